@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+'''
+    Benchmark of the .profile reader against the former pandas python
+    engine path.
+
+    python benchmarks/profile_reader.py [file.profile] [-n repeats]
+
+    Without a file a synthetic file of the real size (345 sections,
+    2 x 1000 points) is written to a temporary directory.
+    Run from the application directory (textron logs to ./log).
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def write_synthetic(filename, sections=345, points=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    heights = rng.integers(400000, 700000, (sections, points))
+    heights[rng.random(heights.shape) < 0.05] = 0
+    with open(filename, 'w') as f:
+        f.write('ScanProgram:1\n')
+        f.write('RFC-20\n')
+        f.write('1;0;0\n')
+        for i in range(4):
+            f.write('\n' if i else 'header\n')
+        for s, row in enumerate(heights):
+            f.write('%d;0;' % s + ';'.join(map(str, row)) + '\n')
+
+
+def read_python_engine(filename):
+    df = pd.read_csv(filename, sep=';', skiprows=7, dtype=float,
+                     header=None, engine='python')
+    df = df.drop([0, 1], axis=1)
+    df.columns = np.arange(0, df.columns.size / 10, 0.1)
+    return df
+
+
+def read_profile_file(filename):
+    from textron.profile_file import ProfileFile
+    scan = ProfileFile(filename)
+    return pd.DataFrame(scan.matrix, columns=scan.x)
+
+
+def timed(func, filename, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = func(filename)
+        times.append(time.perf_counter() - start)
+    return result, min(times), np.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('filename', nargs='?')
+    parser.add_argument('-n', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+    # textron.server checks the command line when the package is imported
+    del sys.argv[1:]
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = args.filename
+        if filename is None:
+            filename = os.path.join(tmp, 'synthetic.profile')
+            write_synthetic(filename)
+        old, oldMin, oldMed = timed(read_python_engine, filename,
+                                    args.repeats)
+        new, newMin, newMed = timed(read_profile_file, filename,
+                                    args.repeats)
+    same = (old.shape == new.shape and
+            np.array_equal(old.to_numpy(), new.to_numpy(), equal_nan=True))
+    print('file: %s, %d x %d' % (args.filename or 'synthetic',
+                                 new.shape[0], new.shape[1]))
+    print('python engine: min %.3f s, median %.3f s' % (oldMin, oldMed))
+    print('ProfileFile:   min %.3f s, median %.3f s' % (newMin, newMed))
+    print('speedup x%.1f, same data: %s' % (oldMed / newMed, same))
+
+
+if __name__ == '__main__':
+    main()
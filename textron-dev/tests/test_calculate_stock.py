@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''
+    Stock of a section by TemplateSection (batched nearest node search,
+    precomputed spline segments, the window around the previous nodes
+    and the k-d tree of large searches) against the former per-point
+    calculation.
+'''
+import numpy as np
+import pytest
+
+from scipy.interpolate import interp1d
+from scipy.spatial import distance
+
+import textron.calculate_stock as calculate_stock
+
+SPLINE = (10, 40, 'quadratic')
+SECTIONS = (0, 100, 345)
+
+
+def surface(x, z, side):
+    '''height of the synthetic blade surface'''
+    if side == 'convex':
+        return 3.0 - 0.05 * (x - 0.5) ** 2 - 0.002 * z
+    return 1.0 - 0.03 * (x - 0.5) ** 2 - 0.002 * z
+
+
+def template_sections(side, rng, count=346):
+    '''
+        sections (2 x n) as read from a template table: x every 0.1 mm,
+        the first and the last cells of a row may be empty
+    '''
+    xs = np.round(np.arange(-7.5, 7.51, 0.1), 2)
+    sections = []
+    for sec in range(count):
+        start = rng.integers(0, 5)
+        end = xs.size - rng.integers(0, 5)
+        x = xs[start:end]
+        sections.append(np.vstack((x, np.round(surface(x, sec / 10, side),
+                                               4))))
+    return sections
+
+
+def reference_closest_node(node, nodes):
+    return nodes[distance.cdist([node], nodes).argmin()]
+
+
+def reference_stock(mes_sec, pts, side, spline=SPLINE):
+    '''stock_calculation as it was: one spline for every measured point'''
+    spline_borders, spline_points, spline_kind = spline
+    x = pts.T[0]
+    y = pts.T[1]
+    stock = np.full(mes_sec.shape[1], np.nan)
+    for i, p in enumerate(mes_sec[0]):
+        pt = np.array([p, mes_sec[1, i]])
+        if pt[0] > x[-1] or (pt[0] < x[0] and pt[1] < y[0]):
+            continue
+        c_n = np.where(x == reference_closest_node(pt, pts)[0])[0]
+        ind_s = max(c_n[0] - spline_borders, 0)
+        ind_e = min(c_n[0] + spline_borders, x.size - 1)
+        f2 = interp1d(x[ind_s:ind_e + 1], y[ind_s:ind_e + 1],
+                      kind=spline_kind)
+        xx = np.linspace(x[ind_s], x[ind_e], spline_points)
+        pts2 = np.vstack((xx, f2(xx))).T
+        d_c = np.min(distance.cdist([pt], pts2))
+        c_n2 = reference_closest_node(pt, pts2)
+        if side == 'convex' and pt[1] < c_n2[1]:
+            d_c = -d_c
+        elif side == 'concave' and pt[1] > c_n2[1]:
+            d_c = -d_c
+        if -0.8 <= d_c <= 0.8:
+            stock[i] = d_c
+    return stock
+
+
+@pytest.fixture(scope='module', params=['convex', 'concave'])
+def template(request):
+    return request.param, template_sections(request.param,
+                                            np.random.default_rng(0))
+
+
+def measured(sec, rng, stock=0.05, points=None):
+    '''
+        points above the template section with noise, with points out of
+        the template, far from it and nan
+    '''
+    x = np.asarray(sec[0])
+    if points is None:
+        points = x.size
+    px = np.sort(rng.uniform(x[0] - 0.3, x[-1] + 0.3, points))
+    py = np.interp(px, x, sec[1]) + stock + rng.normal(0, 0.03, points)
+    py[::17] += 1.  # over 0.8 mm
+    px[5], py[9] = np.nan, np.nan
+    return np.vstack((px, py))
+
+
+@pytest.mark.parametrize('s', SECTIONS)
+def test_stock_calculation_matches_reference(template, s):
+    side, sections = template
+    sec = sections[s]
+    mes = measured(sec, np.random.default_rng(s))
+    expected = reference_stock(mes, sec.T, side)
+    stock = calculate_stock.stock_calculation(
+        mes, sec.T, np.full(mes.shape[1] + 3, np.nan), side, SPLINE)
+    np.testing.assert_allclose(stock[:mes.shape[1]], expected, rtol=0,
+                               atol=1e-9)
+    assert np.isnan(stock[mes.shape[1]:]).all()
+    assert np.isnan(stock[[5, 9]]).all()
+    assert np.isfinite(expected).sum() > mes.shape[1] // 2
+
+
+def test_section_stock_reuses_segments(template):
+    side, sections = template
+    sec = sections[200]
+    tsec = calculate_stock.TemplateSection(sec, *SPLINE)
+    for seed in range(3):
+        mes = measured(sec, np.random.default_rng(seed))
+        np.testing.assert_allclose(
+            calculate_stock.section_stock(mes, tsec, side),
+            reference_stock(mes, sec.T, side), rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('s', SECTIONS)
+def test_nearest_from_start_matches_full_search(template, s):
+    side, sections = template
+    sec = sections[s]
+    tsec = calculate_stock.TemplateSection(sec, *SPLINE)
+    # enough points for the window to be used
+    mes = measured(sec, np.random.default_rng(s), points=400)
+    stock, nodes = calculate_stock.section_stock_nodes(mes, tsec, side)
+    # moved a little, as by a jog or the best fit
+    moved = mes + np.array([[0.02], [-0.01]])
+    expected = calculate_stock.section_stock_nodes(moved, tsec, side)
+    result = calculate_stock.section_stock_nodes(moved, tsec, side,
+                                                 start=nodes)
+    np.testing.assert_array_equal(result[1], expected[1])
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_allclose(
+        result[0], reference_stock(moved, sec.T, side), rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('min_pairs', [0, 10 ** 12])
+def test_kdtree_and_cdist_nearest_nodes(template, monkeypatch, min_pairs):
+    side, sections = template
+    sec = sections[100]
+    tsec = calculate_stock.TemplateSection(sec, *SPLINE)
+    mes = measured(sec, np.random.default_rng(1), points=1000)
+    # the k-d tree for every search, or never
+    monkeypatch.setattr(calculate_stock, 'KDTREE_MIN_PAIRS', min_pairs)
+    stock = calculate_stock.section_stock(mes, tsec, side)
+    assert (tsec.tree is not None) == (min_pairs == 0)
+    np.testing.assert_allclose(stock, reference_stock(mes, sec.T, side),
+                               rtol=0, atol=1e-9)
+    # nodes as by the brute force search, nan points at the first node
+    pts = sec.T
+    inside = ~np.isnan(mes).any(axis=0)
+    expected = np.array([np.where(pts[:, 0] == reference_closest_node(
+        p, pts)[0])[0][0] for p in mes.T[inside]])
+    nodes = tsec.nearest(mes[0], mes[1])
+    np.testing.assert_array_equal(nodes[inside], expected)
+    assert (nodes[~inside] == 0).all()
+
+
+def test_closest_node_matches_reference():
+    rng = np.random.default_rng(2)
+    nodes = rng.normal(size=(300, 2))
+    for node in rng.normal(size=(20, 2)):
+        np.testing.assert_array_equal(
+            calculate_stock.closest_node(node, nodes),
+            reference_closest_node(node, nodes))
+    nodes[0] = np.nan
+    np.testing.assert_array_equal(
+        calculate_stock.closest_node([0.5, 0.5], nodes),
+        reference_closest_node([0.5, 0.5], nodes))
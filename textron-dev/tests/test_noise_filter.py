@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+'''
+    noise_filter with the sliding window kernel against the pandas
+    rolling kernel
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+from textron.profiles_manipulation import noise_filter
+
+WINDOW, MUL = 5, 1.5
+
+
+def heights(rng, shape=(345, 300)):
+    '''integer heights in 1e-5 mm as written by the scanner, with gaps'''
+    values = (rng.integers(0, 12, shape) + 300000).astype(float)
+    values[rng.random(shape) < 0.02] = np.nan
+    return pd.DataFrame(values)
+
+
+def on_bound(df):
+    '''points within rounding of median +- MUL * std of their window'''
+    values = df.to_numpy()
+    windows = sliding_window_view(values, WINDOW, axis=0)
+    median = np.median(windows, axis=-1)
+    std = windows.std(axis=-1, ddof=1)
+    close = np.zeros(values.shape, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        close[WINDOW - 1:] = (np.abs(np.abs(values[WINDOW - 1:] - median)
+                                     - MUL * std) <= 1e-8 * std)
+    return close
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_window_kernel_matches_pandas_out_of_bounds(seed):
+    df = heights(np.random.default_rng(seed))
+    window = noise_filter(df, WINDOW, MUL).to_numpy()
+    pandas = noise_filter(df, WINDOW, MUL, kernel='pandas').to_numpy()
+    differ = ~((np.isnan(window) & np.isnan(pandas)) | (window == pandas))
+    bound = on_bound(df)
+    # the only differences are the points on a bound, kept by the
+    # exact std of the window kernel
+    assert not (differ & ~bound).any()
+    assert np.isfinite(window[differ]).all()
+    assert np.isnan(pandas[differ]).all()
+    assert bound.any()
+
+
+def test_window_kernel_drops_first_rows_and_gaps():
+    df = heights(np.random.default_rng(2), shape=(20, 4))
+    window = noise_filter(df, WINDOW, MUL)
+    assert window.iloc[:WINDOW - 1].isna().all().all()
+    pandas = noise_filter(df, WINDOW, MUL, kernel='pandas')
+    np.testing.assert_array_equal(window.isna().to_numpy()[~on_bound(df)],
+                                  pandas.isna().to_numpy()[~on_bound(df)])
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+'''
+    Calculation of archived parts without the interface.
+
+    python -m textron.batch INPUT [INPUT ...] -o results.csv
+        [--convex TemplateConvex.csv] [--concave TemplateConcave.csv]
+        [--calibration calibration_arrays.csv] [--settings settings.ini]
+        [-j processes] [--no-fit] [--retry-failed]
+
+    INPUT is a directory (its .profile files), a glob or a file. Every
+    part goes through Airfoil, the best fit (shift applied as by the
+    interface), the control sections and areas stock and C2, one part
+    per process. A row of results is appended to the output as soon as
+    the part is done, so a run started again with the same output skips
+    the parts already there (with --retry-failed a part with an error is
+    calculated again, its last row counts). A .parquet output is written
+    at the end of the run (pyarrow or fastparquet), the rows are kept
+    meanwhile in OUTPUT.partial.csv.
+'''
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import textron.configparse as configparse
+
+from textron.logging_module import worker_logging, worker_queue
+from textron.logging_module import write_to_log
+from textron.profiles_manipulation import Airfoil, c2_options
+from textron.profiles_manipulation import control_sections_over_tolerance
+from textron.profiles_manipulation import get_additional_calibration
+
+print = write_to_log
+
+# areas of stock_calc_areas, as in the interface
+AREAS = range(113, 342)
+
+COLUMNS = (['file', 'part', 'kind', 'area_to_measure',
+            'shift_x', 'shift_y', 'shift_c', 'fit_scraped',
+            'scraped_convex', 'scraped_concave', 'no_stock'] +
+           ['cv_control_%d' % i for i in range(1, 5)] +
+           ['cc_control_%d' % i for i in range(1, 5)] +
+           ['cv_area_%d' % i for i in range(1, 7)] +
+           ['cc_area_%d' % i for i in range(1, 7)] +
+           ['c2_%d' % i for i in range(1, 5)] +
+           ['c2_scraped', 'error', 'seconds'])
+
+
+def part_name(filename):
+    '''
+        part ID and kind from the name given by the interface:
+        ID-preX..Y...profile, ID-post.profile ('' if it is not renamed)
+    '''
+    name = os.path.basename(filename)
+    if name.endswith('.profile'):
+        name = name[:-len('.profile')]
+    if '-' not in name:
+        return name, ''
+    part, kind = name.split('-', 1)
+    for known in ('pre', 'post'):
+        if kind.startswith(known):
+            return part, known
+    return part, kind
+
+
+def process_part(filename, options, fit=True):
+    '''results of the part as a row of COLUMNS, error if it has failed'''
+    started = time.time()
+    row = dict.fromkeys(COLUMNS, '')
+    row['file'] = filename
+    row['part'], row['kind'] = part_name(filename)
+    try:
+        settings = configparse.get_settings(options['settings'])
+        blade = Airfoil(dynamic_profile_name=False, profile_file=filename,
+                        calibration_arrays_file=options['calibration'],
+                        additional_calibration=get_additional_calibration(
+                            settings),
+                        settings=settings,
+                        template_convex=options['convex'],
+                        template_concave=options['concave'])
+        row['area_to_measure'] = blade.profile_data.area_to_measure
+        x = y = c = 0.
+        if fit:
+            blade.autoshift2()
+            # as applied by the interface
+            x, y = np.round((blade.x_shift, blade.y_shift), 2)
+            c = blade.c_shift
+            if c:
+                blade.rotate(c)
+            blade.move('X', x)
+            blade.move('Y', y)
+            row['fit_scraped'] = blade.bestfit.scraped
+        row['shift_x'], row['shift_y'], row['shift_c'] = x, y, c
+
+        sections = blade.controlSectionsList
+        conv, conc = blade.stock_calc_control()
+        threshold = settings.getfloat('Processing', 'min_stock_initial_check',
+                                      -0.08)
+        points = settings.getint('Processing', 'points_for_initial_check', 8)
+        row['scraped_convex'] = control_sections_over_tolerance(
+            conv.stock, threshold, points, sections)[1]
+        row['scraped_concave'] = control_sections_over_tolerance(
+            conc.stock, threshold, points, sections)[1]
+        no_stock = settings.getfloat('Grinding', 'no_stock_threshold', 0.1)
+        row['no_stock'] = all(conv.avgStock[i] + conc.avgStock[i] <= no_stock
+                              for i in range(1, len(sections) + 1))
+        for i in range(1, len(sections) + 1):
+            row['cv_control_%d' % i] = conv.avgStock[i]
+            row['cc_control_%d' % i] = conc.avgStock[i]
+
+        # this is a pool process already
+        areas_conv, areas_conc = blade._stock_calc_areas_sc(AREAS)
+        for i in range(1, 7):
+            row['cv_area_%d' % i] = areas_conv.areasMean[i]
+            row['cc_area_%d' % i] = areas_conc.areasMean[i]
+
+        c2 = c2_options(settings, sections)
+        C2 = blade.c2(**c2)[4]
+        for i, value in enumerate(C2):
+            row['c2_%d' % (i + 1)] = value
+        row['c2_scraped'] = any(value < nominal
+                                for value, nominal in zip(C2, c2['C2Nominal']))
+    except Exception as e:
+        print('%s failed: %r' % (filename, e))
+        row['error'] = repr(e)
+    row['seconds'] = round(time.time() - started, 3)
+    return row
+
+
+def profile_files(inputs):
+    '''.profile files of the directories, globs and files, sorted'''
+    files = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            files.update(glob.glob(os.path.join(item, '*.profile')))
+        else:
+            files.update(glob.glob(item))
+    return sorted(os.path.abspath(f) for f in files)
+
+
+def done_files(filenames, retry_failed=False):
+    '''files in the results already written'''
+    done = set()
+    for filename in filenames:
+        if not os.path.exists(filename) or not os.path.getsize(filename):
+            continue
+        if filename.endswith('.parquet'):
+            results = pd.read_parquet(filename, columns=['file', 'error'])
+        else:
+            results = pd.read_csv(filename, usecols=['file', 'error'],
+                                  dtype=str, keep_default_na=False)
+        if retry_failed:
+            results = results[results['error'].fillna('') == '']
+        done.update(results['file'])
+    return done
+
+
+def run(files, output, options, processes=None, fit=True):
+    '''
+        append the rows of files to the csv output,
+        returns the number of the parts done and failed
+    '''
+    new = not os.path.exists(output) or not os.path.getsize(output)
+    done = failed = 0
+    with open(output, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        if new:
+            writer.writeheader()
+        with Pool(processes, initializer=worker_logging,
+                  initargs=(worker_queue(),)) as pool:
+            for row in pool.imap_unordered(
+                    partial(process_part, options=options, fit=fit), files):
+                writer.writerow(row)
+                # the row is kept if the run is interrupted
+                f.flush()
+                done += 1
+                if row['error']:
+                    failed += 1
+                sys.stdout.write('%d/%d %s %s\n' % (
+                    done, len(files), os.path.basename(row['file']),
+                    row['error'] or '%.1f s' % row['seconds']))
+    return done, failed
+
+
+def write_parquet(output, partial_csv):
+    '''add the rows of partial_csv to the parquet output'''
+    rows = pd.read_csv(partial_csv, keep_default_na=False,
+                       dtype={'file': str, 'part': str, 'kind': str,
+                              'error': str})
+    if os.path.exists(output):
+        rows = pd.concat([pd.read_parquet(output), rows], ignore_index=True)
+    rows = rows.drop_duplicates('file', keep='last')
+    rows.to_parquet(output, index=False)
+    os.remove(partial_csv)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m textron.batch',
+        description='Calculation of archived .profile files')
+    parser.add_argument('inputs', nargs='+', metavar='INPUT',
+                        help='directory, glob or .profile file')
+    parser.add_argument('-o', '--output', default='results.csv',
+                        help='.csv or .parquet')
+    parser.add_argument('--convex', default='TemplateConvex.csv')
+    parser.add_argument('--concave', default='TemplateConcave.csv')
+    parser.add_argument('--calibration', default='calibration_arrays.csv')
+    parser.add_argument('--settings', default='settings.ini')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='processes, all cores by default')
+    parser.add_argument('--no-fit', dest='fit', action='store_false',
+                        help='calculate the parts as they are scanned')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='calculate again the parts with an error')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log to the console')
+    args = parser.parse_args(args)
+
+    output = args.output
+    parquet = output.endswith('.parquet')
+    if parquet:
+        try:
+            pd.io.parquet.get_engine('auto')
+        except ImportError as e:
+            parser.error(str(e))
+        rows_file = output + '.partial.csv'
+        written = [output, rows_file]
+    else:
+        rows_file = output
+        written = [output]
+    files = profile_files(args.inputs)
+    done = done_files(written, args.retry_failed)
+    todo = [f for f in files if f not in done]
+    sys.stdout.write('%d files, %d done before, %d to calculate\n' %
+                     (len(files), len(files) - len(todo), len(todo)))
+    options = {'convex': args.convex, 'concave': args.concave,
+               'calibration': args.calibration, 'settings': args.settings}
+    if todo:
+        calculated, failed = run(todo, rows_file, options, args.processes,
+                                 args.fit)
+        sys.stdout.write('%d parts calculated, %d failed\n' %
+                         (calculated, failed))
+    if parquet and os.path.exists(rows_file):
+        write_parquet(output, rows_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+'''
+    Benchmark of the calculation of a part without the interface.
+
+    python -m textron.bench [profiles dir] [--convex TemplateConvex.csv]
+        [--concave TemplateConcave.csv] [--calibration calibration.csv]
+        [--settings settings.ini] [-n repeats] [--save baseline.json]
+        [--compare baseline.json] [-sp]
+
+    Every .profile file of the directory goes through the pipeline of the
+    automatic mode: Airfoil, autoshift2, stock_calc_control,
+    stock_calc_areas, c2 and the PLC results written to PLCDEBUG. Reported
+    are p50/p95/max of every stage (see textron/metrics.py, the nested
+    stages are indented under their stage), peak RSS and parts per
+    minute. Without a directory a synthetic corpus is written to a
+    temporary directory (--synthetic parts).
+    --compare exits with 1 if a stage or the throughput is worse than in
+    the baseline by more than --tolerance.
+    The log is written to ./log as by the server (-v to the console).
+'''
+import argparse
+import configparser
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import textron.configparse as configparse
+import textron.metrics as metrics
+import textron.plc_io as plc_io
+import textron.workers as workers
+
+from textron.plcdebug import PLCDEBUG
+from textron.profiles_manipulation import Airfoil, c2_options
+from textron.profiles_manipulation import get_additional_calibration
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# areas of stock_calc_areas, as in the interface
+AREAS = range(113, 342)
+# a stage is not a regression if it is slower by less than this, s
+MIN_REGRESSION = 0.002
+
+SYNTHETIC_SETTINGS = {
+    'Processing': {'bestfit_method': '2',
+                   'bestfit_spline_borders': '10',
+                   'bestfit_spline_points': '40',
+                   'bestfit_spline_kind': 'quadratic',
+                   'noise_filter_kernel': 'window'},
+    'Calibration': {'cv_shift_x': '0.0', 'cc_shift_x': '0.0',
+                    'cv_shift_y': '0.0', 'cc_shift_y': '0.0',
+                    'cv_tilt_a': '0.0', 'cc_tilt_a': '0.0',
+                    'cv_tilt_b': '0.0', 'cc_tilt_b': '0.0',
+                    'cv_tilt_c': '0.0', 'cc_tilt_c': '0.0'},
+}
+
+
+def _surface(x, z, side):
+    '''height of the synthetic blade surface'''
+    if side == 'convex':
+        return 3.0 - 0.05 * (x - 0.5) ** 2 - 0.002 * z
+    return 1.0 - 0.03 * (x - 0.5) ** 2 - 0.002 * z
+
+
+def write_template(filename, side, rng):
+    xs = np.round(np.arange(-7.5, 7.51, 0.1), 2)
+    with open(filename, 'w') as f:
+        f.write('Template:1\n')
+        f.write('#;' + ';'.join('%.2f' % x for x in xs) + '\n')
+        f.write('0.1;' + ';'.join([''] * xs.size) + '\n')
+        f.write(';' + ';'.join([''] * xs.size) + '\n')
+        for sec in range(346):
+            values = ['%.4f' % v for v in -_surface(xs, sec / 10, side)]
+            # ragged edges as in the real templates
+            for k in range(rng.integers(0, 5)):
+                values[k] = ''
+            for k in range(rng.integers(0, 5)):
+                values[-1 - k] = ''
+            f.write('%d;' % sec + ';'.join(values) + '\n')
+
+
+def write_profile(filename, rng, points=300, stock=0.05, shift=(0., 0.)):
+    '''
+        scan of a part with stock mm on both sides, shifted by shift,
+        with noise, empty points and spikes
+    '''
+    half = points // 2
+    xcv = np.arange(half) * 0.1 - 7.5
+    xcc = -(np.arange(half) + half) * 0.1 + 22.5
+    with open(filename, 'w') as f:
+        f.write('ScanProgram:1\n')
+        f.write('RFC-20\n')
+        f.write('1;0;0\n')
+        for i in range(4):
+            f.write('h%d\n' % i)
+        for row in range(346):
+            z = row / 10
+            ycv = (_surface(xcv - shift[0], z, 'convex') + stock + shift[1] +
+                   rng.normal(0, 0.01, half) + 5.0)
+            ycc = 5.0 - (_surface(xcc + shift[0], z, 'concave') - stock +
+                         shift[1] + rng.normal(0, 0.01, half))
+            heights = np.concatenate((ycv, ycc)) * 1e5
+            heights[rng.random(heights.size) < 0.02] = 0
+            if rng.random() < 0.1:
+                heights[rng.integers(0, heights.size)] += 2e5
+            f.write('%d;0;' % row + ';'.join('%d' % v for v in heights) +
+                    '\n')
+
+
+def write_synthetic(directory, parts=5, seed=0):
+    '''
+        templates, calibration arrays, settings.ini and parts .profile
+        files in directory; returns the options of run()
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    options = {'convex': os.path.join(directory, 'TemplateConvex.csv'),
+               'concave': os.path.join(directory, 'TemplateConcave.csv'),
+               'calibration': os.path.join(directory, 'calibration.csv'),
+               'settings': os.path.join(directory, 'settings.ini')}
+    write_template(options['convex'], 'convex', rng)
+    write_template(options['concave'], 'concave', rng)
+    calibration = np.tile([-7.5, -5.0, 22.5, 5.0], (346, 1))
+    np.savetxt(options['calibration'], calibration, delimiter=';',
+               header='cv_shift_x;cv_shift_y;cc_shift_x;cc_shift_y')
+    configparse.create_config(options['settings'])
+    config = configparser.ConfigParser()
+    config.read(options['settings'])
+    config.read_dict(SYNTHETIC_SETTINGS)
+    with open(options['settings'], 'w') as f:
+        config.write(f)
+    for n in range(parts):
+        write_profile(os.path.join(directory, 'part%03d.profile' % n), rng,
+                      stock=rng.uniform(0.03, 0.08),
+                      shift=rng.uniform(-0.05, 0.05, 2))
+    return options
+
+
+def run_part(filename, options, settings, plc):
+    '''the calculation of the automatic mode, returns its PartTiming'''
+    with metrics.part('bench', keep=False) as record:
+        blade = Airfoil(dynamic_profile_name=False, profile_file=filename,
+                        calibration_arrays_file=options['calibration'],
+                        additional_calibration=get_additional_calibration(
+                            settings),
+                        settings=settings,
+                        template_convex=options['convex'],
+                        template_concave=options['concave'])
+        x, y = blade.autoshift2()
+        blade.move('X', x)
+        blade.move('Y', y)
+        blade.stock_calc_control()
+        conv, conc = blade.stock_calc_areas(AREAS)
+        C2 = blade.c2(**c2_options(settings, blade.controlSectionsList))[4]
+        with metrics.span('plc_results'):
+            plc.write_list(plc_io.stock_results(conv.areasMean,
+                                                conc.areasMean, C2) +
+                           plc_io.offset_results(x, y))
+    return record
+
+
+def peak_rss_mb():
+    '''peak resident memory of this process, None if it is not known'''
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return rss / (1024. ** 2 if sys.platform == 'darwin' else 1024.)
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024. ** 2
+    return None
+
+
+def summary(records, seconds):
+    '''stage statistics of the records, throughput and memory'''
+    stages = {}
+    for record in records:
+        for stage, value in record.stages.items():
+            stages.setdefault(stage, []).append(value)
+    # nested stages after the stage they are run in
+    stages = {stage: stages[stage] for stage in metrics.ordered(stages)}
+    stages['total'] = [record.seconds for record in records]
+    result = {'parts': len(records),
+              'parts_per_minute': len(records) / seconds * 60.,
+              'peak_rss_mb': peak_rss_mb(),
+              'stages': {}}
+    for stage, values in stages.items():
+        values = np.array(values)
+        result['stages'][stage] = {'p50': float(np.percentile(values, 50)),
+                                   'p95': float(np.percentile(values, 95)),
+                                   'max': float(values.max())}
+    return result
+
+
+def run(files, options, repeats=1, warmup=1):
+    '''
+        runs the files repeats times, the first warmup parts (templates
+        compiled and loaded, pool started) are not counted
+    '''
+    settings = configparse.get_settings(options['settings'])
+    plc = plc_io.PlcIO(PLCDEBUG())
+    for filename in files[:warmup]:
+        run_part(filename, options, settings, plc)
+    records = []
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for filename in files:
+            records.append(run_part(filename, options, settings, plc))
+    result = summary(records, time.perf_counter() - started)
+    result.update({'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'files': len(files), 'repeats': repeats})
+    return result
+
+
+def compare(result, baseline, tolerance=0.2):
+    '''
+        regressions of result against baseline: stages slower at p50
+        and the throughput lower by more than tolerance (a fraction)
+    '''
+    regressions = []
+    for stage, new in result['stages'].items():
+        old = baseline['stages'].get(stage)
+        if old is None:
+            continue
+        if (new['p50'] > old['p50'] * (1 + tolerance) and
+                new['p50'] - old['p50'] > MIN_REGRESSION):
+            regressions.append('%s p50 %.4f s, was %.4f s' %
+                               (stage, new['p50'], old['p50']))
+    if result['parts_per_minute'] < (baseline['parts_per_minute'] *
+                                     (1 - tolerance)):
+        regressions.append('%.1f parts per minute, was %.1f' %
+                           (result['parts_per_minute'],
+                            baseline['parts_per_minute']))
+    return regressions
+
+
+def report(result, out=sys.stdout):
+    out.write('%-28s %10s %10s %10s\n' % ('stage, s', 'p50', 'p95', 'max'))
+    for stage, stats in result['stages'].items():
+        # a nested stage is indented under the stage it is run in
+        name = ('  ' * metrics.depth(stage) +
+                stage.split(metrics.SEPARATOR)[-1])
+        out.write('%-28s %10.4f %10.4f %10.4f\n' %
+                  (name, stats['p50'], stats['p95'], stats['max']))
+    out.write('%d parts, %.1f parts per minute' %
+              (result['parts'], result['parts_per_minute']))
+    if result['peak_rss_mb'] is not None:
+        out.write(', peak RSS %.0f MB' % result['peak_rss_mb'])
+    out.write('\n')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m textron.bench',
+        description='Benchmark of the part calculation on .profile files')
+    parser.add_argument('directory', nargs='?',
+                        help='recorded .profile files, a synthetic corpus '
+                             'if not given')
+    parser.add_argument('--convex', default='TemplateConvex.csv')
+    parser.add_argument('--concave', default='TemplateConcave.csv')
+    parser.add_argument('--calibration', default='calibration_arrays.csv')
+    parser.add_argument('--settings', default='settings.ini')
+    parser.add_argument('-n', '--repeats', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='parts run before the measurement')
+    parser.add_argument('--synthetic', type=int, default=5, metavar='PARTS',
+                        help='parts of the synthetic corpus')
+    parser.add_argument('--save', metavar='JSON', help='save the result')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='baseline to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    # read by the modules from sys.argv
+    parser.add_argument('-sp', '--singleprocess', action='store_true',
+                        help='stock of the areas on a single process')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log to the console')
+    args = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.directory is None:
+            options = write_synthetic(tmp, args.synthetic)
+            directory = tmp
+        else:
+            options = {'convex': args.convex, 'concave': args.concave,
+                       'calibration': args.calibration,
+                       'settings': args.settings}
+            directory = args.directory
+        files = sorted(glob.glob(os.path.join(directory, '*.profile')))
+        if not files:
+            parser.error('no .profile files in %s' % directory)
+        try:
+            result = run(files, options, args.repeats, args.warmup)
+        finally:
+            workers.stop_pool()
+    report(result)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            sys.stdout.write('REGRESSION: %s\n' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''
+    Best fit of the measured profiles to the templates.
+
+    The rigid X/Y shift (and C rotation, if asked) is found by least
+    squares of the stock of the control sections points, with a penalty
+    for the points below the scrap threshold.
+'''
+import numpy as np
+import time
+
+from scipy.optimize import least_squares
+
+from textron.calculate_stock import section_stock_nodes, spline_settings
+from textron.calculate_stock import template_section
+from textron.logging_module import write_to_log
+
+print = write_to_log
+
+# distance of the points out of the template, see ControlStock.residuals
+out_of_template = 0.8
+
+
+class ControlStock(object):
+    '''
+        Stock of the control sections points for a shift (x, y) or
+        a rotation and shift (x, y, c in degrees) of the measured
+        profiles. The profiles are only read.
+        sides - ((side, mes profile, template profile), ...)
+    '''
+    def __init__(self, sides, sections, spline):
+        self.sections = []
+        for side, mes, templ in sides:
+            for s in sections:
+                self.sections.append(
+                    (side, s, np.asarray(mes.profiles[s], dtype=np.float64),
+                     template_section(templ, s, spline)))
+        # nearest nodes of the last evaluation, to start from
+        self.nodes = [None] * len(self.sections)
+        self.evaluations = 0
+
+    def __call__(self, params):
+        '''stock of every section (list of arrays)'''
+        self.evaluations += 1
+        dx, dy = params[0], params[1]
+        if len(params) > 2:
+            angle = np.radians(params[2])
+            M = np.array([[np.cos(angle), -np.sin(angle)],
+                          [np.sin(angle), np.cos(angle)]])
+        else:
+            M = None
+        stock = []
+        for n, (side, _, pts, tsec) in enumerate(self.sections):
+            if M is not None:
+                pts = np.dot(M, pts)
+            moved = (pts[0] + dx, pts[1] + dy)
+            sec_stock, self.nodes[n] = section_stock_nodes(moved, tsec, side,
+                                                           self.nodes[n])
+            stock.append(sec_stock)
+        return stock
+
+    def residuals(self, params, threshold=-0.08, penalty=10.):
+        '''
+            stock of all points (points out of the template count as
+            out_of_template) and penalties for the points below threshold
+        '''
+        stock = np.concatenate(self(params))
+        stock[np.isnan(stock)] = out_of_template
+        scrap = np.minimum(stock - threshold, 0) * penalty
+        return np.concatenate((stock, scrap))
+
+    def scraped(self, params, threshold=-0.08, points=8):
+        '''
+            True if a section has points or more points below threshold,
+            as control_sections_over_tolerance
+        '''
+        for stock in self(params):
+            if np.count_nonzero(stock[~np.isnan(stock)] < threshold) >= points:
+                return True
+        return False
+
+
+class BestFit(object):
+    '''
+        Result of best_fit
+        x, y, c - shift and rotation (degrees) of the measured profiles
+        scraped - the part is scraped at this position anyway
+        iterations, evaluations - of the optimizer
+        seconds - time of the fit
+    '''
+    def __init__(self, params, scraped, iterations, evaluations, seconds):
+        self.x, self.y = params[0], params[1]
+        self.c = params[2] if len(params) > 2 else 0.
+        self.scraped = scraped
+        self.iterations = iterations
+        self.evaluations = evaluations
+        self.seconds = seconds
+
+    def __repr__(self):
+        return ('x %.4f, y %.4f, c %.4f, scraped %s, %d iterations, '
+                '%d evaluations, %.3f s' % (self.x, self.y, self.c,
+                                            self.scraped, self.iterations,
+                                            self.evaluations, self.seconds))
+
+
+def best_fit(sides, sections, start=(0., 0.), rotation=False, spline=None,
+             threshold=-0.08, points=8, max_shift=0.1, max_rotation=1.,
+             settings=None):
+    '''
+        Shift (and C rotation if rotation) of the measured profiles
+        with the least squares of the stock in the sections.
+        sides - ((side, mes profile, template profile), ...)
+        start - initial shift, the shift is kept within +-max_shift mm
+        and the rotation within +-max_rotation degrees
+        threshold, points - scrap condition, see ControlStock.scraped
+    '''
+    started = time.time()
+    if spline is None:
+        spline = spline_settings(settings)
+    control = ControlStock(sides, sections, spline)
+    # least_squares starts strictly inside the bounds
+    inside = max_shift * 0.99
+    x0 = list(np.clip(np.nan_to_num(start), -inside, inside))
+    lower, upper = [-max_shift] * 2, [max_shift] * 2
+    if rotation:
+        x0.append(0.)
+        lower.append(-max_rotation)
+        upper.append(max_rotation)
+    result = least_squares(control.residuals, x0, bounds=(lower, upper),
+                           args=(threshold,), x_scale=0.01, xtol=1e-4)
+    params = result.x
+    scraped = control.scraped(params, threshold, points)
+    if scraped and not control.scraped(x0, threshold, points):
+        # the penalty has not kept the fit from the scrap
+        params = np.array(x0)
+        scraped = False
+    fit = BestFit(params, scraped, result.njev, control.evaluations,
+                  time.time() - started)
+    print('best fit: %r' % fit)
+    return fit
@@ -6,57 +6,91 @@ Created on Thu Feb  7 15:58:17 2019
 '''
 import numpy as np
 import os
-from scipy.spatial import distance
+from scipy.spatial import cKDTree, distance
 from scipy.interpolate import interp1d
 # from sys import argv
 
 import textron.configparse as configparse
 from textron.logging_module import write_to_log
+from textron.packed_profiles import PackedProfiles
 
 print = write_to_log
 
+# spline sample operators shared by all template sections,
+# keyed by spline kind, number of points and node spacing
+_spline_operators = {}
+# points x nodes of a full nearest node search from which the k-d tree
+# of the section is used instead of all the distances
+KDTREE_MIN_PAIRS = 100000
+
 
 class Stock(object):
     '''Stock for control sections'''
-    def __init__(self, mes, templ, rng, side):
-        stock = np.full((450, 300), np.nan)
+    def __init__(self, mes, templ, rng, side, settings=None):
         self.side = side
         self.rng = rng
         self.mes = mes
         self.templ = templ
         # self.mes.profiles, self.templ.profiles = cut_rng(self.mes.profiles,
         #     [-5.5,5.5]), cut_rng(self.templ.profiles, [-5.5,5.5])
-        for s in rng:
-            x = templ.profiles[s][0].astype(np.float64)
-            y = templ.profiles[s][1].astype(np.float64)
-            pts = np.vstack((x, y)).T
-            stock[s] = stock_calculation(mes.profiles[s], pts, stock[s], side)
+        self.spline = spline_settings(settings)
+        # nearest template nodes of the measured points by section
+        self.nodes = {}
+        # shift since the last full calculation, see update
+        self.moved = np.zeros(2)
+        self._calculate()
+
+    def _calculate(self, start=None):
+        stock = np.full((450, 300), np.nan)
+        for s in self.rng:
+            tsec = template_section(self.templ, s, self.spline)
+            row, self.nodes[s] = section_stock_nodes(
+                self.mes.profiles[s], tsec, self.side,
+                None if start is None else start.get(s))
+            stock[s][:row.size] = row
         self.stock = stock
         self.avgStock = {i+1: mean_stock(self.stock[s])
                          for i, s in enumerate(self.rng)}
+        return self
+
+    def update(self, dx=0, dy=0, radius=0.5):
+        '''
+            Stock after a rigid shift of the measured profiles (mes is
+            moved already). Nearest template nodes are searched only
+            around the nodes of the last calculation, the result is the
+            same as of a new calculation. When the profiles are moved
+            more than radius mm from the last full calculation, it is
+            calculated again from scratch.
+        '''
+        self.moved = self.moved + (dx, dy)
+        if np.hypot(*self.moved) > radius:
+            self.moved = np.zeros(2)
+            return self._calculate()
+        return self._calculate(self.nodes)
 
 
 class Stock_areas(object):
-    def __init__(self, mes, templ, rng, side='convex'):
+    def __init__(self, mes, templ, rng, side='convex', settings=None):
         self.side = side
-        profiles_mes_list = [area_profiles(mes, rng, n) for n in range(1, 7)]
-        profiles_templ_list = [area_profiles(templ, rng, n)
-                               for n in range(1, 7)]
+        jobs = area_jobs(rng)
+        rows = area_stock_rows([mes.profiles[s] for _, _, s in jobs], templ,
+                               jobs, side, spline_settings(settings))
+        self._set_areas(rng, jobs, rows)
+
+    @classmethod
+    def from_rows(cls, rng, side, jobs, rows):
+        '''Stock_areas assembled from rows calculated by area_stock_rows'''
+        stock = cls.__new__(cls)
+        stock.side = side
+        stock._set_areas(rng, jobs, rows)
+        return stock
+
+    def _set_areas(self, rng, jobs, rows):
         stock_areas = []
         for stock in range(6):
             stock_areas.append(np.full((len(rng) // 3, 200), np.nan))
-
-        for i, stock in enumerate(stock_areas):
-            if i < 2:
-                rng_new = rng[-len(rng)//3:]
-            elif 2 <= i and i < 4:
-                rng_new = rng[len(rng)//3:-len(rng)//3]
-            else:
-                rng_new = rng[:len(rng)//3]
-
-            stock = calculate_area_stock(profiles_mes_list[i],
-                                         profiles_templ_list[i], stock,
-                                         rng_new, side)
+        for (i, k, _), row in zip(jobs, rows):
+            stock_areas[i][k] = row
         self.stock_areas = stock_areas
         self.areasMean = {i+1: mean_stock(area)
                           for i, area in enumerate(self.stock_areas)}
@@ -68,13 +102,137 @@ class profile_special():
         self.profiles = []
 
 
+class TemplateSection(object):
+    '''
+        Template section (2 x n, as in profile.profiles) prepared
+        for batched stock calculation.
+        Every template node has its local spline segment
+        (+-spline_borders nodes, spline_points samples); segments are
+        built on first use and kept for the next calls, as is the k-d
+        tree of the nodes for the large nearest node searches.
+    '''
+    def __init__(self, sec, spline_borders=10, spline_points=40,
+                 spline_kind='quadratic'):
+        self.x = np.asarray(sec[0], dtype=np.float64)
+        self.y = np.asarray(sec[1], dtype=np.float64)
+        self.pts = np.vstack((self.x, self.y)).T
+        self.spline_borders = spline_borders
+        self.spline_points = spline_points
+        self.spline_kind = spline_kind
+        size = self.x.size
+        # segments are centered on the first node with the same x
+        values, first = np.unique(self.x, return_index=True)
+        self.first = first[np.searchsorted(values, self.x)]
+        # nodes go along x, so nodes near a point are found by x
+        self.increasing = bool(np.all(np.diff(self.x) >= 0))
+        nodes = np.arange(size)
+        self.starts = np.maximum(nodes - spline_borders, 0)
+        self.ends = np.minimum(nodes + spline_borders, size - 1)
+        self.segments = np.full((size, spline_points, 2), np.nan)
+        self.built = np.zeros(size, dtype=bool)
+        # widest range of nodes checked around the last nearest node,
+        # see nearest
+        self.max_window = max(size // 4, 8)
+        # k-d tree of the nodes, built on the first large search
+        self.tree = None
+
+    def nearest(self, px, py, start=None):
+        '''
+            Template node closest to every point.
+            start - nodes closest to the points before they were moved a
+            little (-1 if unknown). A node closer than the start node can
+            not be farther from the point in x than the start node, so
+            only the nodes in this range of x are checked then (the full
+            search is done for the points with too wide ranges, and for
+            all points when there are few of them, as it is faster).
+        '''
+        if (start is None or not self.increasing or
+                px.size * self.x.size < 10000):
+            return self._nearest_all(px, py)
+        reach = np.sqrt((px - self.x[start])**2 + (py - self.y[start])**2)
+        reach *= 1 + 1e-9
+        lo = np.searchsorted(self.x, px - reach, 'left')
+        hi = np.searchsorted(self.x, px + reach, 'right')
+        # points with nan have no range and are searched fully too
+        near = (start >= 0) & (hi > lo) & (hi - lo <= self.max_window)
+        nodes = np.empty(px.size, dtype=np.intp)
+        if not near.all():
+            nodes[~near] = self.nearest(px[~near], py[~near])
+        if near.any():
+            lo, hi = lo[near], hi[near]
+            window = np.minimum(lo[:, None] + np.arange((hi - lo).max()),
+                                hi[:, None] - 1)
+            dist = np.sqrt((px[near, None] - self.x[window])**2 +
+                           (py[near, None] - self.y[window])**2)
+            closest = window[np.arange(window.shape[0]), dist.argmin(axis=1)]
+            nodes[near] = self.first[closest]
+        return nodes
+
+    def _nearest_all(self, px, py):
+        '''
+            nearest without a start: all distances for few points and
+            nodes, the k-d tree of the section for more of them
+        '''
+        if px.size * self.x.size < KDTREE_MIN_PAIRS:
+            dist = distance.cdist(np.vstack((px, py)).T, self.pts)
+            return self.first[dist.argmin(axis=1)]
+        if self.tree is None:
+            self.tree = cKDTree(self.pts)
+        closest = self.tree.query(np.vstack((px, py)).T)[1]
+        # points with nan are not found (index of the size),
+        # the first node as by argmin
+        closest[closest >= self.x.size] = 0
+        return self.first[closest]
+
+    def segments_for(self, nodes):
+        '''Spline segments (len(nodes), spline_points, 2) of the nodes'''
+        missing = np.unique(nodes[~self.built[nodes]])
+        if missing.size:
+            self._build(missing)
+        return self.segments[nodes]
+
+    def _build(self, nodes):
+        starts, ends = self.starts[nodes], self.ends[nodes]
+        width = 2 * self.spline_borders + 1
+        inside = np.arange(width) < (ends - starts + 1)[:, None]
+        windows = np.where(inside, starts[:, None] + np.arange(width),
+                           starts[:, None])
+        xw = self.x[windows]
+        yw = np.where(inside, self.y[windows], 0)
+        # windows with the same node spacing share one linear operator
+        # from the node values to the spline samples
+        rel = np.where(inside, np.round(xw - xw[:, :1], 12), np.inf)
+        keys, inverse = np.unique(rel, axis=0, return_inverse=True)
+        operators = np.zeros((len(keys), self.spline_points, width))
+        for k, key in enumerate(keys):
+            key = key[np.isfinite(key)]
+            operators[k, :, :key.size] = self._operator(key)
+        self.segments[nodes, :, 0] = np.linspace(
+            self.x[starts], self.x[ends], self.spline_points, axis=1)
+        self.segments[nodes, :, 1] = np.einsum(
+            'npw,nw->np', operators[inverse.reshape(-1)], yw)
+        self.built[nodes] = True
+
+    def _operator(self, rel):
+        key = (self.spline_kind, self.spline_points, rel.tobytes())
+        if key not in _spline_operators:
+            if len(_spline_operators) > 10000:
+                _spline_operators.clear()
+            f = interp1d(rel, np.eye(rel.size), kind=self.spline_kind, axis=0)
+            _spline_operators[key] = f(np.linspace(0, rel[-1],
+                                                   self.spline_points))
+        return _spline_operators[key]
+
+
 class Stock_special_areas():
     '''
         object for stock in special areas of stock position anomalities
     '''
     def __init__(self, mes, templ, rng, widthRngMm,
-                 controlSectionList, side='convex', check=True):
+                 controlSectionList, side='convex', check=True,
+                 settings=None):
         self.side = side
+        self.settings = settings
         self.mes = mes
         self.templ = templ
         self.rng = rng
@@ -84,8 +242,10 @@ class Stock_special_areas():
             print('найден горб на спинке!')
             self._calculate()
         else:
-            self.mes.profiles = self._cut_rng(self.mes.profiles)
-            self.templ.profiles = self._cut_rng(self.templ.profiles)
+            # cut copies, the profiles passed in stay as they are
+            self.mes, self.templ = profile_special(), profile_special()
+            self.mes.profiles = self._cut_rng(mes.profiles)
+            self.templ.profiles = self._cut_rng(templ.profiles)
             print('начинаю спецоперацию...')
             self._calculate()
 
@@ -112,7 +272,8 @@ class Stock_special_areas():
             else:
                 rng_new = self.rng[:len(self.rng)//3]
             stock = calculate_area_stock(mesList[i], templList[i],
-                                         stock, rng_new, self.side)
+                                         stock, rng_new, self.side,
+                                         spline_settings(self.settings))
         self.areasMean = {i+1: mean_stock(area)
                           for i, area in enumerate(self.stock_special_areas)}
 
@@ -122,7 +283,7 @@ class Stock_special_areas():
         mesSpecial.profiles = self._cut_rng(self.mes.profiles)
         templSpecial.profiles = self._cut_rng(self.templ.profiles)
         convStockSpecial = Stock(mesSpecial, templSpecial,
-                                 rngSpecial, self.side)
+                                 rngSpecial, self.side, self.settings)
         for s in rngSpecial:
             if np.mean(convStockSpecial.stock[s][
                         ~np.isnan(convStockSpecial.stock[s])]) > 0.1:
@@ -141,33 +302,65 @@ class Stock_special_areas():
                 for s in range(len(p))]
 
 
+def area_jobs(rng):
+    '''
+        (area index, row, section) of every stock row of the six areas.
+        The last section of an area is not calculated.
+    '''
+    jobs = []
+    for i in range(6):
+        sections = get_rng_area(rng, i + 1)
+        for k, s in enumerate(sections[:len(sections)-1]):
+            jobs.append((i, k, s))
+    return jobs
+
+
 def area_profiles(mes, rng, area_num):
+    return [area_section(mes.profiles[s], area_num)
+            for s in get_rng_area(rng, area_num)]
+
+
+def area_section(sec, area_num):
+    '''part of the section of the area: x > 1 for even areas'''
     if area_num % 2 == 0:
-        return [np.vstack((mes.profiles[s][0][np.where(mes.profiles[s][0] >
-                                                       1)[0]],
-                mes.profiles[s][1][np.where(mes.profiles[s][0] > 1)[0]]))
-                for s in get_rng_area(rng, area_num)]
+        ind = np.where(sec[0] > 1)[0]
     else:
-        return [np.vstack((mes.profiles[s][0][np.where(mes.profiles[s][0] <=
-                                                       1)[0]],
-                mes.profiles[s][1][np.where(mes.profiles[s][0] <= 1)[0]]))
-                for s in get_rng_area(rng, area_num)]
+        ind = np.where(sec[0] <= 1)[0]
+    return np.vstack((sec[0][ind], sec[1][ind]))
 
 
-def calculate_area_stock(profiles_mes, profiles_templ, area_stock, rng, side):
+def area_stock_rows(mes_sections, templ, jobs, side, spline):
+    '''
+        Stock rows for area jobs (see area_jobs),
+        mes_sections - measured sections of the jobs in the same order.
+        Area parts of the template sections are kept on templ.
+    '''
+    rows = np.full((len(jobs), 200), np.nan)
+    for n, ((i, _, s), sec) in enumerate(zip(jobs, mes_sections)):
+        tsec = template_section(templ, s, spline, area_num=i + 1)
+        rows[n] = stock_calculation(area_section(sec, i + 1), tsec, rows[n],
+                                    side)
+    return rows
+
+
+def calculate_area_stock(profiles_mes, profiles_templ, area_stock, rng, side,
+                         spline=None):
+    if spline is None:
+        spline = spline_settings()
     for s in range(len(profiles_mes)-1):
-        x = profiles_templ[s][0].astype(np.float64)
-        y = profiles_templ[s][1].astype(np.float64)
-        pts = np.vstack((x, y)).T
-        area_stock[s] = stock_calculation(profiles_mes[s],
-                                          pts, area_stock[s],
-                                          side)
-        s += 20
+        tsec = TemplateSection(profiles_templ[s], *spline)
+        area_stock[s] = stock_calculation(profiles_mes[s], tsec,
+                                          area_stock[s], side)
     return area_stock
 
 
 def closest_node(node, nodes):
-    return nodes[distance.cdist([node], nodes).argmin()]
+    '''
+        point of nodes (n x 2) closest to node; the nodes of a measured
+        section are new on every call, so they are not indexed
+    '''
+    nodes = np.asarray(nodes)
+    return nodes[((nodes - node)**2).sum(axis=1).argmin()]
 
 
 def cut_rng(p, borders):
@@ -197,46 +390,102 @@ def mean_stock(area):
     return np.round(area[~np.isnan(area)].mean(), 3)
 
 
-def stock_calculation(mes_sec, pts, stock_s, side):
-    # spline_borders = 5  # +-how many points for spline borders
-    # spline_points = 50  # in how many points to calcuclate the f(x)
-    configFilePath = os.path.join('settings.ini')
-    spline_borders = int(configparse.get_setting(configFilePath, 'Processing',
-                                             'bestfit_spline_borders'))
-    spline_points = int(configparse.get_setting(configFilePath, 'Processing',
-                                             'bestfit_spline_points'))
-    spline_kind = configparse.get_setting(configFilePath, 'Processing',
-                                             'bestfit_spline_kind')
-    x = pts.T[0]
-    y = pts.T[1]
-    for i, p in enumerate(mes_sec[0]):
-        pt = np.array([p, mes_sec[1, i]])
-        if pt[0] > x[-1] or (pt[0] < x[0] and pt[1] < y[0]):
-            d_c = np.nan
-        else:
-            c_n = np.where(x == closest_node(pt, pts)[0])[0]
-            # import pdb; pdb.set_trace()
-            ind_s = c_n[0] - spline_borders
-            ind_e = c_n[0] + spline_borders
-            while ind_s < 0:
-                ind_s += 1
-            while ind_e > x.size-1:
-                ind_e -= 1
-            x1 = x[ind_s:ind_e+1]
-            y1 = y[ind_s:ind_e+1]
-            f2 = interp1d(x1, y1, kind=spline_kind)
-            xx = np.linspace(x[ind_s], x[ind_e], spline_points)
-            yy2 = f2(xx)
-            pts2 = np.vstack((xx, yy2)).T
-            d_c = np.min(distance.cdist([pt], pts2))
-            c_n2 = closest_node(pt, pts2)
-            if side == 'convex':
-                if pt[1] < c_n2[1]:
-                    d_c = -d_c
-            elif side == 'concave':
-                if pt[1] > c_n2[1]:
-                    d_c = -d_c
-            if d_c > 0.8 or d_c < -0.8:
-                d_c = np.nan
-        stock_s[i] = d_c
+def section_stock(mes_sec, tsec, side):
+    '''
+        Signed distances from all measured points of a section to the
+        template section in one pass: one nearest node query for all points,
+        then distance to the precomputed spline segment of that node.
+        Matches the former per-point loop to within 1e-9 mm.
+    '''
+    return section_stock_nodes(mes_sec, tsec, side)[0]
+
+
+def section_stock_nodes(mes_sec, tsec, side, start=None):
+    '''
+        section_stock and the nearest template nodes of the points
+        (-1 for the points out of the template).
+        start - nodes of the previous calculation for the same points
+        moved a little, see TemplateSection.nearest
+    '''
+    px = np.asarray(mes_sec[0], dtype=np.float64)
+    py = np.asarray(mes_sec[1], dtype=np.float64)
+    stock = np.full(px.size, np.nan)
+    nodes = np.full(px.size, -1, dtype=np.intp)
+    if not px.size:
+        return stock, nodes
+    x, y = tsec.x, tsec.y
+    inside = ~((px > x[-1]) | ((px < x[0]) & (py < y[0])))
+    px, py = px[inside], py[inside]
+    if start is not None and start.size == inside.size:
+        start = start[inside]
+    else:
+        start = None
+    nodes[inside] = tsec.nearest(px, py, start)
+    segments = tsec.segments_for(nodes[inside])
+    dist = np.sqrt((px[:, None] - segments[:, :, 0])**2 +
+                   (py[:, None] - segments[:, :, 1])**2)
+    rows = np.arange(px.size)
+    closest = dist.argmin(axis=1)
+    d_c = dist[rows, closest]
+    if side == 'convex':
+        d_c[py < segments[rows, closest, 1]] *= -1
+    elif side == 'concave':
+        d_c[py > segments[rows, closest, 1]] *= -1
+    d_c[(d_c > 0.8) | (d_c < -0.8)] = np.nan
+    stock[inside] = d_c
+    return stock, nodes
+
+
+def spline_settings(settings=None):
+    '''
+        (borders, points, kind) of the local spline used for stock
+    '''
+    if settings is None:
+        settings = configparse.get_settings(os.path.join('settings.ini'))
+    return settings.spline
+
+
+def stock_calculation(mes_sec, pts, stock_s, side, spline=None):
+    '''
+        pts - template section, either (n, 2) array of points or
+        TemplateSection
+    '''
+    if not isinstance(pts, TemplateSection):
+        if spline is None:
+            spline = spline_settings()
+        pts = TemplateSection(np.asarray(pts).T, *spline)
+    stock = section_stock(mes_sec, pts, side)
+    stock_s[:stock.size] = stock
     return stock_s
+
+
+def template_section(templ, s, spline, area_num=None):
+    '''
+        TemplateSection for section s of the template profile,
+        or for its part in the area if area_num is given.
+        Kept on the template object, so repeated stock calculations
+        (best fit, control sections, areas) reuse the spline segments.
+    '''
+    try:
+        cache = templ.stock_cache
+    except AttributeError:
+        cache = templ.stock_cache = {}
+    profiles = templ.profiles
+    sec = profiles[s]
+    # sections of packed profiles are new views on every access,
+    # their changes are tracked by the version of the buffer
+    # (templates from one file share the buffer and this cache)
+    if isinstance(profiles, PackedProfiles):
+        owner, version = profiles.raw, profiles.version
+    else:
+        owner, version = sec, None
+    part = None if area_num is None else area_num % 2
+    key = (s, part) + tuple(spline)
+    entry = cache.get(key)
+    if entry is None or entry[0] is not owner or entry[1] != version:
+        if part is not None:
+            tsec = TemplateSection(area_section(sec, area_num), *spline)
+        else:
+            tsec = TemplateSection(sec, *spline)
+        entry = cache[key] = (owner, version, tsec)
+    return entry[2]
@@ -1,5 +1,7 @@
 import configparser
+import numpy as np
 import os
+import threading
 from shutil import copyfile
 from sys import argv
 
@@ -9,6 +11,77 @@ from textron.logging_module import write_to_log
 #     print = write_to_log
 print = write_to_log
 
+# settings snapshots by path of the config file
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+class Settings(object):
+    '''
+    Immutable snapshot of settings.ini.
+    Option names are case insensitive, as in ConfigParser.
+    '''
+    def __init__(self, data, path='settings.ini', stamp=None):
+        data = {section: {option.lower(): value
+                          for option, value in options.items()}
+                for section, options in data.items()}
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, 'path', path)
+        object.__setattr__(self, 'stamp', stamp)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings snapshot is read only')
+
+    def __reduce__(self):
+        return (Settings, (self._data, self.path, self.stamp))
+
+    @classmethod
+    def from_config(cls, config, path='settings.ini', stamp=None):
+        return cls({section: dict(config[section])
+                    for section in config.sections()}, path, stamp)
+
+    def get(self, section, setting, fallback=None):
+        return self._data.get(section, {}).get(setting.lower(), fallback)
+
+    def getbool(self, section, setting, fallback=False):
+        value = self.get(section, setting)
+        if value is None:
+            return fallback
+        return value.lower() in ('yes', 'true', 't', '1')
+
+    def getfloat(self, section, setting, fallback=None):
+        value = self.get(section, setting)
+        return fallback if value is None else float(value)
+
+    def getint(self, section, setting, fallback=None):
+        value = self.get(section, setting)
+        return fallback if value is None else int(value)
+
+    def getlist(self, section, setting):
+        '''comma separated list of floats'''
+        return [float(i) for i in self[section, setting].split(',')]
+
+    def __getitem__(self, key):
+        section, setting = key
+        return self._data[section][setting.lower()]
+
+    @property
+    def control_sections(self):
+        return [int(np.round(i, 1) * 10)
+                for i in self.getlist('Profile', 'control_sections')]
+
+    @property
+    def spline(self):
+        '''(borders, points, kind) of the spline for stock and best fit'''
+        return (int(self['Processing', 'bestfit_spline_borders']),
+                int(self['Processing', 'bestfit_spline_points']),
+                self['Processing', 'bestfit_spline_kind'])
+
+    @property
+    def spline_kind(self):
+        return self['Processing', 'bestfit_spline_kind']
+
+
 def create_config(path):
     """
     Create a config file
@@ -63,6 +136,7 @@ def delete_setting(path, section, setting):
     config.remove_option(section, setting)
     with open(path, "w") as config_file:
         config.write(config_file)
+    _drop_snapshot(path)
 
 def get_config(path):
     """
@@ -85,9 +159,21 @@ def get_setting(path, section, setting):
     """
     Print out a setting
     """
-    config = get_config(path)
-    value = config[section][setting]
-    return value
+    return get_settings(path)[section, setting]
+
+def get_settings(path='settings.ini'):
+    """
+    Returns the settings snapshot, the file is parsed again only
+    when its modification time or size changes
+    """
+    with _snapshots_lock:
+        snapshot = _snapshots.get(path)
+        stamp = _file_stamp(path)
+        if snapshot is None or stamp is None or snapshot.stamp != stamp:
+            config = get_config(path)
+            snapshot = Settings.from_config(config, path, _file_stamp(path))
+            _snapshots[path] = snapshot
+        return snapshot
 
 def update_setting(path, section, setting, value):
     """
@@ -97,6 +183,18 @@ def update_setting(path, section, setting, value):
     config[section][setting] = value
     with open(path, "w", encoding = 'utf-8') as config_file:
         config.write(config_file)
+    _drop_snapshot(path)
+
+def _drop_snapshot(path):
+    with _snapshots_lock:
+        _snapshots.pop(path, None)
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
 
 if __name__ == "__main__":
 #    path = "settings.ini"
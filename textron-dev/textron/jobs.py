@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+'''
+    Calculations of a session out of the bokeh callbacks.
+
+    A job is a list of stages run one after another in the thread of the
+    session's JobRunner, so the document is not locked while they run.
+    The widgets are changed only in the document: by the callbacks of the
+    job (progress, done, failed, cancelled), which are run on the next
+    tick, or by Job.in_document from a stage.
+'''
+import threading
+
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from functools import partial
+
+import textron.metrics as metrics
+
+from textron.logging_module import write_to_log
+
+print = write_to_log
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Job(object):
+    '''
+        name - for the log
+        stages - [(name, func), ...], value = func(job, value),
+        the first stage gets None
+        progress(stage name, number, count) - before every stage
+        done(value) - after the last stage
+        failed(error) - a stage has raised error
+        cancelled() - the job is cancelled before its end
+        timed - record the durations of the stages, see textron/metrics.py
+    '''
+    def __init__(self, name, stages, progress=None, done=None, failed=None,
+                 cancelled=None, timed=False):
+        self.name = name
+        self.timed = timed
+        self.stages = stages
+        self.progress = progress
+        self.done = done
+        self.failed = failed
+        self.cancelled = cancelled
+        self.doc = None
+        self.finished = threading.Event()
+        self._cancel = threading.Event()
+        self._waiting = None
+        self.record = None
+
+    def cancel(self):
+        '''stop the job before its next stage'''
+        self._cancel.set()
+        waiting = self._waiting
+        if waiting is not None:
+            waiting.cancel()
+
+    def is_cancelled(self):
+        return self._cancel.is_set()
+
+    def check(self):
+        '''raise Cancelled if the job is cancelled'''
+        if self._cancel.is_set():
+            raise Cancelled(self.name)
+
+    def in_document(self, func, *args):
+        '''
+            func(*args) on the next tick of the document, returns its
+            result when it is done; raises Cancelled if the job is
+            cancelled meanwhile
+        '''
+        future = Future()
+
+        def call():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.check()
+        self._waiting = future
+        try:
+            self.doc.add_next_tick_callback(call)
+            return future.result()
+        except CancelledError:
+            raise Cancelled(self.name)
+        finally:
+            self._waiting = None
+
+    def _tick(self, callback, *args):
+        if callback is not None:
+            self.doc.add_next_tick_callback(partial(callback, *args))
+
+    def run(self):
+        try:
+            if self.timed:
+                with metrics.part(self.name) as self.record:
+                    callback, args = self._run()
+            else:
+                callback, args = self._run()
+        finally:
+            self.finished.set()
+        # after the record is saved
+        self._tick(callback, *args)
+
+    def _run(self):
+        '''the stages, returns the last callback and its arguments'''
+        value = None
+        try:
+            for n, (stage, func) in enumerate(self.stages):
+                self.check()
+                print('%s: %s' % (self.name, stage))
+                self._tick(self.progress, stage, n + 1, len(self.stages))
+                with metrics.span(stage):
+                    value = func(self, value)
+            self.check()
+        except Exception as e:
+            # a cancelled job may fail on the data changed meanwhile
+            if isinstance(e, Cancelled) or self._cancel.is_set():
+                print('%s is cancelled' % self.name)
+                return self.cancelled, ()
+            print('%s failed: %r' % (self.name, e))
+            return self.failed, (e,)
+        return self.done, (value,)
+
+
+class JobRunner(object):
+    '''
+        Runs the jobs of a document one by one in a thread
+        jobs - submitted jobs not finished yet
+    '''
+    def __init__(self, doc):
+        self.doc = doc
+        self.jobs = []
+        self.lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(1)
+
+    def submit(self, job, cancel=False):
+        '''
+            run job after the jobs submitted before it,
+            cancel - cancel them first (e.g. a new profile is loaded)
+        '''
+        job.doc = self.doc
+        with self.lock:
+            self.jobs = [j for j in self.jobs if not j.finished.is_set()]
+            if cancel:
+                for j in self.jobs:
+                    j.cancel()
+            self.jobs.append(job)
+        self._executor.submit(job.run)
+        return job
+
+    def cancel(self, names):
+        '''cancel the jobs with these names'''
+        with self.lock:
+            for j in self.jobs:
+                if j.name in names:
+                    j.cancel()
+
+    def running(self, name):
+        '''True if a job with the name is not finished'''
+        with self.lock:
+            return any(j.name == name and not j.finished.is_set()
+                       for j in self.jobs)
+
+    def shutdown(self):
+        '''cancel the jobs, the thread ends after the current stage'''
+        with self.lock:
+            for j in self.jobs:
+                j.cancel()
+            self.jobs = []
+        self._executor.shutdown(wait=False)
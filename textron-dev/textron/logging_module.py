@@ -3,53 +3,174 @@
 Created on Mon Apr  8 12:29:39 2019
 
 @author: grin
+
+The messages are put in a queue and written to ./log/out.log (rotated by
+size) or, with -v/--verbose, to the console by a background thread, so
+write_to_log does not wait for the file. Every module logs with its own
+logger, named after the module.
+Only the main process writes (and rotates) the file: the pool processes
+send their records to it through worker_queue (worker_logging is their
+initializer), a child process without it logs to stderr.
 """
 
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
 import sys
 
-class StreamToLogger(object):
-    """
-    Fake file-like stream object that redirects writes to a logger instance.
-    """
-    def __init__(self, logger, log_level=logging.INFO):
-        self.logger = logger
-        self.log_level = log_level
-        self.linebuf = ''
+LOG_DIR = './log'
+LOG_FILE = 'out.log'
+# size of out.log before it is rotated to out.log.1, ...
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 10
+
+_listener = None
+_handler = None
+_loggers = {}
+# records of the pool processes, see worker_queue
+_worker_queue = None
+_worker_listener = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''queues the records of write_to_log as they are, without a copy'''
+    def prepare(self, record):
+        if record.args or record.exc_info or record.stack_info:
+            return super().prepare(record)
+        return record
+
+
+def setup_logging(verbose=None):
+    '''
+        Send the records of all loggers through a queue to the file
+        (or the console if verbose, by default if -v/--verbose is given)
+        written by a background thread
+    '''
+    global _listener, _handler
+    if _listener is not None:
+        return
+    # a spawned pool process imports this module before its parent
+    # process is known, but after its name is set
+    if (multiprocessing.parent_process() is not None or
+            multiprocessing.current_process().name != 'MainProcess'):
+        _child_logging()
+        return
+    if verbose is None:
+        verbose = '--verbose' in sys.argv or '-v' in sys.argv
+    if verbose:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+    else:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            os.path.join(LOG_DIR, LOG_FILE), 'a', LOG_MAX_BYTES, LOG_BACKUPS,
+            'utf-8')
+        handler.setFormatter(logging.Formatter(
+            datefmt='%Y-%m-%d;%H:%M:%S',
+            fmt='%(asctime)s;%(levelname)s;%(name)s;%(message)s'))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    _handler = _QueueHandler(log_queue)
+    root.addHandler(_handler)
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def _child_logging(handler=None):
+    '''
+        records of a child process to handler, stderr by default:
+        the file is written by the main process only
+    '''
+    global _handler
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    if handler is None:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(
+            '%(process)d;%(levelname)s;%(name)s;%(message)s'))
+    _handler = handler
+    root.setLevel(logging.INFO)
+    root.addHandler(_handler)
 
-    def close(self):
-        logging.shutdown()
 
-    def flush(self):
-        pass
+def _after_fork():
+    # the writing threads are not copied to a forked process
+    global _listener, _worker_queue, _worker_listener
+    if _listener is not None:
+        _listener = None
+        _worker_queue, _worker_listener = None, None
+        _child_logging()
 
-    def write(self, buf):
-        for line in buf.rstrip().splitlines():
-            self.logger.log(self.log_level, line.rstrip())
 
+def worker_queue():
+    '''
+        queue for the records of the pool processes, written by this
+        process with its own (pass it to worker_logging)
+    '''
+    global _worker_queue, _worker_listener
+    setup_logging()
+    if _worker_queue is None and _listener is not None:
+        _worker_queue = multiprocessing.Queue()
+        _worker_listener = logging.handlers.QueueListener(
+            _worker_queue, *_listener.handlers)
+        _worker_listener.start()
+    return _worker_queue
 
-if (not '--verbose' in sys.argv) and (not '-v' in sys.argv):
-    fh = logging.FileHandler('./log/out.log', 'a', 'utf-8')
-    logging.basicConfig(
-        level=logging.INFO,
-        datefmt = '%Y-%m-%d;%H:%M:%S',
-        format='%(asctime)s;%(levelname)s;%(name)s;%(message)s',
-        #filename="out.log",
-        handlers = [fh]
-    )
+
+def worker_logging(log_queue):
+    '''
+        initializer of a pool process: its records go to the queue of
+        the main process (worker_queue)
+    '''
+    if log_queue is not None:
+        _child_logging(logging.handlers.QueueHandler(log_queue))
+
+
+def stop_logging():
+    '''write the queued records and stop the background thread'''
+    global _listener, _worker_listener
+    if _worker_listener is not None:
+        _worker_listener.stop()
+        _worker_listener = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name):
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers[name] = logging.getLogger(name)
+    return logger
+
+
+setup_logging()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
 
 # logging.getLogger('bokeh.server').setLevel(logging.WARNING)
 logging.getLogger('tornado.access').disabled = True
 
 def write_to_log(mes, mesType = 'info'):
-    if (not '--verbose' in sys.argv) and (not '-v' in sys.argv):
-        stdout_logger = logging.getLogger('STDOUT')
-        sl1 = StreamToLogger(stdout_logger, logging.INFO)
-        sys.stdout = sl1
-        stderr_logger = logging.getLogger('STDERR')
-        sl2 = StreamToLogger(stderr_logger, logging.ERROR)
-        sys.stderr = sl2
-        print(mes)
-        for i in (sl1, sl2): i.close()
-    else:
-        print(mes)
+    '''
+        Log mes (print is replaced by it in the modules) with the logger
+        of the calling module, one record per line
+        mesType - 'info', 'warning', 'error'...
+    '''
+    logger = get_logger(sys._getframe(1).f_globals.get('__name__', 'STDOUT'))
+    level = logging.getLevelName(mesType.upper())
+    if not isinstance(level, int):
+        level = logging.INFO
+    if not logger.isEnabledFor(level):
+        return
+    for line in str(mes).rstrip().splitlines():
+        # the record is made directly: Logger.log would look for the
+        # source line of the call in the stack
+        logger.handle(logger.makeRecord(logger.name, level, '', 0,
+                                        line.rstrip(), None, None))
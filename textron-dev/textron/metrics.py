@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+'''
+    Durations of the calculation stages of a part.
+
+    A PartTiming is started for a job by part(); the functions decorated
+    by timed() and the blocks in span() record their durations in the
+    record of their thread. A stage run within another one is recorded
+    under the path of the stages it is nested in, e.g. 'загрузка/Airfoil'
+    and 'загрузка/Airfoil/profile', so the seconds of the top stages
+    (without SEPARATOR) are not counted twice. At the end the record is
+    written as one line of METRICS_FILE and kept in recent for the
+    interface.
+    Without a record a span only checks that there is none.
+'''
+import html
+import json
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from textron.logging_module import write_to_log
+
+print = write_to_log
+
+METRICS_FILE = './log/metrics.jsonl'
+# between the names of a nested stage and of the stages it is run in
+SEPARATOR = '/'
+
+# last records, newest last
+recent = deque(maxlen=20)
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class PartTiming(object):
+    '''
+        Durations of the stages of one part
+        job - name of the calculation
+        part - part ID, file - profile file name
+        stages - {stage path: seconds}, summed if a stage runs more
+        than once (see SEPARATOR)
+        seconds - of the whole calculation
+    '''
+    def __init__(self, job=''):
+        self.job = job
+        self.part = ''
+        self.file = ''
+        self.started = time.time()
+        self.stages = {}
+        self.seconds = None
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.) + seconds
+
+    def as_dict(self):
+        with self.lock:
+            stages = {stage: round(seconds, 4)
+                      for stage, seconds in self.stages.items()}
+        return {'time': time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.localtime(self.started)),
+                'job': self.job, 'part': self.part, 'file': self.file,
+                'seconds': round(self.seconds or 0., 4), 'stages': stages}
+
+
+def current():
+    '''record of the thread, None if there is none'''
+    return getattr(_local, 'record', None)
+
+
+def _path():
+    '''names of the stages running in the thread, outer first'''
+    return getattr(_local, 'path', ())
+
+
+@contextmanager
+def _stage(record, stage):
+    path = _path()
+    _local.path = path + (stage,)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _local.path = path
+        record.add(SEPARATOR.join(path + (stage,)),
+                   time.perf_counter() - start)
+
+
+def depth(stage):
+    '''number of the stages stage is nested in'''
+    return stage.count(SEPARATOR)
+
+
+def ordered(stages):
+    '''stage paths, every stage before the stages nested in it'''
+    rank = {}
+    for stage in stages:
+        names = stage.split(SEPARATOR)
+        for i in range(1, len(names) + 1):
+            rank.setdefault(tuple(names[:i]), len(rank))
+
+    def key(stage):
+        names = stage.split(SEPARATOR)
+        return [rank[tuple(names[:i])] for i in range(1, len(names) + 1)]
+    return sorted(stages, key=key)
+
+
+@contextmanager
+def part(job='', keep=True):
+    '''
+        record the stages run in this thread,
+        saved at the end if keep (see save)
+    '''
+    record = PartTiming(job)
+    previous, path = current(), _path()
+    _local.record, _local.path = record, ()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        _local.record, _local.path = previous, path
+        record.seconds = time.perf_counter() - start
+        if keep:
+            save(record)
+
+
+@contextmanager
+def span(stage):
+    record = current()
+    if record is None:
+        yield
+        return
+    with _stage(record, stage):
+        yield
+
+
+def timed(stage):
+    '''decorator: the calls of the function are the stage'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            record = current()
+            if record is None:
+                return func(*args, **kwargs)
+            with _stage(record, stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(func):
+    '''
+        func for another thread, recording in the record of this one
+        within the stages running here
+    '''
+    record, path = current(), _path()
+
+    @wraps(func)
+    def bound(*args, **kwargs):
+        previous = current(), _path()
+        _local.record, _local.path = record, path
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.record, _local.path = previous
+    return bound
+
+
+def annotate(part=None, file=None):
+    '''set the part ID or the file name of the record of this thread'''
+    record = current()
+    if record is None:
+        return
+    if part is not None:
+        record.part = part
+    if file is not None:
+        record.file = os.path.basename(file)
+
+
+def save(record):
+    with _lock:
+        recent.append(record)
+        try:
+            with open(METRICS_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record.as_dict(), ensure_ascii=False)
+                        + '\n')
+        except OSError as e:
+            print('metrics are not written: %s' % e)
+
+
+def html_table(records, stages=None):
+    '''
+        records as an html table for a Div, newest first,
+        one column for each stage (all stages of the records by default),
+        the nested stages after the stage they are run in
+    '''
+    records = list(records)[::-1]
+    if stages is None:
+        stages = []
+        for record in records:
+            for stage in record.stages:
+                if stage not in stages:
+                    stages.append(stage)
+        stages = ordered(stages)
+    head = ''.join('<th>%s</th>' % html.escape(s) for s in
+                   ['время', 'деталь', 'файл', 'всего, с'] +
+                   [s.replace(SEPARATOR, ' › ') for s in stages])
+    rows = []
+    for record in records:
+        data = record.as_dict()
+        cells = [data['time'][11:], data['part'], data['file'],
+                 '%.2f' % data['seconds']]
+        cells += ['%.3f' % data['stages'][s] if s in data['stages'] else ''
+                  for s in stages]
+        rows.append('<tr>%s</tr>' % ''.join('<td>%s</td>' % html.escape(c)
+                                            for c in cells))
+    return '<table><tr>%s</tr>%s</table>' % (head, ''.join(rows))
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+'''
+    Packed (ragged array) representation of the sections of one side
+'''
+import numpy as np
+import sys
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+
+class Transform(object):
+    '''
+        Affine transform of the points of a section at z mm:
+            p' = M p + t + z k
+        M - rotation (C), t - translation (X, Y), k - tilt (B, A) as
+        tangents of the angles. Transforms are not changed in place,
+        every operation returns a new one.
+    '''
+    def __init__(self, M=None, t=(0., 0.), k=(0., 0.)):
+        self.M = M
+        self.t = np.asarray(t, dtype=np.float64)
+        self.k = np.asarray(k, dtype=np.float64)
+
+    def moved(self, dx, dy):
+        return Transform(self.M, self.t + (dx, dy), self.k)
+
+    def rotated(self, angle, center=(0., 0.)):
+        '''rotated by angle degrees around center'''
+        angle = np.radians(angle)
+        c = np.cos(angle)
+        s = np.sin(angle)
+        R = np.array([[c, -s],
+                      [s, c]])
+        center = np.asarray(center, dtype=np.float64)
+        M = R if self.M is None else np.dot(R, self.M)
+        return Transform(M, np.dot(R, self.t - center) + center,
+                         np.dot(R, self.k))
+
+    def tilted(self, axis, angle):
+        '''tilted around A (y grows with z) or B (x grows with z)'''
+        tan = np.tan(np.radians(angle))
+        return Transform(self.M, self.t,
+                         self.k + ((0., tan) if axis == 'A' else (tan, 0.)))
+
+    def apply(self, points, z):
+        '''points - 2 x n, z - position of the section or of every point'''
+        if self.M is not None:
+            points = np.dot(self.M, points)
+        else:
+            points = points.copy()
+        points += self.t[:, None]
+        if self.k.any():
+            points += self.k[:, None] * z
+        return points
+
+
+class PackedProfiles(object):
+    '''
+        All sections of a side in one contiguous float64 buffer.
+        raw - 2 x N array, x and y of all sections one after another
+        offsets - start of every section in raw, one more than sections
+        transform - Transform of raw accumulated by move, rotate and
+        tilt, applied only to the sections read (None - no transform)
+        data - transformed raw
+        profiles[i] is a (2, n) array of section i (a view of raw without
+        a transform), so code written for lists of np.vstack((x, y))
+        arrays works on it unchanged.
+        A read only buffer (shared by cached templates) is copied
+        before the first modification.
+    '''
+    # distance between sections, mm (section i is at z = i * step)
+    step = 0.1
+
+    def __init__(self, data, offsets, shm=None):
+        self.raw = data
+        self.offsets = offsets
+        self.shm = shm
+        self.transform = None
+        # changes on every modification made through the methods
+        self.version = 0
+        # transformed raw of a version, see data
+        self._transformed = (None, None)
+
+    @classmethod
+    def from_list(cls, sections):
+        sizes = [np.shape(sec)[1] if np.size(sec) else 0 for sec in sections]
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        data = np.empty((2, offsets[-1]))
+        for i, sec in enumerate(sections):
+            if sizes[i]:
+                data[:, offsets[i]:offsets[i+1]] = sec
+        return cls(data, offsets)
+
+    @classmethod
+    def attach(cls, descriptor):
+        '''
+            PackedProfiles from share(): a view of the shared memory
+            block, nothing is copied
+        '''
+        if isinstance(descriptor, PackedProfiles):
+            return descriptor
+        name, sections, points = descriptor
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name)
+        offsets = np.ndarray((sections + 1,), dtype=np.int64, buffer=shm.buf)
+        data = np.ndarray((2, points), dtype=np.float64, buffer=shm.buf,
+                          offset=offsets.nbytes)
+        return cls(data, offsets, shm)
+
+    def __getitem__(self, i):
+        if self.transform is None:
+            return self.raw[:, self.offsets[i]:self.offsets[i+1]]
+        version, data = self._transformed
+        if version == self.version:
+            return data[:, self.offsets[i]:self.offsets[i+1]]
+        return self.transform.apply(
+            self.raw[:, self.offsets[i]:self.offsets[i+1]], i * self.step)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __setitem__(self, i, sec):
+        self.apply()
+        start, end = self.offsets[i], self.offsets[i+1]
+        size = np.shape(sec)[1] if np.size(sec) else 0
+        if size == end - start:
+            self._writeable()
+            self.raw[:, start:end] = sec
+        else:
+            self.raw = np.hstack((self.raw[:, :start],
+                                  np.reshape(sec, (2, size)),
+                                  self.raw[:, end:]))
+            self.offsets = self.offsets.copy()
+            self.offsets[i+1:] += size - (end - start)
+        self.version += 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = None
+        state['_transformed'] = (None, None)
+        return state
+
+    @property
+    def data(self):
+        '''
+            All sections transformed, calculated once for a version.
+            Read only with a transform: changes have to go to raw.
+        '''
+        if self.transform is None:
+            return self.raw
+        version, data = self._transformed
+        if version != self.version:
+            data = self.transform.apply(self.raw,
+                                        self.section_ids() * self.step)
+            data.flags.writeable = False
+            self._transformed = (self.version, data)
+        return data
+
+    def apply(self):
+        '''make the transform a part of raw'''
+        if self.transform is not None:
+            self.raw = np.array(self.data)
+            self.transform = None
+            self._transformed = (None, None)
+            self.version += 1
+
+    def close(self):
+        '''detach from the shared memory block'''
+        if self.shm is not None:
+            self.raw = self.offsets = None
+            self.shm.close()
+            self.shm = None
+
+    def _writeable(self):
+        if not self.raw.flags.writeable:
+            self.raw = self.raw.copy()
+            self.offsets = self.offsets.copy()
+
+    def _transformed_by(self, transform):
+        self.transform = transform
+        self.version += 1
+
+    def copy(self):
+        copied = PackedProfiles(self.raw.copy(), self.offsets.copy())
+        copied.transform = self.transform
+        return copied
+
+    def move(self, axis, val):
+        transform = self.transform or Transform()
+        self._transformed_by(transform.moved(*((val, 0.) if axis == 'X'
+                                               else (0., val))))
+
+    def reset(self):
+        '''drop the transform: back to raw'''
+        if self.transform is not None:
+            self._transformed_by(None)
+
+    def rotate(self, angle, center=(0., 0.)):
+        transform = self.transform or Transform()
+        self._transformed_by(transform.rotated(angle, center))
+
+    def read_only(self):
+        '''protect the buffer, see _writeable'''
+        self.raw.flags.writeable = False
+        self.offsets.flags.writeable = False
+        return self
+
+    def section_ids(self):
+        '''number of the section of every point in data'''
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def share(self):
+        '''
+            Copy to a shared memory block. Returns the shared copy,
+            which has to be unlinked by the caller, and the descriptor
+            to attach to it in other processes.
+            Without shared memory support the copy is sent as it is.
+        '''
+        if shared_memory is None:
+            return self, self
+        data = self.data
+        points = data.shape[1]
+        shm = shared_memory.SharedMemory(
+            create=True, size=max(self.offsets.nbytes + data.nbytes, 1))
+        shared = PackedProfiles(
+            np.ndarray((2, points), dtype=np.float64, buffer=shm.buf,
+                       offset=self.offsets.nbytes),
+            np.ndarray(self.offsets.shape, dtype=np.int64, buffer=shm.buf),
+            shm)
+        shared.offsets[:] = self.offsets
+        shared.raw[:] = data
+        return shared, (shm.name, len(self), points)
+
+    def shift(self, dx, dy):
+        '''
+            Move the sections, dx and dy are numbers
+            or arrays with a value for every section
+            (changes raw, see apply)
+        '''
+        if not (np.ndim(dx) or np.ndim(dy)):
+            self.move('X', dx)
+            self.move('Y', dy)
+            return
+        self.apply()
+        sizes = np.diff(self.offsets)
+        self._writeable()
+        self.raw[0] += np.repeat(dx, sizes) if np.ndim(dx) else dx
+        self.raw[1] += np.repeat(dy, sizes) if np.ndim(dy) else dy
+        self.version += 1
+
+    def tilt(self, axis, angle):
+        '''
+            Tilt around A or B by angle degrees: the sections are
+            moved along Y or X in proportion to their position
+        '''
+        transform = self.transform or Transform()
+        self._transformed_by(transform.tilted(axis.upper(), angle))
+
+    def unlink(self):
+        '''free the shared memory block made by share()'''
+        if self.shm is not None:
+            shm = self.shm
+            self.close()
+            shm.unlink()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+'''
+    Access to the PLC variables over one ADS connection.
+    Symbol handles are resolved once and kept while the connection
+    is open, a set of variables is written with one ADS sum command.
+    The server and the interface share one PlcConnection (get_connection).
+'''
+import ctypes
+import threading
+import time
+from sys import argv
+
+from textron.logging_module import write_to_log
+from textron.plcdebug import PLCDEBUG, fakeADS
+
+print = write_to_log
+
+try:
+    import pyads
+except ImportError:
+    pyads = fakeADS
+
+PLC_ADDRESS = ('5.41.213.16.1.1', 851)
+
+# connection shared by the server threads and the sessions
+_connection = None
+_connection_lock = threading.Lock()
+
+
+class PlcIO(object):
+    '''
+        Wrapper of an opened pyads.Connection (or PLCDEBUG) with the same
+        read_by_name, write_by_name and close, plus write_list.
+        handles - symbol handles by name, released by close
+        notifications - handles of the device notifications
+    '''
+    def __init__(self, plc):
+        self.plc = plc
+        self.handles = {}
+        self.notifications = []
+
+    def handle(self, name):
+        '''handle of the symbol, None if the connection has no handles'''
+        if not hasattr(self.plc, 'get_handle'):
+            return None
+        handle = self.handles.get(name)
+        if handle is None:
+            handle = self.handles[name] = self.plc.get_handle(name)
+        return handle
+
+    def read_by_name(self, name, plc_type):
+        return self.plc.read_by_name(name, plc_type, handle=self.handle(name))
+
+    def write_by_name(self, name, value, plc_type):
+        self.plc.write_by_name(name, value, plc_type,
+                               handle=self.handle(name))
+
+    def write_list(self, values):
+        '''
+            values - [(name, value, plc type), ...]
+            Written with one ADS sum write if the connection supports it
+            (pyads >= 3.3), otherwise one by one by the handles.
+            Returns the names not written.
+        '''
+        if hasattr(self.plc, 'write_list_by_name'):
+            errors = self.plc.write_list_by_name(
+                {name: value for name, value, _ in values})
+            failed = [name for name, error in errors.items()
+                      if error != 'no error']
+            if failed:
+                print('PLC write errors: %s' %
+                      {name: errors[name] for name in failed})
+            return failed
+        for name, value, plc_type in values:
+            self.write_by_name(name, value, plc_type)
+        return []
+
+    def subscribe(self, name, plc_type, callback):
+        '''
+            callback(name, value) on every change of the variable
+            (ADS device notification, it is called in the ADS thread)
+        '''
+        if isinstance(self.plc, PLCDEBUG):
+            handles = self.plc.add_device_notification(name, None, callback)
+        else:
+            @self.plc.notification(plc_type)
+            def changed(handle, notification_name, timestamp, value):
+                callback(name, value)
+            handles = self.plc.add_device_notification(
+                name, pyads.NotificationAttrib(ctypes.sizeof(plc_type)),
+                changed)
+        self.notifications.append(handles)
+
+    def release(self):
+        '''release the symbol handles and the notifications'''
+        notifications, self.notifications = self.notifications, []
+        for handles in notifications:
+            try:
+                self.plc.del_device_notification(*handles)
+            except Exception as e:
+                print('PLC notification was not deleted: %s' % e)
+        handles, self.handles = self.handles, {}
+        for handle in handles.values():
+            try:
+                self.plc.release_handle(handle)
+            except Exception as e:
+                print('PLC handle was not released: %s' % e)
+
+    def close(self):
+        self.release()
+        self.plc.close()
+
+
+class PlcConnection(object):
+    '''
+        One long lived PLC connection shared by the server threads and
+        the interface callbacks. Every operation holds the lock (hold
+        it with "with plc.lock:" for a sequence of operations). A failed
+        operation drops the connection, the next one connects again, but
+        not before the backoff time, which doubles with every failed
+        attempt up to max_backoff seconds.
+        Subscriptions to notifications are made again on every opening.
+        simulator - PLCDEBUG instead of ADS
+    '''
+    def __init__(self, address=PLC_ADDRESS, simulator=False, backoff=1.,
+                 max_backoff=30.):
+        self.address = address
+        self.simulator = simulator
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.RLock()
+        self.io = None
+        self.failures = 0
+        self.last_error = None
+        self.connected_since = None
+        self.subscriptions = []
+        self._next_attempt = 0.
+
+    def connect(self):
+        '''True if the connection is open or has been opened now'''
+        with self.lock:
+            try:
+                self._open()
+                return True
+            except Exception as e:
+                print('No ADS connection: %s' % e)
+                return False
+
+    def _open(self):
+        if self.io is not None:
+            return self.io
+        if time.time() < self._next_attempt:
+            raise ConnectionError('next attempt to connect in %.1f s' %
+                                  (self._next_attempt - time.time()))
+        try:
+            if self.simulator:
+                plc = PLCDEBUG()
+            else:
+                plc = pyads.Connection(*self.address)
+                plc.open()
+        except Exception as e:
+            self._failed(e)
+            raise
+        self.io = PlcIO(plc)
+        self.failures = 0
+        self.connected_since = time.time()
+        print('PLC connection opened')
+        for subscription in self.subscriptions:
+            if not self._subscribe(*subscription):
+                raise ConnectionError('notifications are not subscribed: %s'
+                                      % self.last_error)
+        return self.io
+
+    def _subscribe(self, name, plc_type, callback):
+        try:
+            self.io.subscribe(name, plc_type, callback)
+            return True
+        except Exception as e:
+            self._failed(e)
+            return False
+
+    def _failed(self, error):
+        self.failures += 1
+        self.last_error = str(error)
+        self._next_attempt = time.time() + min(
+            self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+        if self.io is not None:
+            io, self.io = self.io, None
+            self.connected_since = None
+            try:
+                io.close()
+            except Exception:
+                pass
+            print('PLC connection dropped: %s' % error)
+
+    def _call(self, method, *args):
+        with self.lock:
+            io = self._open()
+            try:
+                return getattr(io, method)(*args)
+            except Exception as e:
+                self._failed(e)
+                raise
+
+    def read_by_name(self, name, plc_type):
+        return self._call('read_by_name', name, plc_type)
+
+    def write_by_name(self, name, value, plc_type):
+        return self._call('write_by_name', name, value, plc_type)
+
+    def write_list(self, values):
+        return self._call('write_list', values)
+
+    def subscribe(self, name, plc_type, callback):
+        '''
+            callback(name, value) on every change of the variable,
+            see PlcIO.subscribe; kept while the connection is reopened
+        '''
+        with self.lock:
+            self.subscriptions.append((name, plc_type, callback))
+            if self.io is not None:
+                self._subscribe(name, plc_type, callback)
+
+    def notify(self, name, value):
+        '''fire a synthetic notification (simulator only)'''
+        with self.lock:
+            io = self._open()
+        if not isinstance(io.plc, PLCDEBUG):
+            raise TypeError('notifications are simulated only by PLCDEBUG')
+        io.plc.notify(name, value)
+
+    def health(self):
+        '''
+            state of the connection for the interface and the log,
+            read without the lock, so it does not wait for the I/O
+        '''
+        return {'connected': self.io is not None,
+                'simulator': self.simulator,
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'connected_since': self.connected_since}
+
+    def close(self):
+        '''the connection is shared and stays open, see shutdown'''
+        pass
+
+    def shutdown(self):
+        with self.lock:
+            if self.io is not None:
+                io, self.io = self.io, None
+                self.connected_since = None
+                io.close()
+
+
+def stock_results(stock_conv_mean, stock_conc_mean, C2):
+    '''
+        (name, value, type) of the mean stock of the areas
+        ({area: stock}, the convex areas are sent in pairs swapped)
+        and of C2 of the control sections
+    '''
+    results = []
+    for area, value in zip(range(1, 7), (2, 1, 4, 3, 6, 5)):
+        results.append(('GVL_MeasuringUnit.rConvexSurfaceResults[%d]' % area,
+                        float(stock_conv_mean[value]), pyads.PLCTYPE_REAL))
+    for area in range(1, 7):
+        results.append(('GVL_MeasuringUnit.rConcaveSurfaceResults[%d]' % area,
+                        float(stock_conc_mean[area]), pyads.PLCTYPE_REAL))
+    for i in range(1, 5):
+        results.append(('GVL_MeasuringUnit.arrProfileMeasurements[%d].C2' % i,
+                        float(C2[i - 1]), pyads.PLCTYPE_REAL))
+    return results
+
+
+def offset_results(x, y):
+    '''(name, value, type) of the X/Y path offsets in 0.01 mm'''
+    results = []
+    for axis, shift in (('X', x), ('Y', y)):
+        if shift >= 0:
+            plus, minus = int(shift * 100), 0
+        else:
+            plus, minus = 0, int(-shift * 100)
+        results += [
+            ('GVL_MeasuringUnit.O_bytePath%s_offsetPlus' % axis, plus,
+             pyads.PLCTYPE_BYTE),
+            ('GVL_MeasuringUnit.O_bytePath%s_offsetMinus' % axis, minus,
+             pyads.PLCTYPE_BYTE)]
+    return results
+
+
+def get_connection():
+    '''the shared connection, opened on first use'''
+    return start_connection()
+
+
+def start_connection(simulator=None):
+    '''
+        simulator - PLCDEBUG instead of ADS,
+        by default if the server runs with -s/--simulator
+    '''
+    global _connection
+    with _connection_lock:
+        if _connection is None:
+            if simulator is None:
+                simulator = '-s' in argv or '--simulator' in argv
+            _connection = PlcConnection(simulator=simulator)
+        return _connection
+
+
+def stop_connection():
+    global _connection
+    with _connection_lock:
+        if _connection is not None:
+            _connection.shutdown()
+            _connection = None
@@ -1,20 +1,57 @@
+from textron.logging_module import write_to_log
+
+print = write_to_log
+
+
 class PLCDEBUG(object):
     '''
     class for debugiing
+    writes - (name, value) of every written variable
+    batches - {name: value} of every sum write
+    notifications - callbacks by name, fired by notify
     '''
     def __init__(self):
-        pass
+        self.handles = {}
+        self.writes = []
+        self.batches = []
+        self.notifications = {}
 
     def close(self):
         pass
 
-    def read_by_name(self, where, type):
+    def add_device_notification(self, where, attr, callback):
+        self.notifications.setdefault(where, []).append(callback)
+        return where, callback
+
+    def del_device_notification(self, where, callback):
+        self.notifications[where].remove(callback)
+
+    def notify(self, where, value):
+        '''fire a synthetic notification: callback(where, value)'''
+        print('simulating notification ', where, value)
+        for callback in list(self.notifications.get(where, [])):
+            callback(where, value)
+
+    def get_handle(self, where):
+        return self.handles.setdefault(where, len(self.handles) + 1)
+
+    def release_handle(self, handle):
+        pass
+
+    def read_by_name(self, where, type, handle=None):
         print('simulating reading ', where)
         return -1
 
-    def write_by_name(self, where, what, type):
+    def write_by_name(self, where, what, type, handle=None):
+        self.writes.append((where, what))
         print('simulating writing ', where, '... done')
 
+    def write_list_by_name(self, data):
+        self.batches.append(dict(data))
+        self.writes.extend(data.items())
+        print('simulating writing of %d variables in one request' % len(data))
+        return {where: 'no error' for where in data}
+
 class fakeADS(object):
     def __init__(self):
         print('Using fakeADS!')
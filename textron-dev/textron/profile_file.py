@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+'''
+    Reader of the RFC-20 scanner .profile files
+'''
+import numpy as np
+import pandas as pd
+
+
+class ProfileFile(object):
+    '''
+        Scanner .profile file. It starts with 7 header lines:
+            1 - ScanProgram:<scanner program number>
+            3 - <AreaToMeasure>;...
+        followed by one line per section:
+            <section>;<...>;<heights in 1e-5 mm, 0.1 mm apart>
+        matrix - heights of all sections (rows) without the first
+        two columns, x - positions of the matrix columns
+    '''
+    header_lines = 7
+    step = 0.1
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.header = [f.readline().decode('utf-8', 'replace')
+                           .rstrip('\r\n') for i in range(self.header_lines)]
+            data = pd.read_csv(f, sep=';', header=None, dtype=float,
+                               engine='c')
+        self.matrix = data.to_numpy()[:, 2:]
+
+    @property
+    def area_to_measure(self):
+        return int(self.header[2].split(';')[0])
+
+    @property
+    def scanner_program(self):
+        line = self.header[0]
+        return line[line.index(':') + 1:]
+
+    @property
+    def x(self):
+        return np.arange(self.matrix.shape[1]) * self.step
+
+    def side(self, side):
+        '''
+            Columns of the side (convex - first half, concave - second),
+            scanner program 2 measures both sides in one half
+        '''
+        if self.scanner_program == '2':
+            return slice(None)
+        middle = int(np.round(self.matrix.shape[1] / 2))
+        if side == 'convex':
+            return slice(None, middle)
+        return slice(middle, None)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+'''
+    Index of the profile files of a directory and events of new ones.
+
+    The directory is not listed and its files are not stat'ed again
+    while it has not changed: native change notifications (watchdog)
+    are used if it is installed, otherwise the modification time of
+    the directory is checked. Without the notifications a file rewritten
+    in place does not change the directory, so the newest files are
+    stat'ed again instead (a rewritten older file is seen at the next
+    change of the directory).
+'''
+import bisect
+import os
+import threading
+import time
+
+from textron.logging_module import write_to_log
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+print = write_to_log
+
+# watchers by directory, see get_watcher
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+class ProfileWatcher(object):
+    '''
+        Files of path sorted by modification time, updated incrementally.
+        After start, a new file ending with suffix is passed to the
+        listeners once its size and modification time have not changed
+        for debounce seconds, so a file being written is not taken.
+        order - sorted (mtime, name) of the files
+        pending - (size, mtime, time of the last change) of new files
+        restat - newest files stat'ed again without change notifications
+    '''
+    def __init__(self, path, suffix='.profile', debounce=0.5, interval=0.25,
+                 restat=8):
+        self.path = path
+        self.restat = restat
+        self.suffix = suffix
+        self.debounce = debounce
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.mtimes = {}
+        self.order = []
+        self.pending = {}
+        self.listeners = []
+        self.dir_mtime = None
+        self._changed = True
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._observer = None
+        try:
+            # files already there are not new
+            self.refresh(report=False)
+        except OSError as e:
+            print('profiles directory is not available: %s' % e)
+
+    def _add(self, name, mtime):
+        old = self.mtimes.get(name)
+        if old is not None:
+            self.order.remove((old, name))
+        self.mtimes[name] = mtime
+        bisect.insort(self.order, (mtime, name))
+
+    def _remove(self, name):
+        self.order.remove((self.mtimes.pop(name), name))
+        self.pending.pop(name, None)
+
+    def refresh(self, report=True):
+        '''
+            Update the index if the directory has changed. New files
+            are pending until they are complete (see check_pending), the
+            files known already are stat'ed again for their new
+            modification time. Without change notifications the newest
+            files are stat'ed again anyway (see restat_newest).
+            Returns True if the directory was listed.
+        '''
+        with self.lock:
+            if self._observer is not None and not self._changed:
+                return False
+            dir_mtime = os.stat(self.path).st_mtime_ns
+            if dir_mtime == self.dir_mtime and not self._changed:
+                self.restat_newest()
+                if not self._changed:
+                    return False
+            self._changed = False
+            # files found by the first listing are not new
+            report = report and self.dir_mtime is not None
+            self.dir_mtime = dir_mtime
+            names = set()
+            now = time.time()
+            for entry in os.scandir(self.path):
+                if not entry.is_file():
+                    continue
+                names.add(entry.name)
+                st = entry.stat()
+                if entry.name in self.mtimes:
+                    # rewritten in place
+                    if st.st_mtime != self.mtimes[entry.name]:
+                        self._add(entry.name, st.st_mtime)
+                    continue
+                self._add(entry.name, st.st_mtime)
+                if report and entry.name.endswith(self.suffix):
+                    self.pending[entry.name] = (st.st_size, st.st_mtime, now)
+            for name in set(self.mtimes) - names:
+                self._remove(name)
+            return True
+
+    def restat_newest(self):
+        '''
+            new modification time of the newest files rewritten in place,
+            which does not change the directory
+        '''
+        with self.lock:
+            for _, name in self.order[-self.restat:]:
+                try:
+                    mtime = os.stat(os.path.join(self.path, name)).st_mtime
+                except OSError:
+                    # removed, the directory has changed
+                    self._changed = True
+                    continue
+                if mtime != self.mtimes[name]:
+                    self._add(name, mtime)
+
+    def check_pending(self):
+        '''report the new files, which have not changed for debounce s'''
+        complete = []
+        with self.lock:
+            now = time.time()
+            for name, (size, mtime, since) in list(self.pending.items()):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    # renamed or deleted meanwhile
+                    self._remove(name)
+                    continue
+                if (st.st_size, st.st_mtime) != (size, mtime):
+                    self._add(name, st.st_mtime)
+                    self.pending[name] = (st.st_size, st.st_mtime, now)
+                elif now - since >= self.debounce:
+                    del self.pending[name]
+                    complete.append(os.path.join(self.path, name))
+            listeners = list(self.listeners)
+        for filename in complete:
+            for listener in listeners:
+                listener(filename)
+
+    def files(self):
+        '''names of the files, newest first'''
+        self.refresh()
+        with self.lock:
+            return [name for _, name in reversed(self.order)]
+
+    def newest(self):
+        '''path of the newest file, None if there are no files'''
+        self.refresh()
+        with self.lock:
+            if not self.order:
+                return None
+            return os.path.join(self.path, self.order[-1][1])
+
+    def start(self, listener=None):
+        '''
+            Watch the directory in a thread,
+            listener(path) is called for every new complete file
+        '''
+        with self.lock:
+            if listener is not None:
+                self.listeners.append(listener)
+            if self._thread is not None:
+                return self
+            if Observer is not None:
+                self._start_observer()
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+        return self
+
+    def _start_observer(self):
+        watcher = self
+
+        class Changed(FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher._changed = True
+                watcher._wake.set()
+
+        try:
+            observer = Observer()
+            observer.schedule(Changed(), self.path, recursive=False)
+            observer.start()
+            self._observer = observer
+            print('watching %s by change notifications' % self.path)
+        except (OSError, RuntimeError) as e:
+            print('change notifications are not available: %s' % e)
+
+    def _watch(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+                self.check_pending()
+            except OSError:
+                # the directory may be mounted later
+                pass
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def get_watcher(path):
+    '''the watcher of the directory, made on first use'''
+    path = os.path.abspath(path)
+    with _watchers_lock:
+        watcher = _watchers.get(path)
+        if watcher is None:
+            watcher = _watchers[path] = ProfileWatcher(path)
+        return watcher
+
+
+def stop_watchers():
+    with _watchers_lock:
+        watchers = list(_watchers.values())
+        _watchers.clear()
+    for watcher in watchers:
+        watcher.stop()
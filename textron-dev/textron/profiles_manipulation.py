@@ -8,35 +8,52 @@ v0_4_b
 import pandas as pd
 import numpy as np
 
+import copy
 import os
 import shutil
-# import copy
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from multiprocessing import Pool
+from functools import partial
 from scipy.interpolate import interp1d
+try:
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:  # numpy < 1.20
+    sliding_window_view = None
 from sys import argv
 
 import textron.configparse as configparse
+import textron.metrics as metrics
+import textron.profile_watcher as profile_watcher
+import textron.template_cache as template_cache
+import textron.workers as workers
 
+from textron.bestfit import best_fit
 from textron.calculate_stock import Stock, Stock_areas, Stock_special_areas
 from textron.calculate_stock import closest_node
 from textron.logging_module import write_to_log
+from textron.packed_profiles import PackedProfiles
+from textron.profile_file import ProfileFile
 
 # if (not '--verbose' in argv) and (not '-v' in argv):
 #     print = write_to_log
 print = write_to_log
 
+# parsed templates by path, see template_profile
+_templates = {}
+_templates_lock = threading.Lock()
+
 
 class profile(object):
     '''
     Класс для сырых данных, загруженных из файла .profile
+    filename - path or ProfileFile, so both sides of a part
+    are made from one reading of the file
     '''
+    @metrics.timed('profile')
     def __init__(self, filename, template=False, side='convex',
-                 sections='control', filter=True):
-        #check if it is profile of the blade
-        ScanProgNum = get_scanner_program_number(filename)
-        #print('Scanner program No. {}'.format(ScanProgNum))
+                 sections='control', filter=True, settings=None):
         if template:
             if 'cave' in filename:
                 side = 'concave'
@@ -46,26 +63,25 @@ class profile(object):
         elif sections == 'special':
             sections = np.arange(1,39,1)
         else:
-            sections = np.array(get_control_sections())
+            sections = np.array(get_control_sections(settings))
 
         if not template:
-            df = pd.read_csv(os.path.join(filename), sep=';',
-                             skiprows=7, dtype=float,
-                             header=None,  engine='python')
-            df = df.drop([0, 1], axis=1)
-            df.columns = np.arange(0, df.columns.size / 10, 0.1)
-            middle = int(np.round(df.columns.size / 2))
-            if ScanProgNum == '2':
+            scan = profile_file_data(filename)
+            #print('Scanner program No. {}'.format(scan.scanner_program))
+            if scan.scanner_program == '2':
                 sections = np.arange(1,40,1)
-            else:
-                if side == 'convex':
-                    df = df.iloc[:, :middle]
-                else:
-                    df = df.iloc[:, middle:]
+            columns = scan.side(side)
+            df = pd.DataFrame(scan.matrix[:, columns],
+                              columns=scan.x[columns])
             df = df.where(df > 0)  # .dropna(axis = 1, how = 'all')
             if filter:
                 # print('filtering...')
-                df = noise_filter(df, window=5, mul=1.5)
+                if settings is None:
+                    settings = configparse.get_settings('settings.ini')
+                df = noise_filter(df, window=5, mul=1.5,
+                                  kernel=settings.get('Processing',
+                                                      'noise_filter_kernel',
+                                                      'window'))
             profiles = extract_profiles(df, sections)
             self.profiles = profiles
             self.sections = sections
@@ -73,52 +89,36 @@ class profile(object):
                 self.rotate(180)
         # part for template
         else:
-            df = pd.read_csv(
-                             filename, sep=';',
-                             skiprows=1,
-                             skip_blank_lines=True)
-            startindex = df['#'][0]
+            rows, startindex = template_cache.load_template(filename)
             self.startindex = startindex
-            df = df.drop(['#'], axis=1)
-            for i in range(int(startindex*10)):
-                sections = np.insert(sections, 0, 0)
-            profiles = []
-            df = df.iloc[2:]
-            for i, sec in enumerate(sections):
-                XY = df.iloc[int(sec)].dropna(axis=0, how='all')
-                xs = XY.index.values
-                for k, p in enumerate(xs):
-                    xs[k] = np.float(p[:4])
-                stack = np.vstack((xs, -XY.values))
-                profiles.append(stack)
+            sections = np.concatenate((
+                np.zeros(int(startindex*10), dtype=sections.dtype), sections))
+            profiles = PackedProfiles.from_list(
+                [rows[int(sec)] for sec in sections])
         self.profiles = profiles
         self.sections = sections
 
     def move(self, axis, val):
-        if axis == "X":
-            for i, s in enumerate(self.profiles):
-                self.profiles[i][0] += val
-        elif axis == 'Y':
-            for i, s in enumerate(self.profiles):
-                self.profiles[i][1] += val
-
-    def rotate(self, angle):
-        angle = np.radians(angle)
-        V = np.array([])
-        c = np.cos(angle)
-        s = np.sin(angle)
-        M = np.array([[c, -s],
-                      [s, c],
-                      [0, 0]])
-        for i, _ in enumerate(self.sections):
-            V = np.dot(M, np.vstack((self.profiles[i][0],
-                       self.profiles[i][1])))
-            self.profiles[i][0] = V[0]
-            self.profiles[i][1] = V[1]
+        if axis in ('X', 'Y'):
+            self.profiles.move(axis, val)
+
+    def reset(self):
+        self.profiles.reset()
+
+    def rotate(self, angle, center=(0., 0.)):
+        self.profiles.rotate(angle, center)
+
+    def tilt(self, axis, angle):
+        self.profiles.tilt(axis, angle)
 
 
 class Airfoil(object):
+    @metrics.timed('Airfoil')
     def __init__(self, **kwargs):
+        # one settings snapshot for the whole calculation
+        if kwargs.get('settings') is None:
+            kwargs['settings'] = configparse.get_settings()
+        settings = self.settings = kwargs['settings']
         if 'calibration_arrays_file' in kwargs:
             calibration_arrays_filename = kwargs['calibration_arrays_file']
         else:
@@ -146,29 +146,35 @@ class Airfoil(object):
             else:
                 profile_file = kwargs['profile_file']
                 path = os.path.dirname(profile_file)
-            template_convex_name = r'TemplateConvex.csv'
-            template_concave_name = r'TemplateConcave.csv'
+            template_convex_name = kwargs.get('template_convex',
+                                              r'TemplateConvex.csv')
+            template_concave_name = kwargs.get('template_concave',
+                                               r'TemplateConcave.csv')
         if 'filt' in kwargs:
             print('found filter in kwargs')
             filt = kwargs['filt']
         else:
             filt = True
         ''' main part '''
+        # the file is read once for both sides and the header
+        scan = profile_file_data(profile_file)
+        metrics.annotate(file=scan.filename)
         if 'special_sections' in kwargs:
-            if 'special_sections':
-                convmes = profile(profile_file, side='convex',
-                                  sections='special', filter=filt)
-                concmes = profile(profile_file, side='concave',
-                                  sections='special', filter=filt)
+            sections = 'special'
         else:
-            convmes = profile(profile_file, side='convex',
-                              sections='all', filter=filt)
-            concmes = profile(profile_file, side='concave',
-                              sections='all', filter=filt)
-        conctempl = profile(template_concave_name, side='concave',
-                            template=True, sections='all')
-        convtempl = profile(template_convex_name, side='convex',
-                            template=True, sections='all')
+            sections = 'all'
+        sides = [partial(profile, scan, side=side, sections=sections,
+                         filter=filt, settings=settings)
+                 for side in ('convex', 'concave')]
+        if settings.getbool('Processing', 'parallel_sides'):
+            # filtering of a side is numpy code, which releases the GIL
+            with ThreadPoolExecutor(2) as executor:
+                convmes, concmes = executor.map(
+                    metrics.bind(lambda side: side()), sides)
+        else:
+            convmes, concmes = (side() for side in sides)
+        conctempl = template_profile(template_concave_name, side='concave')
+        convtempl = template_profile(template_convex_name, side='convex')
 
         concmes.rotate(kwargs['additional_calibration']['cc_tilt_c'])
         convmes.rotate(kwargs['additional_calibration']['cv_tilt_c'])
@@ -186,189 +192,66 @@ class Airfoil(object):
         cv_shift_y += kwargs['additional_calibration']['cv_shift_y']
         cc_shift_y += kwargs['additional_calibration']['cc_shift_y']
 
-        areaToMeasure = get_area_to_measure(profile_file)
-        for s in range(0, len(concmes.profiles)):
-            concmes.profiles[s][0] += cc_shift_x[s]
-            convmes.profiles[s][0] += cv_shift_x[s]  # -0.03
-            concmes.profiles[s][1] += cc_shift_y[s]
-            convmes.profiles[s][1] += cv_shift_y[s]  # -0.14
-            # filter y values on convex
-            if filt and (areaToMeasure == 1 or areaToMeasure == 2):
-                convmes.profiles[s][1][convmes.profiles[s][1] > 3] = np.nan
+        areaToMeasure = scan.area_to_measure
+        n = len(concmes.profiles)
+        concmes.profiles.shift(cc_shift_x[:n], cc_shift_y[:n])
+        convmes.profiles.shift(cv_shift_x[:n], cv_shift_y[:n])  # -0.03, -0.14
+        # calibrated profiles are the raw data, shifts and rotations
+        # of the interface are transforms of it (see reset)
+        concmes.profiles.apply()
+        convmes.profiles.apply()
+        # filter y values on convex
+        if filt and (areaToMeasure == 1 or areaToMeasure == 2):
+            y = convmes.profiles.raw[1]
+            y[y > 3] = np.nan
         self.convmes, self.convtempl = convmes, convtempl
         self.concmes, self.conctempl = concmes, conctempl
-        self.controlSectionsList = get_control_sections()
-        self.profile_file = profile_file
+        self.controlSectionsList = get_control_sections(settings)
+        self.templatesKey = workers.templates_key(template_convex_name,
+                                                  template_concave_name)
+        self.profile_file = scan.filename
+        self.profile_data = scan
         self.profile_dir = path
 
     def _stock_calc_areas_sc(self, rng):
         self.stockConv = Stock_areas(
-            self.convmes, self.convtempl, rng, 'convex')
+            self.convmes, self.convtempl, rng, 'convex', self.settings)
         self.stockConc = Stock_areas(
-            self.concmes, self.conctempl, rng, 'concave')
+            self.concmes, self.conctempl, rng, 'concave', self.settings)
         return self.stockConv, self.stockConc
 
     def _stock_calc_control_sc(self):
         self.stockConvControl = Stock(
             self.convmes, self.convtempl,
-            self.controlSectionsList, 'convex')
+            self.controlSectionsList, 'convex', self.settings)
         self.stockConcControl = Stock(
             self.concmes, self.conctempl,
-            self.controlSectionsList, 'concave')
+            self.controlSectionsList, 'concave', self.settings)
         return self.stockConvControl, self.stockConcControl
 
+    def control_snapshot(self):
+        '''
+            convmes, convtempl, concmes, conctempl for the best fit:
+            copies of the control sections of the measured profiles
+            (the part can be moved meanwhile) and the templates,
+            which are not changed in place
+        '''
+        sections = self.controlSectionsList
+        return (frozen_profile(self.convmes, sections), self.convtempl,
+                frozen_profile(self.concmes, sections), self.conctempl)
+
     def autoshift(self):
-        convmes, convtempl = self.convmes, self.convtempl
-        concmes, conctempl = self.concmes, self.conctempl
-        deltas = np.full((4, 2), np.nan)
-        # for num,i in enumerate([121,221,321,341]):
-        for num, i in enumerate(self.controlSectionsList):
-            x_cv = convmes.profiles[i][0][convmes.profiles[i][1] < 4]
-            y_cv = convmes.profiles[i][1][convmes.profiles[i][1] < 4]
-            convmes.profiles[i] = np.vstack((x_cv, y_cv))
-            rng_start_cv, rng_end_cv = check_borders(
-                convmes.profiles[i][0], convtempl.profiles[i][0])
-            rng_start_cc, rng_end_cc = check_borders(
-                concmes.profiles[i][0][::-1], conctempl.profiles[i][0])
-            if rng_start_cv >= rng_start_cc:
-                rng_start = rng_start_cv
-            else:
-                rng_start = rng_start_cc
-            if rng_end_cv <= rng_end_cc:
-                rng_end = rng_end_cv
-            else:
-                rng_end = rng_end_cc
-            convmes.profiles[i] = cut_rng(convmes.profiles[i], rng_start,
-                                          rng_end)
-            convtempl.profiles[i] = cut_rng(convtempl.profiles[i], rng_start,
-                                            rng_end)
-            concmes.profiles[i] = cut_rng(concmes.profiles[i], rng_start,
-                                          rng_end)
-            conctempl.profiles[i] = cut_rng(conctempl.profiles[i], rng_start,
-                                            rng_end)
-            # import pdb; pdb.set_trace()
-            xs = convmes.profiles[i][0]
-            ys = convmes.profiles[i][1]
-            xs = np.append(xs, concmes.profiles[i][0])
-            ys = np.append(ys, concmes.profiles[i][1])
-            avg_x = np.mean(xs)
-            avg_y = np.mean(ys)
-            xs1 = convtempl.profiles[i][0]
-            ys1 = convtempl.profiles[i][1]
-            xs1 = np.append(xs1, conctempl.profiles[i][0])
-            ys1 = np.append(ys1, conctempl.profiles[i][1])
-            avg_x1 = np.mean(xs1)
-            avg_y1 = np.mean(ys1)
-            deltas[num, 0] = avg_x - avg_x1
-            deltas[num, 1] = avg_y1 - avg_y
-        deltas = deltas.T
-        x_shift = np.mean(deltas[0])-0.1
-        y_shift = np.mean(deltas[1])
-        y_shift += 0.06
-        if y_shift < 0:
-            y_shift *= 0.6
-
-        x_shift = check_shift(x_shift)
-        y_shift = check_shift(y_shift)
-
-        print('X shift: %f\nY shift: %f' % (x_shift, y_shift))
-        self.x_shift = x_shift
-        self.y_shift = y_shift
-        return x_shift, y_shift
+        self.x_shift, self.y_shift = centroids_shift(
+            *self.control_snapshot(), self.controlSectionsList)
+        return self.x_shift, self.y_shift
 
     def autoshift2(self):
-        # --------------
-        # for debugging usage
-        # --------------
-        # import matplotlib.pyplot as plt
-        # fig, axs = plt.subplots(2, 2)
-        # col = 0
-        # --------------
-        x_shift, y_shift = 0, 0
-        convmes, convtempl = self.convmes, self.convtempl
-        concmes, conctempl = self.concmes, self.conctempl
-        deltas = np.full((4, 2), np.nan)
-        for num, i in enumerate(self.controlSectionsList):
-            # --------------------------
-            # xs, ys - measurements
-            # xs1, ys1 - template
-            # --------------------------
-            xsConv, ysConv = convmes.profiles[i]
-            xsConc, ysConc = (ar[::-1] for ar in concmes.profiles[i])
-            xs1Conv, ys1Conv = convtempl.profiles[i]
-            xs1Conc, ys1Conc = conctempl.profiles[i]
-            stPointConv = xs1Conv[0]
-            endPoint = xs1Conc[-1]
-            xs1ConvCut = xs1Conv[(stPointConv <= xs1Conv) &
-                                 (xs1Conv <= endPoint)]
-            ys1ConvCut = ys1Conv[(stPointConv <= xs1Conv) &
-                                 (xs1Conv <= endPoint)]
-            xs1Conv, ys1Conv = xs1ConvCut, ys1ConvCut
-            ysConvFirstNotNan = np.where(~np.isnan(ysConv))[0][0]
-            # stPointConv = (stPointConv if stPointConv > ysConvFirstNotNan
-            #            else ysConvFirstNotNan)
-            xsConvItp, ysConvItp = interpolated(
-                                        xsConv[ysConvFirstNotNan:
-                                               minlen(xsConv, ysConv)-1],
-                                        ysConv[ysConvFirstNotNan:
-                                               minlen(xsConv, ysConv)-1],
-                                        stPointConv,
-                                        endPoint)
-            # stPointConc = comparator(xsConc[0], xs1Conc[0])
-            stPointConc = stPointConv
-            xs1ConcCut = xs1Conc[(stPointConc <= xs1Conc) &
-                                 (xs1Conc <= endPoint)]
-            ys1ConcCut = ys1Conc[(stPointConc <= xs1Conc) &
-                                 (xs1Conc <= endPoint)]
-            xs1Conc, ys1Conc = xs1ConcCut, ys1ConcCut
-            xsConcItp, ysConcItp = interpolated(
-                                        xsConc[:minlen(xsConc, ysConc)-1],
-                                        ysConc[:minlen(xsConc, ysConc)-1],
-                                        stPointConc,
-                                        endPoint)
-            if ysConvItp[0] < ysConcItp[0]:
-                xsConvItp = xsConvItp[2:]
-                ysConvItp = ysConvItp[2:]
-            xs1 = np.hstack((xs1Conv, xs1Conc)).astype(float)
-            ys1 = np.hstack((ys1Conv, ys1Conc)).astype(float)
-            xs = np.append(xsConvItp, xsConcItp)
-            ys = np.append(ysConvItp, ysConcItp)
-
-            centroid = np.array([np.mean(xs), np.mean(ys)])
-            centroid1 = np.array([np.mean(xs1), np.mean(ys1)])
-            deltas[num] = centroid1 - centroid
-            # -----------
-            # draw debug graphs
-            # -----------
-            # row = 0 if num < 2 else 1
-            # axs[row, col].plot(xsConvItp, ysConvItp, 'b-',
-            #                    xs1Conv, ys1Conv, 'g-',
-            #                    xsConcItp, ysConcItp, 'r-',
-            #                    xs1Conc, ys1Conc, 'y-')
-            # axs[row, col].grid()
-            # col = 1 if col == 0 else 0
-            # -----------
-        deltas = deltas.T
-        # plt.show()
-        extraStep = 0.01
-        extraShift = {'x': 0, 'y': 0}
-        for axis in ['x', 'y']:
-            extraPlus = self.extra_bestfit_shift(axis, extraStep)
-            extraMinus = self.extra_bestfit_shift(axis, -extraStep)
-            extraShift[axis] = (extraPlus if extraPlus >
-                                abs(extraMinus) else extraMinus)
-        x_shift = np.mean(deltas[0]) + extraShift['x']
-        y_shift = np.mean(deltas[1]) + extraShift['y']
-        x_shift = check_shift(x_shift)
-        y_shift = check_shift(y_shift)
-        # print('X shift: %f\nY shift: %f' %(x_shift, y_shift))
-        print('total shift x: %f, extrashift: %f' % (x_shift, extraShift['x']))
-        print('total shift y: %f, extrashift: %f' % (y_shift, extraShift['y']))
-        # print('total shift y: %f' %y_shift)
-        self.x_shift = x_shift
-        self.y_shift = y_shift
-        return x_shift, y_shift
+        self.x_shift, self.y_shift, self.bestfit = bestfit_shift(
+            *self.control_snapshot(), self.controlSectionsList, self.settings)
+        self.c_shift = self.bestfit.c
+        return self.x_shift, self.y_shift
 
+    @metrics.timed('c2')
     def c2(self, **kwargs):
         """ Check the c2 parameter accoding to its theoretical
             profiles_manipulation
@@ -442,35 +325,6 @@ class Airfoil(object):
                     ) / len(self.controlSectionsList)
         return avgStock
 
-    def extra_bestfit_shift(self, axis, step):
-        # -------------
-        # additional tune bestfit
-        # -------------
-        avgStock = self.control_sections_stock_avg()
-        # print('starting avgStock %f' %avgStock)
-        shift = 0
-        if axis == 'x':
-            axis = 0
-        elif axis == 'y':
-            axis = 1
-        while True:
-            shift += step
-            for i in range(len(self.concmes.profiles)):
-                self.convmes.profiles[i][axis] += step
-                self.concmes.profiles[i][axis] += step
-            avgStockNew = self.control_sections_stock_avg()
-            # print('total shift %f' %shift)
-            # print('new avgStock %f' %avgStockNew)
-            if (abs(avgStockNew) <
-                    abs(avgStock)) and not (True in self.initial_check(-0.08,8)):
-                avgStock = avgStockNew
-            else:
-                # print('stop!')
-                for i in range(len(self.concmes.profiles)):
-                    self.convmes.profiles[i][axis] -= step
-                    self.convmes.profiles[i][axis] -= step
-                return shift
-
     def initial_check(self, threshold, points):
         scrapedCv, scrapedCc = False, False
         checkCv = control_sections_over_tolerance(self.stockConvControl.stock,
@@ -491,43 +345,251 @@ class Airfoil(object):
 
     def special_stock_calc(self, rng, rng_width, side='convex', check=True):
         '''rng_width in mm ether range or list with two borders'''
-        p = Pool(2)
-        result = p.apply_async(Stock_special_areas,
-                               (self.convmes, self.convtempl,
-                                rng, rng_width, side, check))
-        self.specialStock = result.get()
-        p.close()
+        self.specialStock = workers.get_pool().apply(
+            Stock_special_areas, (self.convmes, self.convtempl, rng,
+                                  rng_width, self.controlSectionsList,
+                                  side, check, self.settings))
         return self.specialStock
 
+    @metrics.timed('stock_calc_areas')
     def stock_calc_areas(self, rng):
         if '-sp' in argv or '--singleprocess' in argv:
             print('calculating stock using single core')
             return self._stock_calc_areas_sc(rng)
-        print('calculating stock using 2 cores')
-        p = Pool(2)
-        result1 = p.apply_async(Stock_areas, (self.convmes, self.convtempl,
-                                rng, 'convex'))
-        result2 = p.apply_async(Stock_areas, (self.concmes, self.conctempl,
-                                rng, 'concave'))
-        self.stockConv = result1.get()
-        self.stockConc = result2.get()
-        p.close()
+        pool = workers.get_pool()
+        print('calculating stock using %d cores' % pool.processes)
+        self.stockConv, self.stockConc = pool.stock_areas(
+            self.templatesKey,
+            {'convex': self.convtempl, 'concave': self.conctempl},
+            {'convex': self.convmes, 'concave': self.concmes},
+            rng, self.settings.spline)
         return self.stockConv, self.stockConc
 
+    def move(self, axis, val):
+        '''
+            Shift of the measured profiles of both sides along X or Y.
+            The control sections stock, if calculated, is updated
+            for the new position (see Stock.update).
+        '''
+        self.convmes.move(axis, val)
+        self.concmes.move(axis, val)
+        self._update_control_stock(*((val, 0) if axis == 'X' else (0, val)))
+
+    def reset(self):
+        '''
+            Measured profiles back to the calibrated position:
+            all shifts, rotations and tilts are dropped
+        '''
+        self.convmes.reset()
+        self.concmes.reset()
+        # a negative radius: the stock is calculated from scratch
+        self._update_control_stock(radius=-1)
+
+    def rotate(self, angle, center=(0., 0.)):
+        '''C rotation of the measured profiles around center'''
+        self.convmes.rotate(angle, center)
+        self.concmes.rotate(angle, center)
+        self._update_control_stock()
+
+    def tilt(self, axis, angle):
+        '''A or B tilt of the measured profiles'''
+        self.convmes.tilt(axis, angle)
+        self.concmes.tilt(axis, angle)
+        self._update_control_stock()
+
+    def _update_control_stock(self, dx=0, dy=0, radius=None):
+        if radius is None:
+            radius = self.settings.getfloat('Processing',
+                                            'stock_update_radius', 0.5)
+        for mes, name in ((self.convmes, 'stockConvControl'),
+                          (self.concmes, 'stockConcControl')):
+            stock = getattr(self, name, None)
+            if stock is not None and stock.mes is mes:
+                stock.update(dx, dy, radius=radius)
+
+    @metrics.timed('stock_calc_control')
     def stock_calc_control(self):
-        if '-sp' in argv or '--singleprocess' in argv:
-            return self._stock_calc_control_sc()
+        # four sections a side are faster to calculate here
+        # than to send to the workers
+        return self._stock_calc_control_sc()
+
+    def update_settings(self, settings=None):
+        '''
+            Take a new settings snapshot for the next calculations,
+            settings.ini is parsed again only if it has changed
+        '''
+        if settings is None:
+            settings = configparse.get_settings(self.settings.path)
+        self.settings = settings
+        return settings
+
+
+@metrics.timed('best_fit')
+def bestfit_shift(convmes, convtempl, concmes, conctempl, sections,
+                  settings):
+    '''
+        Best fit method 2: shift of the measured profiles by the centroids
+        of the control sections refined by best_fit, see bestfit.py.
+        The profiles are only read. Returns x, y and the BestFit.
+    '''
+    # --------------
+    # for debugging usage
+    # --------------
+    # import matplotlib.pyplot as plt
+    # fig, axs = plt.subplots(2, 2)
+    # col = 0
+    # --------------
+    deltas = np.full((4, 2), np.nan)
+    for num, i in enumerate(sections):
+        # --------------------------
+        # xs, ys - measurements
+        # xs1, ys1 - template
+        # --------------------------
+        xsConv, ysConv = convmes.profiles[i]
+        xsConc, ysConc = (ar[::-1] for ar in concmes.profiles[i])
+        xs1Conv, ys1Conv = convtempl.profiles[i]
+        xs1Conc, ys1Conc = conctempl.profiles[i]
+        stPointConv = xs1Conv[0]
+        endPoint = xs1Conc[-1]
+        xs1ConvCut = xs1Conv[(stPointConv <= xs1Conv) &
+                             (xs1Conv <= endPoint)]
+        ys1ConvCut = ys1Conv[(stPointConv <= xs1Conv) &
+                             (xs1Conv <= endPoint)]
+        xs1Conv, ys1Conv = xs1ConvCut, ys1ConvCut
+        ysConvFirstNotNan = np.where(~np.isnan(ysConv))[0][0]
+        # stPointConv = (stPointConv if stPointConv > ysConvFirstNotNan
+        #            else ysConvFirstNotNan)
+        xsConvItp, ysConvItp = interpolated(
+                                    xsConv[ysConvFirstNotNan:
+                                           minlen(xsConv, ysConv)-1],
+                                    ysConv[ysConvFirstNotNan:
+                                           minlen(xsConv, ysConv)-1],
+                                    stPointConv,
+                                    endPoint,
+                                    settings=settings)
+        # stPointConc = comparator(xsConc[0], xs1Conc[0])
+        stPointConc = stPointConv
+        xs1ConcCut = xs1Conc[(stPointConc <= xs1Conc) &
+                             (xs1Conc <= endPoint)]
+        ys1ConcCut = ys1Conc[(stPointConc <= xs1Conc) &
+                             (xs1Conc <= endPoint)]
+        xs1Conc, ys1Conc = xs1ConcCut, ys1ConcCut
+        xsConcItp, ysConcItp = interpolated(
+                                    xsConc[:minlen(xsConc, ysConc)-1],
+                                    ysConc[:minlen(xsConc, ysConc)-1],
+                                    stPointConc,
+                                    endPoint,
+                                    settings=settings)
+        if ysConvItp[0] < ysConcItp[0]:
+            xsConvItp = xsConvItp[2:]
+            ysConvItp = ysConvItp[2:]
+        xs1 = np.hstack((xs1Conv, xs1Conc)).astype(float)
+        ys1 = np.hstack((ys1Conv, ys1Conc)).astype(float)
+        xs = np.append(xsConvItp, xsConcItp)
+        ys = np.append(ysConvItp, ysConcItp)
+
+        centroid = np.array([np.mean(xs), np.mean(ys)])
+        centroid1 = np.array([np.mean(xs1), np.mean(ys1)])
+        deltas[num] = centroid1 - centroid
+        # -----------
+        # draw debug graphs
+        # -----------
+        # row = 0 if num < 2 else 1
+        # axs[row, col].plot(xsConvItp, ysConvItp, 'b-',
+        #                    xs1Conv, ys1Conv, 'g-',
+        #                    xsConcItp, ysConcItp, 'r-',
+        #                    xs1Conc, ys1Conc, 'y-')
+        # axs[row, col].grid()
+        # col = 1 if col == 0 else 0
+        # -----------
+    deltas = deltas.T
+    # plt.show()
+    # the centroids shift is refined by the least squares of the stock
+    # of the control sections with the scrap condition as a penalty
+    threshold = settings.getfloat('Processing', 'min_stock_initial_check',
+                                  -0.08)
+    fit = best_fit((('convex', convmes, convtempl),
+                    ('concave', concmes, conctempl)),
+                   sections,
+                   start=(np.mean(deltas[0]), np.mean(deltas[1])),
+                   rotation=settings.getbool('Processing',
+                                             'bestfit_rotation'),
+                   spline=settings.spline, threshold=threshold)
+    x_shift = check_shift(fit.x)
+    y_shift = check_shift(fit.y)
+    print('total shift x: %f, centroids: %f' % (x_shift,
+                                                np.mean(deltas[0])))
+    print('total shift y: %f, centroids: %f' % (y_shift,
+                                                np.mean(deltas[1])))
+    return x_shift, y_shift, fit
+
+
+@metrics.timed('best_fit')
+def centroids_shift(convmes, convtempl, concmes, conctempl, sections):
+    '''
+        Best fit method 1: shift of the measured profiles by the centroids
+        of the control sections parts common to the measurement and the
+        template. The profiles are only read.
+    '''
+    deltas = np.full((4, 2), np.nan)
+    # for num,i in enumerate([121,221,321,341]):
+    for num, i in enumerate(sections):
+        conv = convmes.profiles[i][:, convmes.profiles[i][1] < 4]
+        rng_start_cv, rng_end_cv = check_borders(
+            conv[0], convtempl.profiles[i][0])
+        rng_start_cc, rng_end_cc = check_borders(
+            concmes.profiles[i][0][::-1], conctempl.profiles[i][0])
+        if rng_start_cv >= rng_start_cc:
+            rng_start = rng_start_cv
         else:
-            return self._stock_calc_control_sc()
-        p = Pool(2)
-        result1 = p.apply_async(Stock, (self.convmes, self.convtempl,
-                                self.controlSectionsList, 'convex'))
-        result2 = p.apply_async(Stock, (self.concmes, self.conctempl,
-                                self.controlSectionsList, 'concave'))
-        self.stockConvControl = result1.get()
-        self.stockConcControl = result2.get()
-        p.close()
-        return self.stockConvControl, self.stockConcControl
+            rng_start = rng_start_cc
+        if rng_end_cv <= rng_end_cc:
+            rng_end = rng_end_cv
+        else:
+            rng_end = rng_end_cc
+        conv = cut_rng(conv, rng_start, rng_end)
+        conc = cut_rng(concmes.profiles[i], rng_start, rng_end)
+        conv1 = cut_rng(convtempl.profiles[i], rng_start, rng_end)
+        conc1 = cut_rng(conctempl.profiles[i], rng_start, rng_end)
+        # import pdb; pdb.set_trace()
+        xs = np.append(conv[0], conc[0])
+        ys = np.append(conv[1], conc[1])
+        avg_x = np.mean(xs)
+        avg_y = np.mean(ys)
+        xs1 = np.append(conv1[0], conc1[0])
+        ys1 = np.append(conv1[1], conc1[1])
+        avg_x1 = np.mean(xs1)
+        avg_y1 = np.mean(ys1)
+        deltas[num, 0] = avg_x - avg_x1
+        deltas[num, 1] = avg_y1 - avg_y
+    deltas = deltas.T
+    x_shift = np.mean(deltas[0])-0.1
+    y_shift = np.mean(deltas[1])
+    y_shift += 0.06
+    if y_shift < 0:
+        y_shift *= 0.6
+
+    x_shift = check_shift(x_shift)
+    y_shift = check_shift(y_shift)
+
+    print('X shift: %f\nY shift: %f' % (x_shift, y_shift))
+    return x_shift, y_shift
+
+
+def c2_options(settings, sections):
+    '''arguments of Airfoil.c2 from settings.ini [Profile]'''
+    def params(name):
+        return [np.round(i, 2) for i in settings.getlist('Profile', name)]
+    return {'rng': sections,
+            'alpha': [min_to_decimal(i) for i in params('alpha')],
+            'gamma2': [min_to_decimal(i) for i in params('gamma2')],
+            'b2': params('b2'),
+            'C2Nominal': params('C2'),
+            'C2Tol': np.round(float(settings['Profile', 'C2Tol']), 2),
+            'Y2': params('Y2'),
+            'R2': params('R2'),
+            'C2Pos': np.round(float(settings['Profile', 'C2Dist']), 2)
+            }
 
 
 def check_borders(mesP, templP):
@@ -594,8 +656,9 @@ def correct_calibration_arrays(calibArray, secRng):
 
 
 def create_calibration_arrays(**kwargs):
-    profile_file = kwargs['profile_file']
-    if get_area_to_measure(profile_file) != 101:
+    # path or ProfileFile already read (Airfoil.profile_data)
+    profile_file = profile_file_data(kwargs['profile_file'])
+    if profile_file.area_to_measure != 101:
         raise Exception('Not the calibratin part profile file')
     refpart_cv = profile(profile_file, side='convex', sections='all')
     refpart_cc = profile(profile_file, side='concave', sections='all')
@@ -637,37 +700,62 @@ def cut_rng(section, rng_start, rng_end):
     return np.vstack((xs, ys))
 
 
+@metrics.timed('extract_profiles')
 def extract_profiles(df, sections):
-    profiles = []
-    for i, sec in enumerate(sections):
-        XY = df.iloc[sec].dropna(how='all')
-        xs = XY.index.values
-        ys = XY.values / 10**5
-        toDel = []
-        for pn, p in enumerate(ys[:-1]):
-            if abs(p - ys[pn+1]) > 0.5:
-                toDel.append(pn)
-        ys = np.delete(ys, toDel)
-        xs = np.delete(xs, toDel)
-        stack = np.vstack((xs, ys))
-        profiles.append(stack)
-    return profiles
-
-
-def get_additional_calibration():
+    '''
+        Rows of df (heights in 1e-5 mm) for sections without empty points
+        and without the points before jumps of more than 0.5 mm, packed
+    '''
+    values = df.to_numpy(dtype=float)[np.asarray(sections, dtype=int)] / 10**5
+    mask = ~np.isnan(values)
+    xs = np.broadcast_to(df.columns.to_numpy(dtype=float), values.shape)[mask]
+    ys = values[mask]
+    rows = np.repeat(np.arange(len(values)), mask.sum(axis=1))
+    jump = np.zeros(ys.size, dtype=bool)
+    jump[:-1] = (np.abs(np.diff(ys)) > 0.5) & (rows[1:] == rows[:-1])
+    keep = ~jump
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[keep], minlength=len(values)), out=offsets[1:])
+    return PackedProfiles(np.vstack((xs[keep], ys[keep])), offsets)
+
+
+def frozen_profile(prof, sections):
+    '''
+        Shallow copy of the profile with read only copies of the sections
+    '''
+    frozen = copy.copy(prof)
+    frozen.profiles = {}
+    for s in sections:
+        sec = np.array(prof.profiles[s], dtype=np.float64)
+        sec.flags.writeable = False
+        frozen.profiles[s] = sec
+    return frozen
+
+
+def get_additional_calibration(settings=None):
     additional_calibration = {}
-    configfile_path = 'settings.ini'
+    if settings is None:
+        settings = configparse.get_settings('settings.ini')
     for i in ['cv_shift_x', 'cc_shift_x', 'cv_shift_y', 'cc_shift_y',
               'cv_tilt_a', 'cc_tilt_a', 'cv_tilt_b', 'cc_tilt_b']:
-        additional_calibration[i] = float(configparse.get_setting(
-            configfile_path, 'Calibration', i))
+        additional_calibration[i] = float(settings['Calibration', i])
+    # C tilts were added later, old settings.ini have none
+    for i in ['cv_tilt_c', 'cc_tilt_c']:
+        additional_calibration[i] = settings.getfloat('Calibration', i, 0.)
     return additional_calibration
 
 
-def get_control_sections():
-    configfile_path = 'settings.ini'
-    return [int(np.round(float(i), 1) * 10) for i in configparse.get_setting(
-                configfile_path, 'Profile', 'control_sections').split(', ')]
+def get_control_sections(settings=None):
+    if settings is None:
+        settings = configparse.get_settings('settings.ini')
+    return settings.control_sections
+
+
+def profile_file_data(profile_file):
+    '''ProfileFile for a path, the same object for a ProfileFile'''
+    if isinstance(profile_file, ProfileFile):
+        return profile_file
+    return ProfileFile(profile_file)
 
 
 def get_first_point_arrays(list_of_sections, row):
@@ -684,23 +772,26 @@ def get_first_point_arrays(list_of_sections, row):
 
 
 def get_scanner_program_number(filename):
+    if isinstance(filename, ProfileFile):
+        return filename.scanner_program
     with open(os.path.join(filename), 'r') as f:
        line = f.readline()
        return line[line.index(':') + 1: line.index('\n')]
 
 
 def get_area_to_measure(filename):
+    if isinstance(filename, ProfileFile):
+        return filename.area_to_measure
     with open(os.path.join(filename), 'r') as f:
         lines = [f.readline() for i in range(3)]
     return int(lines[2].split(';')[0])
 
 
-def interpolated(x, y, start, end, step=0.01):
+def interpolated(x, y, start, end, step=0.01, settings=None):
     # import pdb; pdb.set_trace()
-    configFilePath = os.path.join('settings.ini')
-    spline_kind = configparse.get_setting(configFilePath, 'Processing',
-                                             'bestfit_spline_kind')
-    f = interp1d(x, y, kind=spline_kind, fill_value='extrapolate')
+    if settings is None:
+        settings = configparse.get_settings(os.path.join('settings.ini'))
+    f = interp1d(x, y, kind=settings.spline_kind, fill_value='extrapolate')
     xx = np.arange(start, end, step)
     yy = f(xx)
     return xx, yy
@@ -718,31 +809,89 @@ def main():
     print('время выполнеия программы: ', datetime.now()-s_time)
 
 
+def min_to_decimal(ang):
+    """
+        convert [deg.min] to decimal degrees
+    """
+    main = np.modf(ang)[1]
+    part = np.round(np.modf(ang)[0] * 100 / 60, 2)
+    return main + part
+
+
 def minlen(x, y):
     return x.size if x.size < y.size else y.size
 
 
 def newest_file(path):
-    files = os.listdir(path)
-    if files:
-        files = [os.path.join(path, file) for file in files]
-        files = [file for file in files if os.path.isfile(file)]
-        profile_file = max(files, key=os.path.getmtime)
-    return profile_file
+    '''the last modified file of path, see profile_watcher'''
+    return profile_watcher.get_watcher(path).newest()
 
 
-def noise_filter(df, window, mul):
-    # df = df.rolling(window).mean()
-    median = df.rolling(window).median()
-    std = df.rolling(window).std()
-    df = df[(df <= median + mul * std) & (df >= median - mul * std)]
-    return df
+@metrics.timed('noise_filter')
+def noise_filter(df, window, mul, kernel='window'):
+    '''
+        Removes the points out of median +- mul * std of the window
+        of the last points in the column. As with pandas rolling, the
+        first window - 1 rows and windows with empty points are removed.
+        kernel - 'window': median and std of one sorted sliding window
+        view of the data, 'pandas': two pandas rolling passes.
+        The kernels differ only for the points exactly on a bound (as
+        on the integer heights of the scanner): the window std is exact,
+        the pandas rolling std is off by up to ~1e-8 of it either way,
+        so pandas may remove such a point, which is kept here.
+    '''
+    if kernel == 'pandas' or sliding_window_view is None:
+        # df = df.rolling(window).mean()
+        median = df.rolling(window).median()
+        std = df.rolling(window).std()
+        df = df[(df <= median + mul * std) & (df >= median - mul * std)]
+        return df
+    values = df.to_numpy(dtype=float)
+    keep = np.zeros(values.shape, dtype=bool)
+    if len(values) >= window:
+        windows = np.sort(sliding_window_view(values, window, axis=0),
+                          axis=-1)
+        half = window // 2
+        if window % 2:
+            median = windows[..., half]
+        else:
+            median = (windows[..., half - 1] + windows[..., half]) / 2
+        # nan for windows with empty points, so they are not kept
+        std = windows.std(axis=-1, ddof=1)
+        values = values[window - 1:]
+        with np.errstate(invalid='ignore'):
+            keep[window - 1:] = ((values <= median + mul * std) &
+                                 (values >= median - mul * std))
+    return df.where(keep)
 
 
 def smothing_calibration_arrays(calib_array, wndSize):
     return pd.Series(calib_array).rolling(wndSize).mean()
 
 
+def template_profile(filename, side='convex'):
+    '''
+        Template profile, parsed once per process while the file
+        is not changed. Profiles returned for the same file share one
+        read only buffer (copied on modification) and the cache of
+        the template spline segments.
+    '''
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size, side)
+    with _templates_lock:
+        cached = _templates.get(path)
+        if cached is None or cached[0] != stamp:
+            templ = profile(filename, side=side, template=True,
+                            sections='all')
+            templ.profiles.read_only()
+            templ.stock_cache = {}
+            cached = _templates[path] = (stamp, templ)
+    templ = copy.copy(cached[1])
+    templ.profiles = copy.copy(cached[1].profiles)
+    return templ
+
+
 def theoretical_point(x0, y0, ang_deg, r):
     x = r * np.cos(np.radians(ang_deg)) + x0
     y = r * np.sin(np.radians(ang_deg)) + y0
@@ -10,26 +10,36 @@ import tornado.options
 import tornado.autoreload
 import tornado.gen
 
-import threading
-import time
+from concurrent.futures import ThreadPoolExecutor
 
 import os
-from sys import argv, exit
-from functools import partial
+from sys import argv, exit, stdout
 import asyncio
 
 arg_list = ['-h', '--help', '-s', '--simulator', '-v', '--verbose', '-sp', '--singleprocess']
-if len(argv) > 1:
-    for a in argv[1:]:
-        if (a in arg_list[:2]) or  (a not in arg_list):
-            print('available arguments are:\n'+
-                '-h, --help\t - print help message\n' +
-                '-s, --simulator\t- run server without  ADS connection\n'+
-                '-v, --verbose\t- print output to console\n' +
-                '-sp, --singleprocess\t- run calculations on single process')
-            exit(0)
+
+def check_arguments():
+    '''
+        exit with the help message for -h or an unknown argument;
+        checked when the server starts, not on import of textron
+    '''
+    if len(argv) > 1:
+        for a in argv[1:]:
+            if (a in arg_list[:2]) or  (a not in arg_list):
+                # to the console, print is write_to_log here
+                stdout.write('available arguments are:\n'+
+                    '-h, --help\t - print help message\n' +
+                    '-s, --simulator\t- run server without  ADS connection\n'+
+                    '-v, --verbose\t- print output to console\n' +
+                    '-sp, --singleprocess\t- run calculations on single process\n')
+                exit(0)
 
 import textron
+import textron.configparse as configparse
+import textron.plc_io as plc_io
+import textron.profile_watcher as profile_watcher
+import textron.sessions as sessions
+import textron.workers as workers
 from textron.logging_module import write_to_log
 from textron.plcdebug import *
 
@@ -62,6 +72,7 @@ class TextronServer(object):
             self.simulator = True
         else:
             self.simulator = False
+        self.profiles_dir = r'C:\Roima\TBM_9_5_2018\TBM_9_5_2018\Profiles\1'
 
     def setup_bokeh(self):
         #turn file paths into bokeh apps
@@ -99,92 +110,140 @@ class TextronServer(object):
             item_to_change[i].data = data[i]
 
     def check_file(self):
-        path = r'C:\Roima\TBM_9_5_2018\TBM_9_5_2018\Profiles\1'
-        files = os.listdir(path)
-        if files:
-            files = [os.path.join(path, file) for file in files]
-            files = [file for file in files if os.path.isfile(file)]
-            profile_file = max(files, key = os.path.getctime)
-        return profile_file
-
-    def heart_beat(self):
-        plc = pyads.Connection('5.41.213.16.1.1', 851)
-        plc.open()
-        while True:
+        return self.watcher.newest()
+
+    async def heart_beat(self):
+        '''one beat, run by a PeriodicCallback every second'''
+        try:
+            await self.run_plc(self._beat)
+        except Exception as e:
+            # the connection is opened again on the next beat
+            print('heart beat failed: %s' % e)
+
+    def _beat(self):
+        plc = self.plc
+        with plc.lock:
             if not plc.read_by_name('GVL_MeasuringUnit.bMU_HeartBeat',
-                        pyads.PLCTYPE_BOOL):
+                                    pyads.PLCTYPE_BOOL):
                 plc.write_by_name('GVL_MeasuringUnit.bMU_HeartBeat', True,
-                        pyads.PLCTYPE_BOOL)
-            time.sleep(1)
+                                  pyads.PLCTYPE_BOOL)
+
+    def _connected(self, future):
+        # the first connection is not awaited, its error is logged here
+        if not future.cancelled() and future.exception() is not None:
+            print('PLC connection failed: %s' % future.exception())
+
+    def run_plc(self, func, *args):
+        '''
+            Run blocking PLC I/O in the PLC thread, one call at a time
+            in the order of the calls. Returns a future for the loop.
+        '''
+        return self.io_loop.run_in_executor(self.executor, func, *args)
 
     def update_data(self):
-        plc = pyads.Connection('5.41.213.16.1.1', 851)
-        plc.open()
-        prev_task = 9999
-        old_file = self.check_file()
-        while True:
-            AreaToMeasure = plc.read_by_name(
-                'GVL_MeasuringUnit.byteAreaToMeasure', pyads.PLCTYPE_BYTE)
-            if AreaToMeasure != prev_task:
-                mes = ("task has changed -> new task is ", AreaToMeasure)
-                print(mes)
-                if AreaToMeasure == -58 and prev_task != AreaToMeasure:
-                    plc.write_by_name(
-                        'GVL_MeasuringUnit.O_bytePathX_offsetPlus', 0,
-                        pyads.PLCTYPE_BYTE)
-                    plc.write_by_name(
-                        'GVL_MeasuringUnit.O_bytePathX_offsetMinus', 0,
-                        pyads.PLCTYPE_BYTE)
-                    plc.write_by_name(
-                        'GVL_MeasuringUnit.O_bytePathY_offsetPlus', 0,
-                        pyads.PLCTYPE_BYTE)
-                    plc.write_by_name(
-                        'GVL_MeasuringUnit.O_bytePathY_offsetMinus', 0,
-                        pyads.PLCTYPE_BYTE)
-                    plc.write_by_name(
-                        'GVL_MeasuringUnit.O_bytePathC_offsetPlus', 0,
-                        pyads.PLCTYPE_BYTE)
-                    plc.write_by_name(
-                        'GVL_MeasuringUnit.O_bytePathC_offsetMinus', 0,
-                        pyads.PLCTYPE_BYTE)
-                    print('offsets reseted')
-                    plc.write_by_name(
-                        'GVL_MeasuringUnit.O_bytePostGrinding_CV', 0,
-                        pyads.PLCTYPE_BYTE)
-            try:
-                old_file
-            except:
-                old_file = ''
-            try:
-                new_file = self.check_file()
-            except OSError:
-                new_file = old_file
-                print('There was the FileNotFoundError. Remaining the old_file')
-            if (new_file != old_file) and ('-' not in new_file):
-                    old_file = new_file
-                    plc.write_by_name('GVL_MeasuringUnit.bMU_Measuring', False,
-                        pyads.PLCTYPE_BOOL)
-                    plc.write_by_name('GVL_MeasuringUnit.bMU_Processing', True,
-                        pyads.PLCTYPE_BOOL)
-                    mes = 'loading profiles and updating plot data'
-                    print(mes)
-                    for app_name,app_context in self.bokeh_server._tornado._applications.items():
-                        for k,ses in app_context._sessions.items():
-                            button1 = (ses._document.select_one(
-                                {'name': 'load'}))#, 'attr': 'clicks', 'new': 1}
-                            toggle1 = (ses._document.select_one(
-                                {'name': 'checkControlSections'}))
-                            ses._document.add_next_tick_callback(partial(
-                                self.sim_click, button1))
-                            # if plc.read_by_name('IO_R2.I_byteTaskID',
-                            #     pyads.PLCTYPE_BYTE)==12:
-                            #     ses._document.add_next_tick_callback(partial(
-                            #         self.sim_toggle, toggle1, state = False))
-            prev_task = AreaToMeasure
-            time.sleep(1)
-
-    def sim_click(self,button):
-        button.clicks +=1
+        '''
+            React to a new task of the PLC and to a new profile file.
+            The task comes by ADS notification, or it is read every
+            plc_poll_interval seconds if [Settings] plc_notifications
+            is False. New files come from the profiles directory watcher.
+            Events of the other threads are passed to the loop.
+        '''
+        settings = configparse.get_settings()
+        notifications = settings.getbool('Settings', 'plc_notifications',
+                                         True)
+        interval = settings.getfloat('Settings', 'plc_poll_interval', 1.)
+        self.prev_task = 9999
+        # the last task reported, a failed one is tried again while
+        # it is the last (a notification comes only on a change)
+        self.task = None
+        self.notifications = notifications
+        if notifications:
+            self.plc.subscribe(
+                'GVL_MeasuringUnit.byteAreaToMeasure', pyads.PLCTYPE_BYTE,
+                lambda name, value: self.io_loop.add_callback(
+                    self.on_event, 'task', value))
+            print('waiting for tasks by ADS notifications')
+        else:
+            self.periodic(self.poll_task, interval)
+        self.watcher.start(lambda filename: self.io_loop.add_callback(
+            self.on_event, 'file', filename))
+
+    async def poll_task(self):
+        try:
+            task = await self.run_plc(
+                self.plc.read_by_name, 'GVL_MeasuringUnit.byteAreaToMeasure',
+                pyads.PLCTYPE_BYTE)
+        except Exception as e:
+            # the connection is opened again on the next reading
+            print('task was not read: %s' % e)
+            return
+        await self.on_event('task', task)
+
+    async def on_event(self, event, value):
+        try:
+            if event == 'task':
+                self.task = value
+                if value != self.prev_task:
+                    await self.run_plc(self.new_task, value)
+                    # only when it is done: a failed task is tried again
+                    self.prev_task = value
+            elif '-' not in os.path.basename(value):
+                # renamed -pre/-post files are not new scans
+                try:
+                    await self.run_plc(self.new_file, value)
+                except Exception as e:
+                    # the file is reported once, it is loaded anyway
+                    print('PLC was not told of %s: %s' % (value, e))
+                self.load_profiles()
+        except Exception as e:
+            print('%s %s was not processed: %s' % (event, value, e))
+            if event == 'task' and self.notifications:
+                self.io_loop.call_later(1, self.retry_task, value)
+
+    def retry_task(self, value):
+        if value == self.task and value != self.prev_task:
+            self.io_loop.add_callback(self.on_event, 'task', value)
+
+    def new_task(self, AreaToMeasure):
+        plc = self.plc
+        mes = ("task has changed -> new task is ", AreaToMeasure)
+        print(mes)
+        if AreaToMeasure == -58:
+            plc.write_list(
+                [('GVL_MeasuringUnit.O_bytePath%s' % offset, 0,
+                  pyads.PLCTYPE_BYTE)
+                 for offset in ('X_offsetPlus', 'X_offsetMinus',
+                                'Y_offsetPlus', 'Y_offsetMinus',
+                                'C_offsetPlus', 'C_offsetMinus')])
+            print('offsets reseted')
+            plc.write_by_name(
+                'GVL_MeasuringUnit.O_bytePostGrinding_CV', 0,
+                pyads.PLCTYPE_BYTE)
+
+    def new_file(self, filename):
+        plc = self.plc
+        print('new profile file %s' % filename)
+        plc.write_by_name('GVL_MeasuringUnit.bMU_Measuring', False,
+            pyads.PLCTYPE_BOOL)
+        plc.write_by_name('GVL_MeasuringUnit.bMU_Processing', True,
+            pyads.PLCTYPE_BOOL)
+
+    def load_profiles(self):
+        '''press "load" in every session'''
+        mes = 'loading profiles and updating plot data'
+        print(mes)
+        self.sessions.click('load')
+
+    def periodic(self, callback, interval):
+        '''
+            Run callback every interval seconds on the loop. The times
+            are counted from the start, so they do not drift; a call
+            still running when the next one is due skips it.
+        '''
+        periodic = tornado.ioloop.PeriodicCallback(callback, interval * 1000)
+        periodic.start()
+        self.periodics.append(periodic)
+        return periodic
 
     def sim_toggle(self, toggle, state = True):
         toggle.active = state
@@ -192,21 +251,13 @@ class TextronServer(object):
     def change_staus(self, status, text):
         status.text = text
 
-    def update_status_btn(self, statusBtn, state):
-        statusBtn.button_type = state
-
     def update_status(self):
-        while True:
-            for app_name,app_context in self.bokeh_server._tornado._applications.items():
-                for k,ses in app_context._sessions.items():
-                    statusBtn = (ses._document.select_one({'name': 'statusBtn'}))
-                    if statusBtn.button_type == 'success':
-                        ses._document.add_next_tick_callback(partial(
-                            self.update_status_btn, statusBtn, 'default'))
-                    else:
-                        ses._document.add_next_tick_callback(partial(
-                            self.update_status_btn, statusBtn, 'success'))
-            time.sleep(1)
+        # red status button while there is no PLC connection,
+        # the sessions get it only when it changes
+        if self.plc.health()['connected']:
+            self.sessions.set_status('success')
+        else:
+            self.sessions.set_status('danger')
 
     def start_server(self,host='localhost', app_port=9876,bok_port=5006):
         print('--------------')
@@ -219,30 +270,47 @@ class TextronServer(object):
 
         #sets the bokeh io_loop to be my io_loop
         self.bokeh_server = self.setup_bokeh()
+        # widgets of the sessions, registered by textron_app
+        self.sessions = sessions.get_registry()
         self.bokeh_server.show('/')
-        # start the thread for starting data
-        try:
-            pyads
-            if not self.simulator:
-                ud_thread = threading.Thread(target=self.update_data)
-                ud_thread.start()
-                us_thread1 = threading.Thread(target=self.heart_beat)
-                us_thread1.start()
-            else:
-                print('running in simulator mode')
-            us_thread2 = threading.Thread(target = self.update_status)
-            us_thread2.start()
-        except:
-            mes = 'Pyads connection failed'
-            print(mes)
-            # print(mes, mesType = 'warining')
+        # new scans are reported by the watcher of the profiles directory
+        self.watcher = profile_watcher.get_watcher(self.profiles_dir)
+        # one PLC connection for the loop and the sessions,
+        # its blocking I/O runs in one thread
+        self.plc = plc_io.start_connection(self.simulator)
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='plc')
+        self.periodics = []
+        self.run_plc(self.plc.connect).add_done_callback(self._connected)
+        # in the simulator mode tasks come by PLCDEBUG.notify
+        self.update_data()
+        if not self.simulator:
+            self.periodic(self.heart_beat, 1)
+        else:
+            print('running in simulator mode')
+        self.periodic(self.update_status, 1)
+        # calculation processes live as long as the server
+        workers.start_pool()
         mes = ('starting server on %s:%d/textron_app'%(host,bok_port))
         print(mes)
         self.io_loop.current()
-        self.io_loop.start()
+        try:
+            self.io_loop.start()
+        finally:
+            self.stop()
+
+    def stop(self):
+        '''stop the periodic calls and the PLC, watcher and pool threads'''
+        for periodic in self.periodics:
+            periodic.stop()
+        self.periodics = []
+        profile_watcher.stop_watchers()
+        self.executor.shutdown(wait=True)
+        plc_io.stop_connection()
+        workers.stop_pool()
 
 
 def start_server():
+    check_arguments()
     srv = TextronServer()
     srv.start_server()
 
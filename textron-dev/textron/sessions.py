@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+'''
+    Registry of the open interface sessions.
+
+    Every session registers the widgets the server changes when its
+    document is created, so the server does not search the documents
+    for them, and the status is sent to the sessions only when it changes.
+'''
+import threading
+
+from functools import partial
+
+from textron.logging_module import write_to_log
+
+print = write_to_log
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+class SessionRegistry(object):
+    '''
+        Widgets of the open sessions by document
+        status - button type of the status buttons, None until it is set
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.status = None
+
+    def register(self, doc, **widgets):
+        '''
+            widgets by name, e.g. status=..., load=...;
+            the session is removed when it is destroyed
+        '''
+        with self.lock:
+            self.sessions[doc] = widgets
+            status = self.status
+        # the document is not served yet, it is changed directly
+        if status is not None and 'status' in widgets:
+            widgets['status'].button_type = status
+        doc.on_session_destroyed(lambda context: self.unregister(doc))
+
+    def unregister(self, doc):
+        with self.lock:
+            self.sessions.pop(doc, None)
+
+    def broadcast(self, name, func, *args):
+        '''
+            func(widget, *args) on the next tick of every session
+            with the widget name, returns the number of the sessions
+        '''
+        with self.lock:
+            targets = [(doc, widgets[name])
+                       for doc, widgets in self.sessions.items()
+                       if name in widgets]
+        for doc, widget in targets:
+            doc.add_next_tick_callback(partial(func, widget, *args))
+        return len(targets)
+
+    def set_status(self, status):
+        '''button type of the status buttons, sent only if it has changed'''
+        with self.lock:
+            if status == self.status:
+                return False
+            self.status = status
+        self.broadcast('status', set_button_type, status)
+        return True
+
+    def click(self, name):
+        '''press the button in every session'''
+        return self.broadcast(name, click)
+
+
+def set_button_type(button, button_type):
+    button.button_type = button_type
+
+
+def click(button):
+    button.clicks += 1
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = SessionRegistry()
+        return _registry
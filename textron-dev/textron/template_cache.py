@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+    Templates (TemplateConvex.csv, TemplateConcave.csv) compiled to .npz
+
+    A template is parsed from csv once and saved to ./cache. The compiled
+    file is used while the csv has the same path and modification time,
+    or, if the time has changed (file copied again), the same content.
+'''
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+
+from textron.logging_module import write_to_log
+from textron.packed_profiles import PackedProfiles
+
+print = write_to_log
+
+cache_dir = 'cache'
+
+
+def compile_template(filename):
+    '''
+        Rows of the template table (x, y of the not empty cells)
+        as PackedProfiles and the start index of the table
+    '''
+    df = pd.read_csv(filename, sep=';', skiprows=1, skip_blank_lines=True)
+    startindex = df['#'][0]
+    df = df.drop(['#'], axis=1)
+    x = np.array([float(str(p)[:4]) for p in df.columns])
+    values = df.iloc[2:].to_numpy(dtype=float)
+    mask = ~np.isnan(values)
+    offsets = np.zeros(values.shape[0] + 1, dtype=np.int64)
+    np.cumsum(mask.sum(axis=1), out=offsets[1:])
+    data = np.vstack((np.broadcast_to(x, values.shape)[mask], -values[mask]))
+    return PackedProfiles(data, offsets), startindex
+
+
+def file_hash(filename):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_template(filename):
+    '''
+        compile_template result, from ./cache if it is up to date
+    '''
+    path = os.path.abspath(filename)
+    mtime = os.path.getmtime(path)
+    name = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    cached = os.path.join(cache_dir, 'template_%s.npz' % name)
+    try:
+        with np.load(cached) as npz:
+            if str(npz['path']) == path:
+                if float(npz['mtime']) == mtime:
+                    return (PackedProfiles(npz['data'], npz['offsets']),
+                            float(npz['startindex']))
+                # the same file copied again keeps its compiled data
+                if str(npz['sha1']) == file_hash(path):
+                    rows = PackedProfiles(npz['data'], npz['offsets'])
+                    startindex = float(npz['startindex'])
+                    _save(cached, rows, startindex, path, mtime,
+                          str(npz['sha1']))
+                    return rows, startindex
+    except (OSError, KeyError, ValueError):
+        pass
+    rows, startindex = compile_template(path)
+    _save(cached, rows, startindex, path, mtime, file_hash(path))
+    return rows, startindex
+
+
+def _save(cached, rows, startindex, path, mtime, digest):
+    tmp = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # a file of its own: processes of a pool may compile the same
+        # template at the same time
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp.npz',
+                                   prefix=os.path.basename(cached) + '.')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, data=rows.data, offsets=rows.offsets,
+                     startindex=startindex, path=path, mtime=mtime,
+                     sha1=digest)
+        os.replace(tmp, cached)
+    except OSError as e:
+        print('template cache was not saved: %s' % e)
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
@@ -6,16 +6,24 @@ from bokeh.plotting import figure
 from bokeh.io import curdoc
 
 import numpy as np
-from time import sleep, strftime
-import copy
+from functools import partial
+from time import strftime
 import os
+import time
 
 from textron.plcdebug import *
 import textron.configparse as configparse
+import textron.jobs as jobs
+import textron.metrics as metrics
+import textron.plc_io as plc_io
+import textron.profile_watcher as profile_watcher
+import textron.sessions as sessions
 import shutil
 from sys import argv
 
-from textron.profiles_manipulation import Airfoil
+from textron.profiles_manipulation import Airfoil, bestfit_shift
+from textron.profiles_manipulation import c2_options
+from textron.profiles_manipulation import centroids_shift
 from textron.profiles_manipulation import control_sections_over_tolerance
 from textron.profiles_manipulation import create_calibration_arrays
 from textron.logging_module import write_to_log
@@ -24,6 +32,9 @@ from textron.logging_module import write_to_log
 #     print = write_to_log
 print = write_to_log
 
+# jobs which calculate the stock of Blade, it is not moved meanwhile
+CALC_JOBS = ('расчет припуска', 'загрузка профиля')
+
 try:
     import pyads
 except ImportError:
@@ -45,6 +56,10 @@ class TextronApp(object):
         else:
             self.simulator = False
         self._empty_sources()
+        # calculations run out of the callbacks, see textron/jobs.py
+        doc = curdoc()
+        self.jobs = jobs.JobRunner(doc)
+        doc.on_session_destroyed(lambda context: self.jobs.shutdown())
 
         ''' load settings '''
         self.configfile_path = os.path.join("settings.ini")
@@ -215,6 +230,12 @@ class TextronApp(object):
         self.bestfit_btn = Button(label='Припасовка', name='bestfit')
         self.bestfit_btn.on_change('clicks', self.perform_best_fit)
 
+        # buttons which move Blade, disabled during the calculation
+        self.blade_buttons = [self.xplus, self.xminus, self.yplus,
+                              self.yminus, self.cplus, self.cminus,
+                              self.aplus, self.aminus, self.bplus,
+                              self.bminus, self.reset_btn, self.bestfit_btn]
+
         self.profiles_btn = Button(label='Загрузить данные', name='load')
         self.profiles_btn.on_change('clicks', self.ld_profiles)
 
@@ -283,6 +304,9 @@ class TextronApp(object):
         self.status.width = 600
 
         self.curfile = Div(text = '-', name = 'curfile')
+        # durations of the stages of the last parts
+        self.timing = Div(text = metrics.html_table(metrics.recent),
+                          name = 'timing')
 
         '''CheckboxGroups'''
         self.checkboxG_side = CheckboxGroup(labels=['Спинка', ' Корыто'],
@@ -315,18 +339,17 @@ class TextronApp(object):
         plots_to_update = {sections_list[0]: self.plot1,
             sections_list[1]: self.plot2,
             sections_list[2]: self.plot3, sections_list[3]: self.plot4}
-        sources = {sections_list[0]: self.source1,
-            sections_list[1]: self.source2,
-            sections_list[2]: self.source3,
-            sections_list[3]: self.source4}
         self.scatters = []
         for ind, sec in enumerate(sections_list):
             stock = [cv_data[sec], cc_data[sec]]
+            # the measured profiles as they are now: the sections of
+            # the sources are not moved with Blade
+            mes = [self.Blade.convmes.profiles[sec],
+                   self.Blade.concmes.profiles[sec]]
             for i in range(2):
                 stock_side = stock[i]
                 if gName == 'stock':
-                    xs = sources[sec].data['xs'][i+2]
-                    ys = sources[sec].data['ys'][i+2]
+                    xs, ys = mes[i][0], mes[i][1]
                 else:
                     xs = np.array([stock_side[0]])
                     ys = np.array([stock_side[1]])
@@ -343,46 +366,44 @@ class TextronApp(object):
                     hover.tooltips = [("(x, y)", "(@x, @y)")]
                 plots_to_update[sec].add_tools(hover)
 
-    def _check_c2(self, plc = False):
+    def _blade_locked(self):
+        '''
+            True if Blade is used by a calculation: the shifts of the
+            interface wait for its end
+        '''
+        if any(self.jobs.running(name) for name in CALC_JOBS):
+            self.status.text = 'Идет расчет припуска, смещения недоступны'
+            return True
+        return False
+
+    def _calc_snapshot(self):
+        '''offsets and transforms of Blade the stock is calculated for'''
+        return {'offsets': (self.totalx, self.totaly),
+                'transforms': (self.Blade.convmes.profiles.transform,
+                               self.Blade.concmes.profiles.transform)}
+
+    def _check_c2(self, plc = False, job = None):
         '''
         Perform the C2 check
+        job - the widgets are changed in the document if it runs in a job
         '''
         if not plc:
             plc = open_PLC_connection()
         try:
             self.Blade
         except:
-            self.showC2_toggle.active = False
+            self._in_document(job, setattr, self.showC2_toggle, 'active',
+                              False)
             return 0
         if self.calculateTheorC2Toggle.active and (
                 plc.read_by_name('IO_R2.I_byteTaskID',
                 pyads.PLCTYPE_BYTE) != 12):
             #get C2 parameters
-            rng = self.Blade.controlSectionsList
-            alpha = self._get_profile_list_params('alpha')
-            gamma2 = self._get_profile_list_params('gamma2')
-            b2 = self._get_profile_list_params('b2')
-            C2Nominal = self._get_profile_list_params('C2')
-            Y2 = self._get_profile_list_params('Y2')
-            R2 = self._get_profile_list_params('R2')
-            C2Tol = np.round(float(configparse.get_setting(self.configfile_path,
-                'Profile', 'C2Tol')), 2)
-            C2Pos = np.round(float(configparse.get_setting(self.configfile_path,
-                'Profile', 'C2Dist')), 2)
-            c2_options = {'rng': rng,
-                        'alpha': [min_to_decimal(i)
-                            for i in alpha],
-                        'gamma2': [min_to_decimal(i)
-                            for i in gamma2],
-                        'b2': b2,
-                        'C2Nominal': C2Nominal,
-                        'C2Tol': C2Tol,
-                        'Y2': Y2,
-                        'R2': R2,
-                        'C2Pos': C2Pos
-                        }
-
-            tCcPts, tCvPts, CcPts, CvPts, C2 = self.Blade.c2(**c2_options)
+            options = c2_options(configparse.get_settings(self.configfile_path),
+                                 self.Blade.controlSectionsList)
+            C2Nominal = options['C2Nominal']
+
+            tCcPts, tCvPts, CcPts, CvPts, C2 = self.Blade.c2(**options)
             self.C2 = C2
             self.C2Nominal = C2Nominal
             CcC2data, tCcC2data = (np.empty((len(self.Blade.concmes.profiles),2))
@@ -394,8 +415,8 @@ class TextronApp(object):
                 CvC2data[sec] = np.array(CvPts[ind])
                 tCcC2data[sec] = np.array(tCcPts[ind])
                 tCvC2data[sec] = np.array(tCvPts[ind])
-            self._add_glyphs(CcC2data, CvC2data, 'C2',
-                addHover = False, color = 'green')
+            self._in_document(job, partial(self._add_glyphs,
+                CcC2data, CvC2data, 'C2', addHover = False, color = 'green'))
             # self._add_glyphs(tCcC2data, tCvC2data, 'tC2',
             #     addHover = False, color = 'red')
             for ind, c2 in enumerate(C2):
@@ -509,11 +530,12 @@ class TextronApp(object):
             from settings.ini file
         '''
         additional_calibration = {}
+        settings = configparse.get_settings(self.configfile_path)
         for par in ['cv_shift_x', 'cc_shift_x', 'cv_shift_y', 'cc_shift_y',
                 'cv_tilt_a', 'cc_tilt_a', 'cv_tilt_b', 'cc_tilt_b',
                 'cv_tilt_c', 'cc_tilt_c']:
-            additional_calibration[par] = float(configparse.get_setting(
-                self.configfile_path, 'Calibration', par))
+            additional_calibration[par] = float(
+                settings['Calibration', par])
         return additional_calibration
 
     def _get_calibration_rng(self):
@@ -525,9 +547,32 @@ class TextronApp(object):
             'Calibration', par)) for par in ['startSection', 'endSection']]
         return secRng
 
-    def _get_profile_list_params(self, parameter):
-        return [np.round(float(i), 2) for i in configparse.get_setting(
-            self.configfile_path, 'Profile', parameter).split(', ')]
+    def _in_document(self, job, func, *args):
+        '''func(*args) here or, from a job stage, in the document'''
+        if job is None:
+            return func(*args)
+        return job.in_document(func, *args)
+
+    def _job_cancelled(self):
+        self._set_blade_buttons(True)
+        if self.calc_stock_btn.button_type == 'success':
+            self.calc_stock_btn_change()
+        self.status.text = 'Расчет прерван'
+        self._show_timing()
+
+    def _job_failed(self, error):
+        self._set_blade_buttons(True)
+        if self.calc_stock_btn.button_type == 'success':
+            self.calc_stock_btn_change()
+        self.status.text = 'Ошибка расчета: %s' % error
+        self._show_timing()
+
+    def _job_progress(self, stage, number, count):
+        self.status.text = 'Этап %d из %d: %s' % (number, count, stage)
+
+    def _set_blade_buttons(self, enabled):
+        for button in self.blade_buttons:
+            button.disabled = not enabled
 
     def _remove_glyphs(self):
         """
@@ -582,37 +627,91 @@ class TextronApp(object):
     def calc_and_send(self, attr,old,new):
         '''
             This method performs all the checkes and calls all the stock
-            callculation, then sends offsets and average stock values to PLC
+            callculation, then sends offsets and average stock values to PLC.
+            The calculation runs in the job thread of the session
+            (see _calc_stages), the interface is not blocked meanwhile.
+        '''
+        self.jobs.submit(self._calc_job('расчет припуска',
+                                        self._calc_stages(), self._calc_done))
+
+    def _calc_job(self, name, stages, done=None):
+        return jobs.Job(name, stages, progress=self._job_progress, done=done,
+                        failed=self._job_failed,
+                        cancelled=self._job_cancelled, timed=True)
+
+    def _calc_stages(self, fit=False):
         '''
+            stages of the calculation: fit - best fit first
+            (as in the automatic mode), except for post-grinding
+        '''
+        stages = [('ПЛК', self._calc_start)]
+        if fit:
+            stages.append(('припасовка', self._calc_best_fit))
+        stages += [('контрольные сечения', self._calc_control),
+                   ('C2', self._calc_c2),
+                   ('средний припуск', self._calc_areas),
+                   ('отправка в ПЛК', self._calc_send)]
+        return stages
+
+    def _calc_begin(self):
         try:
             self._remove_glyphs()
         except:
             pass
-        self.calc_stock_btn_change()
-        debugging = False
-        if self.debugging_toggle.active:
-            debugging = True
-
-        ##esteblish connection to PLC
-        plc = open_PLC_connection()
-
         # initial check of workpiece
         if not hasattr(self, 'Blade'):
             print('не загружена информация о профиле. Вычислить припуск невозможно')
-            self.calc_stock_btn_change()
-            return
-
-        scraped_convex, scraped_concave = self._check_initial(plc)
-
-        # check_C2
-        print('Calculating C2...')
+            return None
+        self._set_blade_buttons(False)
+        self.calc_stock_btn_change()
         self.showC2_toggle.active = False
-        scraped_c2 = self._check_c2(plc)
+        self.Blade.update_settings()
+        calc = self._calc_snapshot()
+        calc.update({'blade': self.Blade,
+                     'debugging': self.debugging_toggle.active})
+        return calc
+
+    def _calc_start(self, job, calc):
+        calc = job.in_document(self._calc_begin)
+        if calc is None:
+            raise jobs.Cancelled(job.name)
+        ##esteblish connection to PLC
+        calc['plc'] = open_PLC_connection()
+        if not calc['plc']:
+            raise ConnectionError('No ADS connection')
+        return calc
+
+    def _calc_best_fit(self, job, calc):
+        if calc['plc'].read_by_name('IO_R2.I_byteTaskID',
+                                    pyads.PLCTYPE_BYTE) != 12:
+            # the stock is calculated after the fit is applied
+            start = time.time()
+            task = job.in_document(self._best_fit_task)
+            if task is not None:
+                job.in_document(self._apply_best_fit, task(), start)
+            # the stock is calculated and sent for the fitted position
+            calc.update(job.in_document(self._calc_snapshot))
+        return calc
+
+    def _calc_control(self, job, calc):
+        calc['scraped_convex'], calc['scraped_concave'] = (
+            self._check_initial(calc['plc']))
+        return calc
+
+    def _calc_c2(self, job, calc):
+        print('Calculating C2...')
+        scraped_c2 = self._check_c2(calc['plc'], job)
         if scraped_c2:
             print('C2 is scrapoed')
         else:
             print('C2 is OK')
-        if ((not scraped_convex) and (not scraped_concave)) and (not scraped_c2):
+        calc['scraped_c2'] = scraped_c2
+        return calc
+
+    def _calc_areas(self, job, calc):
+        plc = calc['plc']
+        if ((not calc['scraped_convex']) and (not calc['scraped_concave'])
+                and (not calc['scraped_c2'])):
             noStock = self._check_nostock(plc)
             if not noStock:
                 '''
@@ -624,7 +723,7 @@ class TextronApp(object):
                 '''
                 #average stock calculation
                 print('На заготовке есть припуск\nВычисляю средний припуск...')
-                stockAreasConv, stockAreasConc = self.Blade.stock_calc_areas(
+                stockAreasConv, stockAreasConc = calc['blade'].stock_calc_areas(
                     range(113,342))
                 stockConvMean = stockAreasConv.areasMean
                 stockConcMean = stockAreasConc.areasMean
@@ -638,92 +737,78 @@ class TextronApp(object):
             noStock = False
             stockConvMean = {key: -1 for key in range(1,7)}
             stockConcMean = {key: -1 for key in range(1,7)}
+        calc['noStock'] = noStock
+        calc['stockConvMean'] = stockConvMean
+        calc['stockConcMean'] = stockConcMean
+        return calc
+
+    def _calc_send(self, job, calc):
+        plc = calc['plc']
+        debugging = calc['debugging']
+        noStock = calc['noStock']
+        stockConvMean = calc['stockConvMean']
+        stockConcMean = calc['stockConcMean']
+        # the offsets of the position the stock is calculated for
+        totalx, totaly = calc['offsets']
+        blade = calc['blade']
+        if calc['transforms'] != (blade.convmes.profiles.transform,
+                                  blade.concmes.profiles.transform):
+            raise RuntimeError('profiles are moved during the calculation')
         #import pdb; pdb.set_trace()
+        results = []
         if (not debugging) or self.simulator:
             print('sending mean stock to plc...')
             print('Convex: {}'.format(stockConvMean))
             print('Concave: {}'.format(stockConcMean))
-            plc.write_by_name('GVL_MeasuringUnit.rConvexSurfaceResults[1]',
-                stockConvMean[2], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConvexSurfaceResults[2]',
-                stockConvMean[1], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConvexSurfaceResults[3]',
-                stockConvMean[4], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConvexSurfaceResults[4]',
-                stockConvMean[3], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConvexSurfaceResults[5]',
-                stockConvMean[6], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConvexSurfaceResults[6]',
-                stockConvMean[5], pyads.PLCTYPE_REAL)
-
-            plc.write_by_name('GVL_MeasuringUnit.rConcaveSurfaceResults[1]',
-                stockConcMean[1], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConcaveSurfaceResults[2]',
-                stockConcMean[2], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConcaveSurfaceResults[3]',
-                stockConcMean[3], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConcaveSurfaceResults[4]',
-                stockConcMean[4], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConcaveSurfaceResults[5]',
-                stockConcMean[5], pyads.PLCTYPE_REAL)
-            plc.write_by_name('GVL_MeasuringUnit.rConcaveSurfaceResults[6]',
-                stockConcMean[6], pyads.PLCTYPE_REAL)
-
+            # results are written in one request with the offsets
             print('sending C2 to PLC...')
-            for i in range(1,5):
-                plc.write_by_name('GVL_MeasuringUnit.arrProfileMeasurements['+
-                    str(i)+'].C2', float(self.C2[i-1]), pyads.PLCTYPE_REAL)
+            results += plc_io.stock_results(stockConvMean, stockConcMean,
+                                            self.C2)
             if noStock:
                 '''option of no stock program'''
-                plc.write_by_name('GVL_MeasuringUnit.O_bytePostGrinding_CV',
-                    int(self.noStockProg.value) + 6, pyads.PLCTYPE_BYTE)
+                results.append(('GVL_MeasuringUnit.O_bytePostGrinding_CV',
+                    int(self.noStockProg.value) + 6, pyads.PLCTYPE_BYTE))
 
-        if self.totalx >= 0:
-            O_bytePathX_offsetPlus = int(self.totalx*100)
-            O_bytePathX_offsetMinus = 0
-        else:
-            O_bytePathX_offsetMinus = int(-self.totalx*100)
-            O_bytePathX_offsetPlus = 0
-        if self.totaly >= 0:
-            O_bytePathY_offsetPlus = int(self.totaly*100)
-            O_bytePathY_offsetMinus = 0
-        else:
-            O_bytePathY_offsetMinus = int(-self.totaly*100)
-            O_bytePathY_offsetPlus = 0
-        print('offsets:\nX: %f\nY: %f' %(self.totalx, self.totaly))
+        print('offsets:\nX: %f\nY: %f' %(totalx, totaly))
 
         '''if debugging is off and this is not post-grinding'''
         if (not debugging and plc.read_by_name('IO_R2.I_byteTaskID',
             pyads.PLCTYPE_BYTE)!= 12) or self.simulator:
 
             print("sending offsets...")
-            plc.write_by_name('GVL_MeasuringUnit.O_bytePathX_offsetPlus',
-                O_bytePathX_offsetPlus, pyads.PLCTYPE_BYTE)
-            plc.write_by_name('GVL_MeasuringUnit.O_bytePathX_offsetMinus',
-                O_bytePathX_offsetMinus, pyads.PLCTYPE_BYTE)
-            plc.write_by_name('GVL_MeasuringUnit.O_bytePathY_offsetPlus',
-                O_bytePathY_offsetPlus, pyads.PLCTYPE_BYTE)
-            plc.write_by_name('GVL_MeasuringUnit.O_bytePathY_offsetMinus',
-                O_bytePathY_offsetMinus, pyads.PLCTYPE_BYTE)
+            results += plc_io.offset_results(totalx, totaly)
 
         else:
             print('not sending offsets due to postmeasuring active or debugging')
+        if results:
+            with metrics.span('plc_results'):
+                plc.write_list(results)
         '''
             Rename the newest file
         '''
-        if not debugging and len(check_partID(plc)) != 0:
-            self.rename_profile_file(plc)
+        if not debugging:
+            with metrics.span('plc_part_id'):
+                partID = check_partID(plc)
+            metrics.annotate(part=partID)
+            if len(partID) != 0:
+                with metrics.span('rename'):
+                    self.rename_profile_file(plc, job, calc['offsets'])
         '''
             Close connection to plc
         '''
         if not debugging:
-            plc.write_by_name('GVL_MeasuringUnit.bMU_Processing',
-                False, pyads.PLCTYPE_BOOL)
+            with metrics.span('plc_processing_off'):
+                plc.write_by_name('GVL_MeasuringUnit.bMU_Processing',
+                    False, pyads.PLCTYPE_BOOL)
             plc.close()
+        return calc
 
+    def _calc_done(self, calc):
         print( 'done')
+        self._set_blade_buttons(True)
         self.calc_stock_btn_change()
         self._add_C2_to_status()
+        self._show_timing()
 
     def calc_stock_btn_change(self):
         if self.calc_stock_btn.button_type == "success":
@@ -752,9 +837,10 @@ class TextronApp(object):
             # self.update_debug_profiles_list()
             # profile_file = os.path.join(self.debug_profiles_dir.value,
             #                             self.debug_profiles_list[0])
-            load_options = {'profile_file': self.Blade.profile_file,
+            # the file is not read again, Blade keeps its data
+            load_options = {'profile_file': self.Blade.profile_data,
                             'secRng': self._get_calibration_rng()}
-            print('using %s file for calibration' %profile_file)
+            print('using %s file for calibration' % self.Blade.profile_file)
             create_calibration_arrays(**load_options)
             self.status.text = ('Калибровка прошла успешно.' +
                 ' Cоздан новый файл с калибровочными коэффициентами')
@@ -771,9 +857,9 @@ class TextronApp(object):
             plc.close()
 
     def clear_data(self, attr, old, new):
-        '''clear all data from the graphs'''
-
-        self.reset(attr, old, new)
+        '''clear all data from the graphs, the calculation is cancelled'''
+        self.jobs.cancel(CALC_JOBS)
+        self._reset_shifts()
         self.curfile.text = ''
         if hasattr(self, 'Blade'):
             del self.Blade
@@ -882,7 +968,8 @@ class TextronApp(object):
                        self.update_additional_calibration_btn),
             ),
             title='Калибровка')
-        tabs = Tabs(tabs = [tab1, tab2, tab3, tab4])
+        tab5 = Panel(child = column(self.timing), title = 'Время расчета')
+        tabs = Tabs(tabs = [tab1, tab2, tab3, tab4, tab5])
         self.status_btn.width = 20
         l = column(children = [tabs, self.status, self.status_btn],
                     # sizing_mode = 'scale_width',
@@ -965,7 +1052,10 @@ class TextronApp(object):
     '''Section with callbacks'''
     def ld_profiles(self, attr, old, new):
         '''
-            Method to load the measured profiles data
+            Method to load the measured profiles data. The file is read in
+            the job thread, in the automatic mode the stock calculation
+            follows in the same job. The jobs for the previous profile are
+            cancelled.
         '''
         self.status.text = ('Идет загрузка профиля')
         try:
@@ -987,16 +1077,31 @@ class TextronApp(object):
                 'dynamic_profile_name': False,
                 'profile_file': profile_file,
                 'calibration_arrays_file': self.calibration_arrays.value,
-                'additional_calibration': self._get_additional_calibration()
+                'additional_calibration': self._get_additional_calibration(),
+                'settings': configparse.get_settings(self.configfile_path)
                 }
         else:
             load_options = {
                 'dynamic_profile_name': True,
                 'calibration_arrays_file': self.calibration_arrays.value,
-                'additional_calibration': self._get_additional_calibration()
+                'additional_calibration': self._get_additional_calibration(),
+                'settings': configparse.get_settings(self.configfile_path)
                 }
+        stages = [('загрузка', partial(self._load_blade, load_options))]
+        done = None
+        if self.production_on.active and not self.debugging_toggle.active:
+            stages += self._calc_stages(fit=True)
+            done = self._calc_done
+        self.jobs.submit(self._calc_job('загрузка профиля', stages, done),
+                         cancel=True)
+
+    def _load_blade(self, load_options, job, calc):
         '''create the blade object'''
-        self.Blade = Airfoil(**load_options)
+        Blade = Airfoil(**load_options)
+        job.in_document(self._show_blade, Blade)
+
+    def _show_blade(self, Blade):
+        self.Blade = Blade
         print('profile file: %s data loaded successfully'
                 %(self.Blade.profile_file))
         self.update_plots_sources()
@@ -1005,18 +1110,6 @@ class TextronApp(object):
         self.curfile.text = os.path.basename(self.Blade.profile_file)
         self.update_debug_profiles_list()
 
-        if self.production_on.active and not self.debugging_toggle.active:
-            plc = open_PLC_connection()
-            if plc:
-                if plc.read_by_name('IO_R2.I_byteTaskID',
-                                    pyads.PLCTYPE_BYTE)!= 12:
-                    self.bestfit_btn.clicks += 1
-                    sleep(2)
-                self.calc_stock_btn.clicks += 1
-                plc.close()
-            else:
-                print('No ADS connection')
-
     def mode_toggle(self, attr, old, new):
         '''
             Method to switch between auto and manual mode
@@ -1029,50 +1122,44 @@ class TextronApp(object):
             self.production_on.label = "Автоматический режим ВЫКЛ."
 
     def move_a_plus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.rotate_a(float(self.angle_step_input.value)/60)
 
     def move_a_minus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.rotate_a(-float(self.angle_step_input.value)/60)
 
     def move_b_plus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.rotate_b(float(self.angle_step_input.value)/60)
 
     def move_b_minus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.rotate_b(-float(self.angle_step_input.value)/60)
 
     def move_c_plus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.rotate_c(float(self.angle_step_input.value)/60)
-            self.update_plots_sources()
 
     def move_c_minus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.rotate_c(-float(self.angle_step_input.value)/60)
-            self.update_plots_sources()
 
     def move_x_plus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.shift_profiles('X', float(self.step_input.value))
-            self.update_plots_sources()
 
     def move_x_minus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.shift_profiles('X', -float(self.step_input.value))
-            self.update_plots_sources()
 
     def move_y_plus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.shift_profiles('Y', float(self.step_input.value))
-            self.update_plots_sources()
 
     def move_y_minus(self, attr, old, new):
-        if hasattr(self, 'Blade'):
+        if hasattr(self, 'Blade') and not self._blade_locked():
             self.shift_profiles('Y', -float(self.step_input.value))
-            self.update_plots_sources()
 
     def no_stock_threshold_change(self, old, new):
         try:
@@ -1083,33 +1170,81 @@ class TextronApp(object):
             self.no_stock_threshold.value = old
 
     def perform_best_fit(self, attr, old, new):
-        if not hasattr(self, 'Blade'):
+        '''
+            Best fit button: the fit runs in the job thread,
+            the interface stays responsive meanwhile
+        '''
+        if not hasattr(self, 'Blade') or self._blade_locked():
             return
-        import time
+        if self.jobs.running('припасовка'):
+            print('best fit is already running')
+            return
+        self.status.text = 'Идет припасовка'
+        self.jobs.submit(jobs.Job('припасовка',
+                                  [('припасовка', self._fit_stage)],
+                                  done=self._fit_done,
+                                  failed=self._fit_failed))
+
+    def _fit_stage(self, job, value):
         start = time.time()
+        task = job.in_document(self._best_fit_task)
+        if task is None:
+            return None
+        result = task()
+        job.in_document(self._apply_best_fit, result, start)
+        return result
+
+    def _fit_done(self, result):
+        if result is not None:
+            self.status.text = 'Припасовка завершена'
+
+    def _fit_failed(self, error):
+        print('best fit failed: %s' % error)
+        self.status.text = 'Ошибка припасовки'
+
+    def _best_fit_task(self):
+        '''
+            Reset the shifts and return the fit of the measured profiles
+            to the templates, None if there is no profile. The fit reads
+            a snapshot of the control sections, nothing is copied or
+            changed until the shift is applied.
+        '''
+        if not hasattr(self, 'Blade'):
+            return None
         print('Starting bes fit operation...')
         #----------------
-        self.reset(attr, old, new)
-        Blade = copy.deepcopy(self.Blade)
-        bestFitMethod = configparse.get_setting(self.configfile_path,
-            'Processing', 'bestfit_method')
+        self._reset_shifts()
+        Blade = self.Blade
+        Blade.update_settings()
+        bestFitMethod = Blade.settings['Processing', 'bestfit_method']
         if bestFitMethod == '1':
-            x_shift, y_shift = np.round(Blade.autoshift(), 2)
+            return partial(centroids_shift, *Blade.control_snapshot(),
+                           Blade.controlSectionsList)
         elif bestFitMethod == '2':
-            x_shift, y_shift = np.round(Blade.autoshift2(), 2)
+            return partial(bestfit_shift, *Blade.control_snapshot(),
+                           Blade.controlSectionsList, Blade.settings)
+        print('unknown best fit method %s' % bestFitMethod)
+        return None
+
+    def _apply_best_fit(self, result, start):
+        x_shift, y_shift = np.round(result[:2], 2)
+        if len(result) > 2 and result[2].c:
+            # the fit rotates the profiles before the shift
+            self.rotate_c(result[2].c)
         self.shift_profiles('X', x_shift)
         self.shift_profiles('Y', y_shift)
-        self.update_plots_sources()
-        del Blade
         #----------------
         print('X shift: {:.2}, Y shift: {:.2}'.format(x_shift, y_shift))
         print('best fit took {:.2} seconds'.format(time.time()-start))
 
-    def rename_profile_file(self, plc):
+    def rename_profile_file(self, plc, job=None, offsets=None):
+        '''offsets - (X, Y) in the new name, the current ones by default'''
+        if offsets is None:
+            offsets = (self.totalx, self.totaly)
         if plc.read_by_name('IO_R2.I_byteTaskID',pyads.PLCTYPE_BYTE) != 12:
                 newName = (check_partID(plc)+'-pre'+
-                    'X{0:5.2f}'.format(self.totalx)+
-                    'Y{0:5.2}'.format(self.totaly)+'.profile')
+                    'X{0:5.2f}'.format(offsets[0])+
+                    'Y{0:5.2}'.format(offsets[1])+'.profile')
         else:
                 newName = check_partID(plc)+'-post.profile'
         print('renaming profile file to %s' %newName)
@@ -1118,31 +1253,39 @@ class TextronApp(object):
             path = self.Blade.profile_dir
             shutil.move(os.path.join(path, self.Blade.profile_file),
                         os.path.join(path, newName))
-            self.update_debug_profiles_list()
-            self.curfile.text = newName
+            self._in_document(job, self._show_renamed, newName)
             print('renamed successfully')
         except FileNotFoundError:
             print('renaming failed')
 
 
+    def _show_renamed(self, newName):
+        self.update_debug_profiles_list()
+        self.curfile.text = newName
+
     def reset(self, attr, old, new):
+        '''reset button, not during the calculation'''
+        if not self._blade_locked():
+            self._reset_shifts()
+
+    def _reset_shifts(self):
         '''
-            reset all the shifting
+            reset all the shifting: the transforms of the measured
+            profiles are dropped, the data is not moved back
         '''
-
+        self.showC2_toggle.active = False
         try:
-            self.shift_profiles('X', -self.totalx)
-            self.shift_profiles('Y', -self.totaly)
-            self.rotate_c(-self.totalc)
-            self.rotate_a(-self.totala)
-            self.rotate_b(-self.totalb)
-            self.update_plots_sources()
-            # try:
-            #     self.scatters
-            #     self.show_stock()
-            # except:
-            #     pass
+            self._remove_glyphs()
         except:
+            pass
+        try:
+            self.Blade.reset()
+            self.totalx, self.totaly = 0.0, 0.0
+            self.totala, self.totalb, self.totalc = 0.0, 0.0, 0.0
+            self.update_plots_sources()
+            if self.showstock_toggle.active:
+                self.show_stock(recalculate=False)
+        except AttributeError:
             print('empty graphs. Nothing to reset')
         self.div.text = self.shift_div_text_set()
         self.status.text = ('Смещения сброшены')
@@ -1160,26 +1303,12 @@ class TextronApp(object):
         self.rotate_a_b('b', ang_deg)
 
     def rotate_a_b(self, ax, ang_deg):
+        '''
+            Tilt the measured profiles, A or B axis
+        '''
         self.showC2_toggle.active = False
-        ang_rad = np.radians(ang_deg)
-        secList = [12.1, 22.1, 32.1, 34.1]
-        for i, s in enumerate([self.source1, self.source2, self.source3,
-                               self.source4]):
-            xs = s.data['xs']
-            ys = s.data['ys']
-            # for sec in [12.1, 22.1, 32.1, 34.1]:
-            #    for y in [ys[2],ys[3]]:
-            #        y += sec*np.tan(ang_rad)
-            if ax == 'a':
-                for y in [ys[2],ys[3]]:
-                   y += secList[i]*np.tan(ang_rad)
-            else:
-                for x in [xs[2], xs[3]]:
-                   x += secList[i]*np.tan(ang_rad)
-
-            s.data = {'xs': xs, 'ys': ys,
-                    'colors': s.data['colors'],
-                    'labels': s.data['labels']}
+        self.Blade.tilt(ax, ang_deg)
+        self.update_plots_sources()
         if ax == 'a':
             self.totala += ang_deg
         else:
@@ -1187,32 +1316,30 @@ class TextronApp(object):
         self.div.text = self.shift_div_text_set()
         try:
             self.scatters
-            self.show_stock()
+            self.show_stock(recalculate=False)
         except:
             pass
 
-
     def rotate_c(self, ang_deg):
         '''
             Rotate profiles on graphs, C-axis
+            (around the point the profiles are shifted to)
         '''
         self.showC2_toggle.active = False
-        convmes, concmes = self.Blade.convmes, self.Blade.concmes
-        totalx = self.totalx
-        totaly = self.totaly
-        self.shift_profiles('X', -self.totalx)
-        self.shift_profiles('Y', -self.totaly)
-        convmes.rotate(ang_deg)
-        concmes.rotate(ang_deg)
-        self.shift_profiles('X', totalx)
-        self.shift_profiles('Y', totaly)
-        self.totalc += ang_deg
-        self.div.text = self.shift_div_text_set()
         try:
-            self.scatters
-            self.show_stock()
+            self._remove_glyphs()
         except:
             pass
+        # control sections stock is updated by Blade for the rotation
+        self.Blade.rotate(ang_deg, center=(self.totalx, self.totaly))
+        self.totalc += ang_deg
+        self.div.text = self.shift_div_text_set()
+        self.update_plots_sources()
+        if self.showstock_toggle.active:
+            self.show_stock(recalculate=False)
+
+    def _show_timing(self):
+        self.timing.text = metrics.html_table(metrics.recent)
 
     def shift_div_text_set(self):
         '''
@@ -1229,41 +1356,65 @@ class TextronApp(object):
             Shift profiles in X or Y direction
         '''
         self.showC2_toggle.active = False
-        self.showstock_toggle.active = False
         try:
             self._remove_glyphs()
         except:
             pass
-        convmes, concmes = self.Blade.convmes, self.Blade.concmes
         if axis == 'X':
             self.totalx += shift
-            for s in range(len(concmes.profiles)):
-                convmes.profiles[s][0] += shift
-                concmes.profiles[s][0] += shift
         elif axis == 'Y':
             self.totaly += shift
-            for s in range(len(concmes.profiles)):
-                convmes.profiles[s][1] += shift
-                concmes.profiles[s][1] += shift
+        # control sections stock is updated by Blade for the shift
+        self.Blade.move(axis, shift)
         self.div.text = self.shift_div_text_set()
+        # the stock is shown on the moved profiles
+        self.update_plots_sources()
+        if self.showstock_toggle.active:
+            self.show_stock(recalculate=False)
 
+    def show_stock(self, recalculate=True):
+        '''
+            recalculate - False to show the control sections stock
+            of Blade as it is (kept up to date by Blade.move, rotate,
+            tilt and reset); it is recalculated in the job thread
+        '''
+        self.status.text = ('Идет расчет припуска для контрольных сечений')
         try:
-            self.scatters
-            self.show_stock()
+            self._remove_glyphs()
         except:
             pass
-
-    def show_stock(self):
-        self.status.text = ('Идет расчет припуска для контрольных сечений')
+        if not hasattr(self, 'Blade'):
+            self._show_stock_failed(None)
+        elif recalculate or not hasattr(self.Blade, 'stockConvControl'):
+            self.jobs.submit(jobs.Job(
+                'припуск контрольных сечений',
+                [('контрольные сечения', self._stock_stage)],
+                done=self._show_stock_glyphs,
+                failed=self._show_stock_failed))
+        else:
+            self._show_stock_glyphs((self.Blade.stockConvControl,
+                                     self.Blade.stockConcControl))
+
+    def _stock_stage(self, job, value):
+        print('calculating stock material')
+        Blade = self.Blade
+        Blade.update_settings()
+        stock = Blade.stock_calc_control()
+        print('stock is calculated!')
+        return stock
+
+    def _show_stock_failed(self, error):
+        print('Профиль не загружен. Невозможно расчитать припуск')
+        self.status.text = (
+            'Профиль не загружен. Невозможно расчитать припуск')
+
+    def _show_stock_glyphs(self, stock):
+        stock_conv, stock_conc = stock
         try:
             self._remove_glyphs()
         except:
             pass
-
         try:
-            print('calculating stock material')
-            stock_conv, stock_conc = self.Blade.stock_calc_control()
-            print('stock is calculated!')
             # plots_to_update = {121: self.plot1, 221: self.plot2,
             #     321: self.plot3, 341: self.plot4}
             # sources = {121: self.source1, 221: self.source2,
@@ -1291,9 +1442,7 @@ class TextronApp(object):
             self.status.text = (
                 'Расчет припуска для контрольных сечений завершен')
         except:
-            print('Профиль не загружен. Невозможно расчитать припуск')
-            self.status.text = (
-                'Профиль не загружен. Невозможно расчитать припуск')
+            self._show_stock_failed(None)
 
     def show_C2_callback(self, attr, old, new):
         if self.showC2_toggle.active:
@@ -1303,8 +1452,10 @@ class TextronApp(object):
             except:
                 pass
             self.showC2_toggle.button_type = 'success'
-            self._check_c2()
-            self._add_C2_to_status()
+            self.jobs.submit(jobs.Job(
+                'C2', [('C2', lambda job, value: self._check_c2(job=job))],
+                done=lambda value: self._add_C2_to_status(),
+                failed=self._job_failed))
         else:
             self.showC2_toggle.button_type = 'default'
             try:
@@ -1439,37 +1590,20 @@ def check_partID(plc):
 
 def get_files_list(path):
     '''
-        get list of files in the given directory
+        get list of files in the given directory, newest first
     '''
-    files = os.listdir(path)
-    if files:
-        files = [os.path.join(path, file) for file in files]
-        files = sorted([file for file in files if os.path.isfile(file)],
-            key = os.path.getmtime)
-        for i,file in enumerate(files):
-            files[i] = os.path.basename(files[i])
-    return files[::-1]
-
-def min_to_decimal(ang):
-    """
-        convert [deg.min] to decimal degrees
-    """
-    main = np.modf(ang)[1]
-    part = np.round(np.modf(ang)[0] * 100 / 60, 2)
-    return main + part
+    return profile_watcher.get_watcher(path).files()
 
 def open_PLC_connection():
-    try:
-        if '--simulator' in argv or '-s' in argv:
-            # plc = False
-            plc = PLCDEBUG()
-        else:
-            plc = pyads.Connection('5.41.213.16.1.1', 851)
-            plc.open()
+    '''
+        the PLC connection shared with the server (PLCDEBUG in the
+        simulator mode), False if it can not be opened;
+        close() of it does not close the shared connection
+    '''
+    plc = plc_io.get_connection()
+    if plc.connect():
         return plc
-    except:
-        print('No ADS connection')
-        return False
+    return False
 
 
 def send_processing_off(attr, old, new):
@@ -1491,3 +1625,7 @@ def str2bool(v):
 Textron = TextronApp()
 curdoc().add_root(Textron.create_layout())
 curdoc().title = 'Textron v1.1.4b-1'
+# widgets changed by the server
+sessions.get_registry().register(
+    curdoc(), status=Textron.status_btn, load=Textron.profiles_btn,
+    checkControlSections=Textron.use_control_sections_check_toggle)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+'''
+    Long-lived process pool for stock calculation.
+
+    The pool is started once with the server. Profiles reach the workers
+    through shared memory (see PackedProfiles.share): templates are
+    shared once per templates key and kept attached in the workers (with
+    their spline segments) for the next parts, measured profiles are
+    shared for one calculation.
+'''
+import numpy as np
+import os
+import threading
+
+from multiprocessing import Pool
+
+from textron.calculate_stock import Stock_areas, area_jobs, area_stock_rows
+from textron.calculate_stock import profile_special
+from textron.logging_module import worker_logging, worker_queue
+from textron.logging_module import write_to_log
+from textron.packed_profiles import PackedProfiles
+
+print = write_to_log
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# templates attached in this worker process, by templates key
+_worker_templates = {}
+# measured profiles attached in this worker process, by descriptor
+_worker_mes = {}
+
+
+class StockPool(object):
+    '''
+        Process pool sized from the core count
+    '''
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        if os.name == 'posix':
+            # workers must share the tracker of the shared memory blocks
+            # with this process, otherwise every one of them starts its
+            # own and removes the blocks it has seen on exit
+            from multiprocessing import resource_tracker
+            resource_tracker.ensure_running()
+        # the records of the workers are written by this process
+        self._pool = Pool(self.processes, initializer=worker_logging,
+                          initargs=(worker_queue(),))
+        # templates key and {side: (shared profiles, descriptor)}
+        self._templates = (None, {})
+
+    def apply(self, func, args=()):
+        return self._pool.apply(func, args)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self._unlink_templates()
+
+    def _share_templates(self, key, templates):
+        if self._templates[0] != key:
+            self._unlink_templates()
+            self._templates = (key, {side: templates[side].profiles.share()
+                                     for side in templates})
+        return {side: shared[1]
+                for side, shared in self._templates[1].items()}
+
+    def _unlink_templates(self):
+        for shared, _ in self._templates[1].values():
+            shared.unlink()
+        self._templates = (None, {})
+
+    def stock_areas(self, key, templates, mes, rng, spline):
+        '''
+            Stock_areas for both sides, split across all workers
+            by chunks of sections.
+            key - templates key, see templates_key
+            templates, mes - {'convex': profile, 'concave': profile}
+        '''
+        jobs = area_jobs(rng)
+        chunks = [jobs[i::self.processes] for i in range(self.processes)]
+        chunks = [c for c in chunks if c]
+        tasks = [(side, chunk) for side in ('convex', 'concave')
+                 for chunk in chunks]
+        # templates changed in memory are shared again
+        key = (key, tuple(templates[side].profiles.version
+                          for side in sorted(templates)))
+        templ_desc = self._share_templates(key, templates)
+        shared_mes = {side: mes[side].profiles.share() for side in mes}
+        try:
+            results = [self._pool.apply_async(
+                           _area_stock_task,
+                           (key, templ_desc, side, chunk,
+                            shared_mes[side][1], spline))
+                       for side, chunk in tasks]
+            rows = [result.get() for result in results]
+        finally:
+            for shared, _ in shared_mes.values():
+                shared.unlink()
+        side_jobs = [job for chunk in chunks for job in chunk]
+        stock = []
+        for side in ('convex', 'concave'):
+            side_rows = np.vstack([r for (s, _), r in zip(tasks, rows)
+                                   if s == side])
+            stock.append(Stock_areas.from_rows(rng, side, side_jobs,
+                                               side_rows))
+        return tuple(stock)
+
+
+def get_pool():
+    '''the running pool, started on first use'''
+    return start_pool()
+
+
+def start_pool(processes=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = StockPool(processes)
+            print('worker pool started with %d processes' % _pool.processes)
+        return _pool
+
+
+def stop_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+            print('worker pool stopped')
+
+
+def templates_key(*filenames):
+    '''identifies templates by their files and modification times'''
+    key = []
+    for filename in filenames:
+        filename = os.path.abspath(filename)
+        try:
+            key.append((filename, os.path.getmtime(filename)))
+        except OSError:
+            key.append((filename, None))
+    return tuple(key)
+
+
+def _area_stock_task(key, templ_desc, side, jobs, mes_desc, spline):
+    if key not in _worker_templates:
+        for templates in _worker_templates.values():
+            for templ in templates.values():
+                templ.profiles.close()
+        _worker_templates.clear()
+        for s, desc in templ_desc.items():
+            templ = profile_special()
+            templ.profiles = PackedProfiles.attach(desc)
+            _worker_templates.setdefault(key, {})[s] = templ
+    if not isinstance(mes_desc, PackedProfiles):
+        # measured profiles of the previous parts are already unlinked
+        if mes_desc not in _worker_mes:
+            for profiles in _worker_mes.values():
+                profiles.close()
+            _worker_mes.clear()
+            _worker_mes[mes_desc] = PackedProfiles.attach(mes_desc)
+        mes = _worker_mes[mes_desc]
+    else:
+        mes = mes_desc
+    return area_stock_rows([mes[s] for _, _, s in jobs],
+                           _worker_templates[key][side], jobs, side, spline)